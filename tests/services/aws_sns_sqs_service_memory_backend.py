@@ -0,0 +1,81 @@
+import asyncio
+import os
+import signal
+import tomodachi
+import uuid
+from typing import Any
+from tomodachi.protocol.json_base import JsonBase
+from tomodachi.transport.aws_sns_sqs import aws_sns_sqs, aws_sns_sqs_publish, sqs, sqs_send_batch
+
+data_uuid = str(uuid.uuid4())
+
+
+@tomodachi.service
+class AWSSNSSQSService(tomodachi.Service):
+    name = 'test_aws_sns_sqs_memory_backend'
+    log_level = 'INFO'
+    message_protocol = JsonBase
+    options = {
+        'aws_sns_sqs': {
+            'backend': 'memory',
+            'wait_time_seconds': 1
+        }
+    }
+    uuid = os.environ.get('TOMODACHI_TEST_SERVICE_UUID')
+    closer = asyncio.Future()  # type: Any
+    test_topic_data_received = False
+    test_topic_metadata_topic = None
+    test_filtered_topic_data = None  # type: Any
+    test_queue_data = None  # type: Any
+    data_uuid = data_uuid
+
+    def check_closer(self):
+        if self.test_topic_data_received and self.test_filtered_topic_data is not None and self.test_queue_data is not None and len(self.test_queue_data) == 25:
+            if not self.closer.done():
+                self.closer.set_result(None)
+
+    @aws_sns_sqs('test-topic')
+    async def test(self, data: Any, metadata: Any, service: Any) -> None:
+        if data == self.data_uuid:
+            self.test_topic_data_received = True
+            self.test_topic_metadata_topic = metadata.get('topic')
+
+            self.check_closer()
+
+    @aws_sns_sqs('test-filtered-topic', filter_policy={'event': ['created']}, raw_message_delivery=True)
+    async def test_filtered(self, data: Any) -> None:
+        if self.test_filtered_topic_data is not None:
+            raise Exception('test_filtered_topic_data already set')
+        self.test_filtered_topic_data = data
+
+        self.check_closer()
+
+    @sqs('test-queue', max_in_flight=5)
+    async def test_queue(self, data: Any) -> None:
+        self.test_queue_data = (self.test_queue_data or []) + [data]
+
+        self.check_closer()
+
+    async def _started_service(self) -> None:
+        async def _async() -> None:
+            async def sleep_and_kill() -> None:
+                await asyncio.sleep(10.0)
+                if not self.closer.done():
+                    self.closer.set_result(None)
+
+            task = asyncio.ensure_future(sleep_and_kill())
+            await self.closer
+            if not task.done():
+                task.cancel()
+            os.kill(os.getpid(), signal.SIGINT)
+        asyncio.ensure_future(_async())
+
+        self.data_uuid = str(uuid.uuid4())
+        await aws_sns_sqs_publish(self, self.data_uuid, topic='test-topic')
+        await aws_sns_sqs_publish(self, 'deleted', topic='test-filtered-topic', attributes={'event': 'deleted'})
+        await aws_sns_sqs_publish(self, 'created', topic='test-filtered-topic', attributes={'event': 'created'})
+        await sqs_send_batch(self, list(range(25)), queue_name='test-queue')
+
+    def stop_service(self) -> None:
+        if not self.closer.done():
+            self.closer.set_result(None)
@@ -1,9 +1,14 @@
+import asyncio
+import io
 import os
+import struct
 import signal
 import pytest
-from typing import Any
-from tomodachi.transport.amqp import AmqpTransport, AmqpException
+import aioamqp
+from typing import Any, Dict, List
+from tomodachi.transport.amqp import AmqpTransport, AmqpException, AmqpInternalServiceError, AmqpRpcError, AmqpRpcTimeout, AmqpPublisherConfirms, AmqpPublishNotConfirmed, AmqpChannelClosed, AmqpChannelError, AmqpAckCoalescer
 from run_test_service_helper import start_service
+from tomodachi.protocol import JsonBase
 
 
 def test_routing_key(monkeypatch: Any) -> None:
@@ -65,3 +70,610 @@ def test_publish_invalid_credentials(monkeypatch: Any, capsys: Any, loop: Any) -
     out, err = capsys.readouterr()
     assert 'Unable to connect [amqp] to 127.0.0.1:54321' in err
     assert out == ''
+
+
+class FakeChannel(object):
+    def __init__(self) -> None:
+        self.calls = []  # type: List
+        self.consumers = {}  # type: Dict[str, Any]
+        self.close_event = asyncio.Event()
+        self.close_on_publish = None  # type: Any
+
+    @property
+    def is_open(self) -> bool:
+        return not self.close_event.is_set()
+
+    async def exchange_declare(self, **kwargs: Any) -> None:
+        self.calls.append(('exchange_declare', kwargs.get('exchange_name')))
+
+    async def exchange_bind(self, exchange_destination: str, exchange_source: str, routing_key: str, **kwargs: Any) -> None:
+        self.calls.append(('exchange_bind', exchange_destination, exchange_source, routing_key))
+
+    async def queue_declare(self, queue_name: str, **kwargs: Any) -> Dict:
+        self.calls.append(('queue_declare', queue_name, kwargs.get('arguments')))
+        return {'queue': queue_name, 'consumer_count': 0}
+
+    async def queue_bind(self, queue_name: str, exchange_name: str, routing_key: str, **kwargs: Any) -> None:
+        self.calls.append(('queue_bind', queue_name, exchange_name, routing_key))
+
+    async def basic_qos(self, prefetch_size: int = 0, prefetch_count: int = 0, connection_global: Any = None) -> None:
+        self.calls.append(('basic_qos', prefetch_size, prefetch_count))
+
+    async def basic_consume(self, callback: Any, queue_name: str = '', **kwargs: Any) -> Dict:
+        self.calls.append(('basic_consume', queue_name))
+        self.consumers[queue_name] = callback
+        return {'consumer_tag': queue_name}
+
+    async def basic_client_ack(self, delivery_tag: int, multiple: bool = False) -> None:
+        self.calls.append(('basic_client_ack', delivery_tag, multiple))
+
+    async def basic_client_nack(self, delivery_tag: int, multiple: bool = False, requeue: bool = True) -> None:
+        self.calls.append(('basic_client_nack', delivery_tag, multiple, requeue))
+
+    async def basic_publish(self, payload: bytes, exchange_name: str, routing_key: str, **kwargs: Any) -> None:
+        assert payload, 'Payload cannot be empty'
+        if not self.is_open:
+            raise aioamqp.exceptions.ChannelClosed()
+        self.calls.append(('basic_publish', payload, exchange_name, routing_key, kwargs.get('properties')))
+        if self.close_on_publish:
+            self.connection_closed(*self.close_on_publish)
+
+    async def confirm_select(self) -> None:
+        self.calls.append(('confirm_select',))
+
+    def connection_closed(self, *args: Any, **kwargs: Any) -> None:
+        self.calls.append(('connection_closed',))
+        self.close_event.set()
+
+
+class FakeFrame(object):
+    def __init__(self, delivery_tag: int, multiple: bool) -> None:
+        self.payload = io.BytesIO(struct.pack('!QB', delivery_tag, 1 if multiple else 0))
+
+
+class FakeProtocol(object):
+    def __init__(self) -> None:
+        self.channels = []  # type: List[FakeChannel]
+        self.state = aioamqp.protocol.OPEN
+        self.connection_closed = asyncio.Event()
+        self.close_on_publish = None  # type: Any
+
+    async def channel(self) -> FakeChannel:
+        channel = FakeChannel()
+        channel.close_on_publish = self.close_on_publish
+        self.channels.append(channel)
+        return channel
+
+    async def close(self) -> None:
+        pass
+
+    def connection_lost(self) -> None:
+        self.state = aioamqp.protocol.CLOSED
+        for channel in self.channels:
+            channel.connection_closed()
+        self.connection_closed.set()
+
+
+class FakeTransport(object):
+    def close(self) -> None:
+        pass
+
+
+class FakeEnvelope(object):
+    def __init__(self, delivery_tag: int) -> None:
+        self.delivery_tag = delivery_tag
+
+
+class FakeService(object):
+    uuid = '5d0b530f-5c44-4981-b01f-342801bd48f5'
+
+
+def start_fake_consumer(monkeypatch: Any, loop: Any, func: Any, context: Dict, **kwargs: Any) -> FakeProtocol:
+    protocol = FakeProtocol()
+    protocols = [protocol]
+
+    async def connect(**kwargs: Any) -> Any:
+        # Connections made after the first one are new connections, made when recovering from a lost connection
+        if protocols[-1].state != aioamqp.protocol.OPEN:
+            protocols.append(FakeProtocol())
+        return FakeTransport(), protocols[-1]
+
+    monkeypatch.setattr(aioamqp, 'connect', connect)
+    monkeypatch.setattr(AmqpTransport, 'channel', None)
+    monkeypatch.setattr(AmqpTransport, 'shard_keys', {})
+
+    async def _async() -> None:
+        _subscribe = await AmqpTransport.subscribe_handler(AmqpTransport, FakeService(), context, func, 'test.topic', **kwargs)
+        await _subscribe()
+
+    loop.run_until_complete(_async())
+    return protocol
+
+
+def test_prefetch_and_handler_concurrency(monkeypatch: Any, loop: Any) -> None:
+    handled = []  # type: List
+    running = [0, 0]
+
+    async def func(self: Any, data: Any) -> None:
+        running[0] += 1
+        running[1] = max(running)
+        await asyncio.sleep(0.01)
+        handled.append(data)
+        running[0] -= 1
+
+    protocol = start_fake_consumer(monkeypatch, loop, func, {}, prefetch_count=3)
+    channel = protocol.channels[-1]
+    assert ('basic_qos', 0, 3) in channel.calls
+    callback = list(channel.consumers.values())[0]
+
+    async def _async() -> None:
+        # The callback never blocks the connection, even when every handler slot is taken
+        for i in range(10):
+            await callback(channel, str(i).encode(), FakeEnvelope(i + 1), None)
+        assert len(AmqpTransport.handler_tasks) == 10
+        assert handled == []
+        await asyncio.wait(list(AmqpTransport.handler_tasks))
+        await asyncio.sleep(0.05)
+
+    loop.run_until_complete(_async())
+
+    assert sorted(handled) == [str(i) for i in range(10)]
+    assert running[1] == 3
+    assert max([call[1] for call in channel.calls if call[0] == 'basic_client_ack' and call[2]]) == 10
+
+
+def test_publisher_confirms(loop: Any) -> None:
+    channel = FakeChannel()
+    publisher_confirms = AmqpPublisherConfirms(channel, max_outstanding=4)
+
+    async def _async() -> None:
+        await publisher_confirms.enable()
+        futures = [await publisher_confirms.publish(str(i).encode(), 'amq.topic', 'test.topic') for i in range(4)]
+        assert publisher_confirms.semaphore.locked()
+
+        # A single ack with the multiple flag set confirms every publish up to the delivery tag
+        await channel.basic_server_ack(FakeFrame(3, True))
+        assert [future.done() for future in futures] == [True, True, True, False]
+        await asyncio.sleep(0)
+        assert not publisher_confirms.semaphore.locked()
+
+        await channel.basic_server_nack(FakeFrame(4, False))
+        with pytest.raises(AmqpPublishNotConfirmed):
+            await futures[3]
+
+        future = await publisher_confirms.publish(b'data', 'amq.topic', 'test.topic')
+        channel.connection_closed()
+        with pytest.raises(AmqpChannelClosed):
+            await future
+
+    loop.run_until_complete(_async())
+    assert ('confirm_select',) in channel.calls
+    assert len([call for call in channel.calls if call[0] == 'basic_publish']) == 5
+
+
+def test_ack_coalescer(loop: Any) -> None:
+    channel = FakeChannel()
+    acks = AmqpAckCoalescer(channel, batch_size=4, linger_time=0.01)
+
+    async def _async() -> None:
+        for delivery_tag in range(1, 10):
+            acks.received(delivery_tag)
+
+        # Acks are sent as a single multiple ack once batch_size messages have been handled
+        for delivery_tag in [2, 1, 4, 3]:
+            await acks.ack(delivery_tag)
+        assert channel.calls == [('basic_client_ack', 4, True)]
+
+        # Acks above a message which is still being handled are sent one by one after the linger time
+        channel.calls = []
+        await acks.ack(6)
+        await acks.nack(7)
+        await acks.ack(8)
+        assert channel.calls == [('basic_client_nack', 7, False, True)]
+        await asyncio.sleep(0.05)
+        assert channel.calls[1:] == [('basic_client_ack', 6, False), ('basic_client_ack', 8, False)]
+
+        channel.calls = []
+        await acks.ack(5)
+        await acks.ack(9)
+        await acks.flush()
+        assert channel.calls == [('basic_client_ack', 9, True)]
+
+        # Deliveries the coalescer was never told about won't hold back the multiple ack
+        channel.calls = []
+        acks.received(12)
+        acks.received(13)
+        await acks.ack(13)
+        await acks.flush()
+        assert channel.calls == [('basic_client_ack', 13, False)]
+
+        # Deliveries whose handler finished without settling them are acked after the linger time
+        channel.calls = []
+        acks.release(12)
+        acks.release(12)
+        await asyncio.sleep(0.05)
+        assert channel.calls == [('basic_client_ack', 12, True)]
+
+        # Collected acks are dropped when the channel is closed, since the messages are redelivered
+        channel.calls = []
+        acks.received(14)
+        await acks.ack(14)
+        channel.connection_closed()
+        await acks.flush()
+        assert channel.calls == [('connection_closed',)]
+        assert acks.timer is None
+
+    loop.run_until_complete(_async())
+
+
+def test_channel_layout(monkeypatch: Any, loop: Any) -> None:
+    async def func(self: Any, data: Any) -> None:
+        pass
+
+    protocol = start_fake_consumer(monkeypatch, loop, func, {'options': {'amqp': {'publish_channels': 2, 'publisher_confirms': False}}})
+    publish_channels = protocol.channels[:2]
+    consumer_channel = protocol.channels[2]
+    assert len(protocol.channels) == 3
+    assert [call[0] for call in consumer_channel.calls] == ['queue_declare', 'queue_bind', 'basic_qos', 'basic_consume']
+
+    async def _async() -> None:
+        service = FakeService()
+        setattr(service, 'context', {'options': {'amqp': {'publisher_confirms': False}}})
+        for i in range(4):
+            await AmqpTransport.publish(service, str(i), 'test.topic', wait=False)
+        await asyncio.sleep(0.01)
+
+        # Closing a consumer channel only reopens that channel
+        consumer_channel.connection_closed()
+        await asyncio.sleep(1.1)
+
+    loop.run_until_complete(_async())
+
+    assert [call[1] for call in publish_channels[0].calls if call[0] == 'basic_publish'] == [b'0', b'2']
+    assert [call[1] for call in publish_channels[1].calls if call[0] == 'basic_publish'] == [b'1', b'3']
+    assert len(protocol.channels) == 4
+    assert [call[0] for call in protocol.channels[3].calls] == ['queue_declare', 'queue_bind', 'basic_qos', 'basic_consume']
+
+
+def test_connection_recovery(monkeypatch: Any, loop: Any, caplog: Any) -> None:
+    async def func(self: Any, data: Any) -> None:
+        pass
+
+    options = {'amqp': {'publish_channels': 1, 'publisher_confirms': False, 'reconnect_min_backoff': 0.05, 'exchange_name': 'test-exchange', 'publish_buffer_size': 2}}
+    protocol = start_fake_consumer(monkeypatch, loop, func, {'options': options})
+    assert [call[0] for call in protocol.channels[1].calls] == ['exchange_declare', 'queue_declare', 'queue_bind', 'basic_qos', 'basic_consume']
+
+    async def _async() -> None:
+        service = FakeService()
+        setattr(service, 'context', {'options': options})
+
+        protocol.connection_lost()
+        await asyncio.sleep(0)
+        assert AmqpTransport.reconnect_waiter and not AmqpTransport.reconnect_waiter.done()
+
+        # Publishes made while reconnecting are buffered, up to publish_buffer_size
+        futures = [asyncio.ensure_future(AmqpTransport.publish(service, str(i), 'test.topic')) for i in range(3)]
+        await asyncio.sleep(0)
+        assert futures[2].done()
+        with pytest.raises(AmqpException):
+            futures[2].result()
+
+        # Publishes which aren't awaited have their failures logged
+        await AmqpTransport.publish(service, 'x', 'test.topic', wait=False)
+        await asyncio.sleep(0.01)
+        assert 'Unable to publish message [amqp] (Publish buffer is full while reconnecting)' in caplog.text
+
+        await asyncio.wait(futures[:2], timeout=5)
+        assert [future.result() for future in futures[:2]] == [None, None]
+
+    loop.run_until_complete(_async())
+
+    new_protocol = AmqpTransport.protocol
+    assert new_protocol is not protocol
+    assert [call[1] for call in new_protocol.channels[0].calls if call[0] == 'basic_publish'] == [b'0', b'1']
+    assert [call[0] for call in new_protocol.channels[1].calls] == ['exchange_declare', 'queue_declare', 'queue_bind', 'basic_qos', 'basic_consume']
+    assert len(protocol.channels) == 2
+
+
+def test_binary_payloads(monkeypatch: Any, loop: Any) -> None:
+    class BinaryProtocol(object):
+        binary = True
+
+        @classmethod
+        async def build_message(cls, service: Any, topic: str, data: Any) -> bytes:
+            return bytes(data)
+
+        @classmethod
+        async def parse_message(cls, payload: Any) -> Any:
+            return {'data': payload}, None, None
+
+    handled = []  # type: List
+
+    async def func(self: Any, data: Any) -> None:
+        handled.append(data)
+
+    options = {'amqp': {'publish_channels': 1, 'publisher_confirms': False}}
+    protocol = start_fake_consumer(monkeypatch, loop, func, {'options': options, 'message_protocol': BinaryProtocol})
+    channel = protocol.channels[-1]
+    callback = list(channel.consumers.values())[0]
+
+    async def _async() -> None:
+        service = FakeService()
+        setattr(service, 'context', {'options': options})
+        setattr(service, 'message_protocol', BinaryProtocol)
+        await AmqpTransport.publish(service, b'\x00\xff', 'test.topic')
+
+        await callback(channel, b'\x00\xff', FakeEnvelope(1), None)
+        await asyncio.wait(list(AmqpTransport.handler_tasks))
+
+    loop.run_until_complete(_async())
+
+    assert [call[1] for call in protocol.channels[0].calls if call[0] == 'basic_publish'] == [b'\x00\xff']
+    assert handled == [b'\x00\xff']
+
+
+def test_retry_queues(monkeypatch: Any, loop: Any) -> None:
+    class FakeProperties(object):
+        def __init__(self, headers: Dict, **kwargs: Any) -> None:
+            self.headers = headers
+            self.reply_to = kwargs.get('reply_to')
+            self.correlation_id = kwargs.get('correlation_id')
+            self.expiration = kwargs.get('expiration')
+
+    async def func(self: Any, data: Any) -> None:
+        raise AmqpInternalServiceError('failed')
+
+    assert AmqpTransport.get_retry_delays(None, None, {}) == []
+    assert AmqpTransport.get_retry_delays(None, 3, {}) == [0]
+    assert AmqpTransport.get_retry_delays(10, None, {'options': {'amqp': {'max_retry_backoff': 60}}}) == [10, 20, 40, 60]
+
+    # Queues without max_retries or dead_letter_exchange_name keep their arguments, so existing queues can still be declared
+    protocol = start_fake_consumer(monkeypatch, loop, func, {}, retry_backoff=1)
+    assert 'x-dead-letter-exchange' not in [call[2] for call in protocol.channels[-1].calls if call[0] == 'queue_declare'][-1]
+
+    options = {'amqp': {'publish_channels': 1, 'publisher_confirms': False}}
+    protocol = start_fake_consumer(monkeypatch, loop, func, {'options': options}, retry_backoff=1, max_retries=3)
+    channel = protocol.channels[-1]
+    queue_name = [call[1] for call in channel.calls if call[0] == 'queue_declare'][-1]
+    assert ('exchange_declare', '{}.dlx'.format(queue_name)) in channel.calls
+    assert [call[1] for call in channel.calls if call[0] == 'queue_declare'] == [
+        '{}.dlq'.format(queue_name), '{}.retry.1'.format(queue_name), '{}.retry.2'.format(queue_name), '{}.retry.4'.format(queue_name), queue_name
+    ]
+    assert [call[2] for call in channel.calls if call[0] == 'queue_declare'][-1]['x-dead-letter-exchange'] == '{}.dlx'.format(queue_name)
+    assert [call[2] for call in channel.calls if call[0] == 'queue_declare'][-1]['x-dead-letter-routing-key'] == queue_name
+    assert [call[2] for call in channel.calls if call[0] == 'queue_declare'][2]['x-message-ttl'] == 2000
+
+    # The dead-letter queue of a non-competing consumer expires like the queue itself, and only receives the messages
+    # dead-lettered with the name of its own queue
+    assert [call[2] for call in channel.calls if call[0] == 'queue_declare'][0] == {'x-expires': 86400000}
+    assert ('queue_bind', '{}.dlq'.format(queue_name), '{}.dlx'.format(queue_name), queue_name) in channel.calls
+    callback = list(channel.consumers.values())[0]
+
+    async def _async() -> None:
+        # Failed messages are published to a delay queue with an increased retry count, and dead-lettered after the last retry
+        await callback(channel, b'data', FakeEnvelope(1), None)
+        await callback(channel, b'data', FakeEnvelope(2), FakeProperties({'x-retry-count': 1, 'x-shard-key': '42'}, reply_to='reply', correlation_id='id', expiration='1000'))
+        await callback(channel, b'data', FakeEnvelope(3), FakeProperties({'x-retry-count': 3}))
+        await asyncio.wait(list(AmqpTransport.handler_tasks))
+        await asyncio.sleep(0.05)
+
+    loop.run_until_complete(_async())
+
+    # Copies are published on a publish channel rather than on the channel of the consumer
+    assert [call for call in channel.calls if call[0] == 'basic_publish'] == []
+    assert [call[1:] for call in protocol.channels[0].calls if call[0] == 'basic_publish'] == [
+        (b'data', '', '{}.retry.1'.format(queue_name), {'headers': {'x-retry-count': 1}, 'delivery_mode': 2}),
+        (b'data', '', '{}.retry.2'.format(queue_name), {'headers': {'x-retry-count': 2, 'x-shard-key': '42'}, 'reply_to': 'reply', 'correlation_id': 'id', 'delivery_mode': 2})
+    ]
+    assert ('basic_client_nack', 3, False, False) in channel.calls
+    assert ('basic_client_ack', 2, True) in channel.calls
+
+    # With publisher confirms the message is acked once the copy has been confirmed, and requeued if it was rejected
+    options = {'amqp': {'publish_channels': 1, 'publisher_confirms': True, 'ack_linger_time': 0}}
+    protocol = start_fake_consumer(monkeypatch, loop, func, {'options': options}, retry_backoff=1, max_retries=3, queue_name='test-queue')
+    channel = protocol.channels[-1]
+    assert [call[2] for call in channel.calls if call[0] == 'queue_declare'][0] == {}
+    callback = list(channel.consumers.values())[0]
+
+    async def _async_confirms() -> None:
+        await callback(channel, b'data', FakeEnvelope(1), None)
+        await callback(channel, b'data', FakeEnvelope(2), None)
+        await asyncio.sleep(0.05)
+        assert len([call for call in protocol.channels[0].calls if call[0] == 'basic_publish']) == 2
+        assert [call for call in channel.calls if call[0] in ('basic_client_ack', 'basic_client_nack')] == []
+
+        await protocol.channels[0].basic_server_ack(FakeFrame(1, False))
+        await protocol.channels[0].basic_server_nack(FakeFrame(2, False))
+        await asyncio.wait(list(AmqpTransport.handler_tasks))
+        await asyncio.sleep(0.05)
+        assert sorted([call for call in channel.calls if call[0] in ('basic_client_ack', 'basic_client_nack')], key=lambda call: call[1]) == [
+            ('basic_client_ack', 1, True), ('basic_client_nack', 2, False, True)
+        ]
+
+    loop.run_until_complete(_async_confirms())
+
+
+def test_sharded_consumers(monkeypatch: Any, loop: Any) -> None:
+    async def func(self: Any, data: Any) -> None:
+        pass
+
+    options = {'amqp': {'publish_channels': 1, 'publisher_confirms': False, 'shard_instances': 2, 'shard_instance': 1}}
+    protocol = start_fake_consumer(monkeypatch, loop, func, {'options': options}, shards=4, shard_key='user_id', queue_name='users')
+
+    # The instance consumes every other shard, each on a channel of its own
+    consumer_channels = protocol.channels[1:]
+    assert len(consumer_channels) == 2
+    assert [channel.calls[1] for channel in consumer_channels] == [('exchange_bind', 'users.shards', 'amq.topic', 'test.topic')] * 2
+    assert [list(channel.consumers.keys()) for channel in consumer_channels] == [['users.shard.1'], ['users.shard.3']]
+    assert ('queue_bind', 'users.shard.1', 'users.shards', '1') in consumer_channels[0].calls
+    assert [call[2] for call in consumer_channels[0].calls if call[0] == 'queue_declare'][0]['x-single-active-consumer'] is True
+    assert [call for call in consumer_channels[0].calls if call[0] == 'basic_qos'] == [('basic_qos', 0, 1)]
+
+    async def _async() -> None:
+        service = FakeService()
+        setattr(service, 'context', {'options': options})
+        setattr(service, 'message_protocol', JsonBase)
+        await AmqpTransport.publish(service, {'user_id': 42}, 'test.topic')
+
+        # Messages without a value for the shard key are refused rather than all hashed to the same shard
+        with pytest.raises(AmqpException):
+            await AmqpTransport.publish(service, {'name': 'test'}, 'test.topic')
+
+        # Publishers without a sharded subscription of their own take the shard key from the options
+        setattr(service, 'context', {'options': {'amqp': dict(options, shard_keys={'test.other': 'order_id'})}})
+        await AmqpTransport.publish(service, {'order_id': 'abc'}, 'test.other')
+
+    loop.run_until_complete(_async())
+
+    assert [call[4] for call in protocol.channels[0].calls if call[0] == 'basic_publish'] == [{'headers': {'x-shard-key': '42'}}, {'headers': {'x-shard-key': 'abc'}}]
+
+
+@pytest.mark.parametrize('message_protocol', [None, JsonBase])
+def test_rpc(monkeypatch: Any, loop: Any, message_protocol: Any) -> None:
+    class FakeProperties(object):
+        def __init__(self, **kwargs: Any) -> None:
+            self.headers = kwargs.get('headers')
+            self.reply_to = kwargs.get('reply_to')
+            self.correlation_id = kwargs.get('correlation_id')
+
+    async def func(self: Any, data: Any) -> Any:
+        if data == 'error':
+            raise Exception('failed')
+        if data == 'none':
+            return None
+        return data.upper()
+
+    options = {'amqp': {'publish_channels': 1, 'publisher_confirms': False}}
+    context = {'options': options, 'message_protocol': message_protocol}  # type: Dict
+
+    async def subscribe() -> None:
+        _subscribe = await AmqpTransport.subscribe_rpc_handler(AmqpTransport, FakeService(), context, func, 'test.rpc', max_concurrency=5)
+        await _subscribe()
+
+    protocol = FakeProtocol()
+
+    async def connect(**kwargs: Any) -> Any:
+        return FakeTransport(), protocol
+
+    monkeypatch.setattr(aioamqp, 'connect', connect)
+    monkeypatch.setattr(AmqpTransport, 'channel', None)
+    monkeypatch.setattr(AmqpTransport, 'rpc_channel', None)
+    loop.run_until_complete(subscribe())
+
+    publish_channel, consumer_channel = protocol.channels
+    assert ('basic_qos', 0, 5) in consumer_channel.calls
+    server_callback = list(consumer_channel.consumers.values())[0]
+
+    async def _async() -> None:
+        service = FakeService()
+        setattr(service, 'context', context)
+        setattr(service, 'message_protocol', message_protocol)
+
+        async def call(data: str, timeout: float = 1) -> Any:
+            call = asyncio.ensure_future(AmqpTransport.rpc(service, 'test.rpc', data, timeout=timeout))
+            await asyncio.sleep(0.01)
+            rpc_channel = AmqpTransport.rpc_channel
+            request = rpc_channel.calls[-1]
+            assert request[0] == 'basic_publish' and request[3] == 'test.rpc'
+            assert request[4]['reply_to'] == 'amq.rabbitmq.reply-to'
+
+            # The request is handled by the consumer and the reply is routed back to the calling channel
+            await server_callback(consumer_channel, request[1], FakeEnvelope(1), FakeProperties(**request[4]))
+            await asyncio.sleep(0.01)
+            reply = publish_channel.calls[-1]
+            assert reply[2:4] == ('', 'amq.rabbitmq.reply-to')
+            await rpc_channel.consumers['amq.rabbitmq.reply-to'](rpc_channel, reply[1], None, FakeProperties(**reply[4]))
+            return await call
+
+        assert await call('data') == 'DATA'
+        with pytest.raises(AmqpRpcError):
+            await call('error')
+
+        # None is replied as null, which the message protocol decodes back to None
+        assert await call('none') == (None if message_protocol else 'null')
+        with pytest.raises(AmqpRpcTimeout):
+            await AmqpTransport.rpc(service, 'test.rpc', 'data', timeout=0.01)
+        assert AmqpTransport.rpc_futures == {}
+
+    loop.run_until_complete(_async())
+
+
+def test_every_delivery_is_settled(monkeypatch: Any, loop: Any) -> None:
+    class DuplicateProtocol(object):
+        @classmethod
+        async def parse_message(cls, payload: Any) -> Any:
+            if payload == 'incompatible':
+                return False, 'uuid-incompatible', None
+            return {'data': payload}, 'uuid-{}'.format(payload), None
+
+    handled = []  # type: List
+
+    async def func(self: Any, data: Any) -> None:
+        handled.append(data)
+
+    protocol = start_fake_consumer(monkeypatch, loop, func, {'options': {'amqp': {'ack_batch_size': 0}}, 'message_protocol': DuplicateProtocol}, prefetch_count=2)
+    channel = protocol.channels[-1]
+    callback = list(channel.consumers.values())[0]
+
+    async def _async() -> None:
+        # Duplicates and messages of an incompatible protocol must not hold on to a slot in the prefetch window
+        for delivery_tag, payload in enumerate(['a', 'a', 'a', 'incompatible', 'b'], 1):
+            await callback(channel, payload.encode(), FakeEnvelope(delivery_tag), None)
+        await asyncio.wait(list(AmqpTransport.handler_tasks))
+
+    loop.run_until_complete(_async())
+
+    assert handled == ['a', 'b']
+    assert sorted([call[1] for call in channel.calls if call[0] == 'basic_client_ack']) == [1, 2, 3, 5]
+    assert ('basic_client_nack', 4, False, False) in channel.calls
+
+
+def test_publish_channel_error(monkeypatch: Any, loop: Any) -> None:
+    async def func(self: Any, data: Any) -> None:
+        pass
+
+    options = {'amqp': {'publish_channels': 2, 'publish_max_attempts': 3, 'publish_retry_backoff': 0.01}}
+    protocol = start_fake_consumer(monkeypatch, loop, func, {'options': options})
+
+    async def _async() -> None:
+        service = FakeService()
+        setattr(service, 'context', {'options': options})
+
+        # Channel errors from the broker, such as a missing exchange, aren't retried
+        for channel in protocol.channels[:2]:
+            channel.close_on_publish = (404, 'NOT_FOUND')
+        with pytest.raises(AmqpChannelError):
+            await AmqpTransport.publish(service, 'data', 'test.topic', exchange_name='missing')
+        assert len([call for channel in protocol.channels for call in channel.calls if call[0] == 'basic_publish']) == 1
+
+        with pytest.raises(AmqpException):
+            await AmqpTransport.publish(service, '', 'test.topic')
+
+    loop.run_until_complete(_async())
+
+
+def test_publish_on_closing_channels(monkeypatch: Any, loop: Any) -> None:
+    async def func(self: Any, data: Any) -> None:
+        pass
+
+    options = {'amqp': {'publish_channels': 2, 'publish_max_attempts': 3, 'publish_retry_backoff': 0.01}}
+    protocol = start_fake_consumer(monkeypatch, loop, func, {'options': options})
+
+    async def _async() -> None:
+        service = FakeService()
+        setattr(service, 'context', {'options': options})
+
+        # Pooled channels which keep closing are reopened once for every publish waiting on them, and every publish
+        # gives up after publish_max_attempts
+        protocol.close_on_publish = (None, None, Exception('closed'))
+        for channel in protocol.channels[:2]:
+            channel.close_on_publish = protocol.close_on_publish
+        channel_count = len(protocol.channels)
+        results = await asyncio.gather(*[AmqpTransport.publish(service, str(i), 'test.topic') for i in range(20)], return_exceptions=True)
+        assert all([isinstance(result, AmqpChannelClosed) for result in results])
+        # Without sharing the reopen, each of the 40 retries would have opened a channel of its own
+        assert len(protocol.channels) - channel_count < 40
+        assert len([call for channel in protocol.channels for call in channel.calls if call[0] == 'basic_publish']) <= 60
+        assert AmqpTransport.reopen_publish_channel_tasks == {}
+
+    loop.run_until_complete(_async())
@@ -0,0 +1,29 @@
+import asyncio
+import time
+from typing import Any
+from run_test_service_helper import start_service
+
+
+def test_start_aws_sns_sqs_service_memory_backend(monkeypatch: Any, capsys: Any, loop: Any) -> None:
+    services, future = start_service('tests/services/aws_sns_sqs_service_memory_backend.py', monkeypatch)
+
+    assert services is not None
+    assert len(services) == 1
+    instance = services.get('test_aws_sns_sqs_memory_backend')
+    assert instance is not None
+
+    async def _async(loop: Any) -> None:
+        loop_until = time.time() + 10
+        while loop_until > time.time():
+            if instance.closer.done():
+                break
+            await asyncio.sleep(0.1)
+
+        assert instance.test_topic_data_received
+        assert instance.test_topic_metadata_topic == 'test-topic'
+        assert instance.test_filtered_topic_data == 'created'
+        assert sorted(instance.test_queue_data) == list(range(25))
+
+    loop.run_until_complete(_async(loop))
+    instance.stop_service()
+    loop.run_until_complete(future)
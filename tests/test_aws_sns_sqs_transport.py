@@ -1,8 +1,13 @@
+import asyncio
 import os
 import signal
+import time
 import pytest
-from typing import Any
+import ujson
+import botocore
+from typing import Any, Dict, List, Optional, Tuple
 from tomodachi.transport.aws_sns_sqs import AWSSNSSQSTransport, AWSSNSSQSException
+from tomodachi.transport.aws_sns_sqs_memory import AWSSNSSQSMemoryBackend
 from run_test_service_helper import start_service
 
 
@@ -51,6 +56,113 @@ def test_queue_name(monkeypatch: Any) -> None:
     assert queue_name == 'prefix-c6fb053c1b70aabd10bfefd087166b532b7c79ed12d24f2d43a9999c724797fd'
 
 
+def test_dead_letter_queue_name(monkeypatch: Any) -> None:
+    queue_name = AWSSNSSQSTransport.get_dead_letter_queue_name('prefix-queue', None, {'options': {'aws_sns_sqs': {'queue_name_prefix': 'prefix-'}}})
+    assert queue_name == 'prefix-queue-dlq'
+
+    queue_name = AWSSNSSQSTransport.get_dead_letter_queue_name('prefix-queue', 'failed-messages', {'options': {'aws_sns_sqs': {'queue_name_prefix': 'prefix-'}}})
+    assert queue_name == 'prefix-failed-messages'
+
+
+def test_retry_backoff(monkeypatch: Any) -> None:
+    assert AWSSNSSQSTransport.get_retry_backoff(1, 10, {}) == 10
+    assert AWSSNSSQSTransport.get_retry_backoff(2, 10, {}) == 20
+    assert AWSSNSSQSTransport.get_retry_backoff(4, 10, {}) == 80
+    assert AWSSNSSQSTransport.get_retry_backoff(20, 10, {}) == 900
+    assert AWSSNSSQSTransport.get_retry_backoff(20, 10, {'options': {'aws_sns_sqs': {'max_retry_backoff': 60}}}) == 60
+
+
+def test_topic_cache(monkeypatch: Any, tmpdir: Any, loop: Any) -> None:
+    context = {'options': {'aws_sns_sqs': {'topic_prefix': 'prefix-', 'topic_cache_file': str(tmpdir.join('topics.json'))}}}
+    tmpdir.join('topics.json').write('{"other-prefix-topic": "arn:aws:sns:eu-west-1:123456789012:other-prefix-topic"}')
+    monkeypatch.setattr(AWSSNSSQSTransport, 'topics', {'test-topic': 'arn:aws:sns:eu-west-1:123456789012:prefix-test-topic'})
+    monkeypatch.setattr(AWSSNSSQSTransport, 'topic_cache_loaded', False)
+    monkeypatch.setattr(AWSSNSSQSTransport, 'topic_cache_task', None)
+
+    async def _async() -> None:
+        # Topics stored while a write is in progress are batched into a single write once it's done
+        task = AWSSNSSQSTransport.store_topic_cache(AWSSNSSQSTransport, context)
+        AWSSNSSQSTransport.topics['test-topic-2'] = 'arn:aws:sns:eu-west-1:123456789012:prefix-test-topic-2'
+        assert AWSSNSSQSTransport.store_topic_cache(AWSSNSSQSTransport, context) is task
+        await task
+
+    loop.run_until_complete(_async())
+    assert ujson.loads(tmpdir.join('topics.json').read()) == {
+        'other-prefix-topic': 'arn:aws:sns:eu-west-1:123456789012:other-prefix-topic',
+        'prefix-test-topic': 'arn:aws:sns:eu-west-1:123456789012:prefix-test-topic',
+        'prefix-test-topic-2': 'arn:aws:sns:eu-west-1:123456789012:prefix-test-topic-2'
+    }
+    assert not tmpdir.join('topics.json.tmp').exists()
+
+    AWSSNSSQSTransport.topics = {}
+    AWSSNSSQSTransport.load_topic_cache(AWSSNSSQSTransport, context)
+    assert AWSSNSSQSTransport.topics == {
+        'test-topic': 'arn:aws:sns:eu-west-1:123456789012:prefix-test-topic',
+        'test-topic-2': 'arn:aws:sns:eu-west-1:123456789012:prefix-test-topic-2'
+    }
+
+    AWSSNSSQSTransport.invalidate_topic_cache(AWSSNSSQSTransport, context)
+    assert AWSSNSSQSTransport.topics == {}
+    assert not tmpdir.join('topics.json').exists()
+
+
+def test_publish_to_deleted_topic(monkeypatch: Any, loop: Any) -> None:
+    backend = AWSSNSSQSMemoryBackend()
+    sns = backend.create_client('sns')
+    sqs = backend.create_client('sqs')
+
+    class Service(object):
+        context = {'options': {'aws_sns_sqs': {'backend': backend}}}
+
+    monkeypatch.setattr(AWSSNSSQSTransport, 'clients', {'sns': sns, 'sqs': sqs})
+    monkeypatch.setattr(AWSSNSSQSTransport, 'topics', {})
+    monkeypatch.setattr(AWSSNSSQSTransport, 'topic_cache_loaded', True)
+
+    async def _async() -> None:
+        await AWSSNSSQSTransport.publish(Service(), 'data', 'test-topic')
+        topic_arn = AWSSNSSQSTransport.topics.get('test-topic')
+        assert topic_arn in backend.topics
+
+        # A topic deleted after its ARN was cached is created again, rather than failing every publish
+        del backend.topics[topic_arn]
+        await AWSSNSSQSTransport.publish(Service(), 'data', 'test-topic')
+        assert topic_arn in backend.topics
+
+    loop.run_until_complete(_async())
+
+
+def test_queue_policy(monkeypatch: Any) -> None:
+    queue_arn = 'arn:aws:sqs:eu-west-1:123456789012:queue'
+    topic_arn = 'arn:aws:sns:eu-west-1:123456789012:test-topic'
+    queue_policy = AWSSNSSQSTransport.generate_queue_policy(queue_arn, [topic_arn], {})
+    assert queue_policy == AWSSNSSQSTransport.generate_queue_policy(queue_arn, [topic_arn], {})
+    assert queue_policy.get('Statement')[0].get('Condition').get('ArnEquals').get('aws:SourceArn') == topic_arn
+
+    queue_policy = AWSSNSSQSTransport.generate_queue_policy(queue_arn, [topic_arn + '-1', topic_arn + '-2'], {})
+    assert queue_policy.get('Statement')[0].get('Condition').get('ArnEquals').get('aws:SourceArn') == topic_arn + '-*'
+
+
+def test_changed_queue_attributes(monkeypatch: Any) -> None:
+    current_attributes = {
+        'Policy': '{"Version": "2012-10-17", "Id": "policy"}',
+        'VisibilityTimeout': '30',
+        'RedrivePolicy': '{"deadLetterTargetArn": "arn:aws:sqs:eu-west-1:123456789012:queue-dlq", "maxReceiveCount": 5}'
+    }
+
+    attributes = AWSSNSSQSTransport.get_changed_queue_attributes(current_attributes, {
+        'Policy': '{"Id": "policy", "Version": "2012-10-17"}',
+        'VisibilityTimeout': '30',
+        'RedrivePolicy': '{"deadLetterTargetArn": "arn:aws:sqs:eu-west-1:123456789012:queue-dlq", "maxReceiveCount": "5"}'
+    })
+    assert attributes == {}
+
+    attributes = AWSSNSSQSTransport.get_changed_queue_attributes(current_attributes, {'Policy': '{"Version": "2012-10-17", "Id": "policy"}', 'VisibilityTimeout': '60'})
+    assert attributes == {'VisibilityTimeout': '60'}
+
+    attributes = AWSSNSSQSTransport.get_changed_queue_attributes({}, {'Policy': '{"Version": "2012-10-17", "Id": "policy"}'})
+    assert attributes == {'Policy': '{"Version": "2012-10-17", "Id": "policy"}'}
+
+
 def test_publish_invalid_credentials(monkeypatch: Any, capsys: Any, loop: Any) -> None:
     services, future = start_service('tests/services/dummy_service.py', monkeypatch)
 
@@ -68,3 +180,727 @@ def test_publish_invalid_credentials(monkeypatch: Any, capsys: Any, loop: Any) -
     out, err = capsys.readouterr()
     assert 'The security token included in the request is invalid' in err
     assert out == ''
+
+
+def test_wildcard_topic_catalog(monkeypatch: Any, loop: Any) -> None:
+    topic_names = ['test-topic', 'test-topic.a', 'test-topic.a.b', 'test-topic-2', 'other-topic.a', 'test-topic.b']
+
+    class Client(object):
+        async def list_topics(self, NextToken: Any = None) -> Dict:
+            index = int(NextToken or 0)
+            next_index = index + 2
+            response = {'Topics': [{'TopicArn': 'arn:aws:sns:eu-west-1:123456789012:{}'.format(AWSSNSSQSTransport.encode_topic(name))} for name in topic_names[index:next_index]]}  # type: Dict
+            if next_index < len(topic_names):
+                response['NextToken'] = str(next_index)
+            return response
+
+    monkeypatch.setattr(AWSSNSSQSTransport, 'clients', {'sns': Client()})
+    monkeypatch.setattr(AWSSNSSQSTransport, 'topic_catalog', None)
+    monkeypatch.setattr(AWSSNSSQSTransport, 'topic_catalog_names', None)
+
+    loop.run_until_complete(AWSSNSSQSTransport.refresh_topic_catalog(AWSSNSSQSTransport, {}))
+    assert len(AWSSNSSQSTransport.topic_catalog) == len(topic_names)
+
+    def get_topics(topic: str) -> List:
+        return sorted([AWSSNSSQSTransport.decode_topic(topic_arn.rsplit(':', 1)[-1]) for topic_arn in AWSSNSSQSTransport.get_wildcard_topic_arns(AWSSNSSQSTransport, topic, {})])
+
+    assert get_topics('test-topic.*') == ['test-topic.a', 'test-topic.b']
+    assert get_topics('test-topic.#') == ['test-topic.a', 'test-topic.a.b', 'test-topic.b']
+    assert get_topics('*.a') == ['other-topic.a', 'test-topic.a']
+    assert get_topics('nonexistent.*') == []
+
+
+def test_decode_message_body(monkeypatch: Any) -> None:
+    payload = '{"service":{"name":"test"},"data":"\\"quoted\\" \\\\ data"}'
+    envelope = '{\n  "Type" : "Notification",\n  "MessageId" : "id",\n  "TopicArn" : "arn:aws:sns:eu-west-1:123456789012:test-topic",\n  "Subject" : "\\"Message\\"",\n  "Message" : ' + \
+        ujson.dumps(payload) + ',\n  "Timestamp" : "2018-08-24T12:00:00.000Z",\n  "SignatureVersion" : "1"\n}'
+
+    assert AWSSNSSQSTransport.decode_message_body(envelope) == payload
+    assert AWSSNSSQSTransport.decode_message_body(envelope, raw_message_delivery=True) == payload
+    assert AWSSNSSQSTransport.decode_message_body(payload, raw_message_delivery=True) == payload
+    assert AWSSNSSQSTransport.decode_message_body('{"Message": "data"}') == 'data'
+    assert AWSSNSSQSTransport.decode_message_body(payload) is None
+    assert AWSSNSSQSTransport.decode_message_body('') is None
+
+    with pytest.raises(ValueError):
+        AWSSNSSQSTransport.decode_message_body('malformed')
+
+
+def test_message_attributes(monkeypatch: Any) -> None:
+    message_attributes = AWSSNSSQSTransport.get_message_attributes({
+        'event': 'created',
+        'priority': 5,
+        'urgent': True,
+        'tags': ['a', 'b'],
+        'missing': None
+    })
+    assert message_attributes == {
+        'event': {'DataType': 'String', 'StringValue': 'created'},
+        'priority': {'DataType': 'Number', 'StringValue': '5'},
+        'urgent': {'DataType': 'String', 'StringValue': 'true'},
+        'tags': {'DataType': 'String.Array', 'StringValue': '["a","b"]'}
+    }
+
+    assert AWSSNSSQSTransport.get_filter_policy(None) is None
+    assert AWSSNSSQSTransport.get_filter_policy('{"event": ["created"]}') == '{"event": ["created"]}'
+    assert ujson.loads(AWSSNSSQSTransport.get_filter_policy({'event': ['created'], 'priority': [{'numeric': ['>', 3]}]})) == {'event': ['created'], 'priority': [{'numeric': ['>', 3]}]}
+
+
+def test_claim_check(tmpdir: Any, monkeypatch: Any, loop: Any) -> None:
+    monkeypatch.setattr(AWSSNSSQSTransport, 'blob_cache', None)
+    context = {'options': {'aws_sns_sqs': {'claim_check_store': 'file', 'claim_check_path': str(tmpdir), 'claim_check_threshold': 100}}}
+
+    async def _async() -> None:
+        assert await AWSSNSSQSTransport.store_payload(AWSSNSSQSTransport, 'small payload', context) == 'small payload'
+
+        payload = 'x' * 1000
+        reference = await AWSSNSSQSTransport.store_payload(AWSSNSSQSTransport, payload, context)
+        assert len(reference) < 200
+        claim_check = AWSSNSSQSTransport.get_claim_check(reference)
+        assert claim_check and claim_check.get('store') == 'file'
+
+        monkeypatch.setattr(AWSSNSSQSTransport, 'blob_cache', None)
+        assert await AWSSNSSQSTransport.fetch_payload(AWSSNSSQSTransport, claim_check, context) == payload
+
+        with pytest.raises(AWSSNSSQSException):
+            await AWSSNSSQSTransport.fetch_payload(AWSSNSSQSTransport, claim_check, {})
+
+        # Published payloads which merely look like a reference are handled as they are
+        assert AWSSNSSQSTransport.get_claim_check('small payload') is None
+        assert AWSSNSSQSTransport.get_claim_check('{"claim_check": {"store": "file", "key": "test"}}') is None
+        assert AWSSNSSQSTransport.get_claim_check(reference[:-1] + ', "data": "test"}') is None
+
+    loop.run_until_complete(_async())
+
+
+def test_sqs_send_to_deleted_queue(monkeypatch: Any, loop: Any) -> None:
+    backend = AWSSNSSQSMemoryBackend()
+    sqs = backend.create_client('sqs')
+
+    class Service(object):
+        context = {'options': {'aws_sns_sqs': {'backend': backend}}}
+
+    monkeypatch.setattr(AWSSNSSQSTransport, 'clients', {'sqs': sqs})
+    monkeypatch.setattr(AWSSNSSQSTransport, 'queue_urls', None)
+
+    async def _async() -> None:
+        await AWSSNSSQSTransport.send(Service(), 'data', 'test-queue')
+        queue_url = AWSSNSSQSTransport.queue_urls['test-queue']
+
+        # A queue which is deleted after its url was cached is resolved again, which recreates it
+        await sqs.delete_queue(QueueUrl=queue_url)
+        await AWSSNSSQSTransport.send(Service(), 'data', 'test-queue')
+        assert (await sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['All'])).get('Attributes').get('ApproximateNumberOfMessages') == '1'
+
+        await sqs.delete_queue(QueueUrl=queue_url)
+        await AWSSNSSQSTransport.send_batch(Service(), ['a', 'b'], 'test-queue')
+        assert (await sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['All'])).get('Attributes').get('ApproximateNumberOfMessages') == '2'
+
+    loop.run_until_complete(_async())
+
+
+def test_sqs_send_batch(monkeypatch: Any, loop: Any) -> None:
+    calls = []  # type: List
+
+    class Client(object):
+        async def get_queue_url(self, QueueName: str) -> Dict:
+            calls.append(('get_queue_url', QueueName))
+            return {'QueueUrl': 'https://sqs.eu-west-1.amazonaws.com/123456789012/{}'.format(QueueName)}
+
+        async def send_message_batch(self, QueueUrl: str, Entries: List) -> Dict:
+            calls.append(('send_message_batch', len(Entries)))
+            return {'Successful': [{'Id': entry.get('Id'), 'MessageId': entry.get('Id')} for entry in Entries]}
+
+    class Service(object):
+        context = {'options': {'aws_sns_sqs': {'queue_name_prefix': 'prefix-'}}}
+
+    monkeypatch.setattr(AWSSNSSQSTransport, 'clients', {'sqs': Client()})
+    monkeypatch.setattr(AWSSNSSQSTransport, 'queue_urls', None)
+
+    async def _async() -> None:
+        await AWSSNSSQSTransport.send_batch(Service(), ['data {}'.format(i) for i in range(25)], 'test-queue')
+        await AWSSNSSQSTransport.send_batch(Service(), ['x' * 100000 for _ in range(5)], 'test-queue')
+
+    loop.run_until_complete(_async())
+
+    assert calls == [
+        ('get_queue_url', 'prefix-test-queue'),
+        ('send_message_batch', 10), ('send_message_batch', 10), ('send_message_batch', 5),
+        ('send_message_batch', 2), ('send_message_batch', 2), ('send_message_batch', 1)
+    ]
+
+
+def test_fifo(monkeypatch: Any) -> None:
+    assert AWSSNSSQSTransport.encode_topic('test.topic.fifo') == 'test___2e_topic.fifo'
+    assert AWSSNSSQSTransport.decode_topic(AWSSNSSQSTransport.encode_topic('test.topic.fifo')) == 'test.topic.fifo'
+    assert AWSSNSSQSTransport.get_dead_letter_queue_name('queue.fifo', None, {}) == 'queue-dlq.fifo'
+
+    assert AWSSNSSQSTransport.get_fifo_message_kwargs('test-topic', 'data') == {}
+    fifo_kwargs = AWSSNSSQSTransport.get_fifo_message_kwargs('test-topic.fifo', 'data')
+    assert fifo_kwargs.get('MessageGroupId') == 'test-topic'
+    assert fifo_kwargs.get('MessageDeduplicationId') == AWSSNSSQSTransport.get_fifo_message_kwargs('test-topic.fifo', 'data').get('MessageDeduplicationId')
+    assert fifo_kwargs.get('MessageDeduplicationId') != AWSSNSSQSTransport.get_fifo_message_kwargs('test-topic.fifo', 'other data').get('MessageDeduplicationId')
+    assert AWSSNSSQSTransport.get_fifo_message_kwargs('test-topic.fifo', 'data', 'group', 'id') == {'MessageGroupId': 'group', 'MessageDeduplicationId': 'id'}
+
+
+def test_client_config(monkeypatch: Any) -> None:
+    config = AWSSNSSQSTransport.get_client_config({})
+    assert config.max_pool_connections == 50
+    assert config.retries is None
+
+    config = AWSSNSSQSTransport.get_client_config({'options': {'aws_sns_sqs': {'client_config': {
+        'max_pool_connections': 100,
+        'connect_timeout': 5,
+        'read_timeout': 30,
+        'max_attempts': 3
+    }}}})
+    assert config.max_pool_connections == 100
+    assert config.connect_timeout == 5
+    assert config.read_timeout == 30
+    assert config.retries == {'max_attempts': 3}
+
+
+def test_memory_backend(loop: Any) -> None:
+    backend = AWSSNSSQSMemoryBackend()
+    sns = backend.create_client('sns')
+    sqs = backend.create_client('sqs')
+
+    async def _async() -> None:
+        topic_arn = (await sns.create_topic(Name='test-topic')).get('TopicArn')
+        queue_url = (await sqs.create_queue(QueueName='test-queue')).get('QueueUrl')
+        queue_arn = (await sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['QueueArn'])).get('Attributes').get('QueueArn')
+        dlq_url = (await sqs.create_queue(QueueName='test-queue-dlq')).get('QueueUrl')
+        dlq_arn = (await sqs.get_queue_attributes(QueueUrl=dlq_url, AttributeNames=['QueueArn'])).get('Attributes').get('QueueArn')
+        await sqs.set_queue_attributes(QueueUrl=queue_url, Attributes={'RedrivePolicy': ujson.dumps({'deadLetterTargetArn': dlq_arn, 'maxReceiveCount': '2'})})
+        await sns.subscribe(TopicArn=topic_arn, Protocol='sqs', Endpoint=queue_arn, Attributes={'RawMessageDelivery': 'true', 'FilterPolicy': ujson.dumps({'priority': [{'numeric': ['>', 3]}]})})
+
+        await sns.publish(TopicArn=topic_arn, Message='low', MessageAttributes={'priority': {'DataType': 'Number', 'StringValue': '1'}})
+        await sns.publish(TopicArn=topic_arn, Message='high', MessageAttributes={'priority': {'DataType': 'Number', 'StringValue': '5'}})
+
+        response = await sqs.receive_message(QueueUrl=queue_url, WaitTimeSeconds=0, MaxNumberOfMessages=10, VisibilityTimeout=0)
+        assert [message.get('Body') for message in response.get('Messages')] == ['high']
+        response = await sqs.receive_message(QueueUrl=queue_url, WaitTimeSeconds=0, MaxNumberOfMessages=10, VisibilityTimeout=1)
+        assert response.get('Messages')[0].get('Attributes').get('ApproximateReceiveCount') == '2'
+        assert await sqs.receive_message(QueueUrl=queue_url, WaitTimeSeconds=0) == {}
+
+        # The message is visible again once the visibility timeout expires, and moved to the dead-letter queue
+        # after being received maxReceiveCount times
+        assert await sqs.receive_message(QueueUrl=queue_url, WaitTimeSeconds=2) == {}
+        response = await sqs.receive_message(QueueUrl=dlq_url, WaitTimeSeconds=0)
+        assert response.get('Messages')[0].get('Body') == 'high'
+        assert (await sqs.delete_message_batch(QueueUrl=dlq_url, Entries=[{'Id': '0', 'ReceiptHandle': response.get('Messages')[0].get('ReceiptHandle')}])).get('Successful') == [{'Id': '0'}]
+        assert (await sqs.get_queue_attributes(QueueUrl=dlq_url, AttributeNames=['All'])).get('Attributes').get('ApproximateNumberOfMessages') == '0'
+
+        # Messages of a FIFO queue are received in order within each message group, one batch per group at a time
+        fifo_queue_url = (await sqs.create_queue(QueueName='test-queue.fifo', Attributes={'FifoQueue': 'true'})).get('QueueUrl')
+        for i in range(3):
+            await sqs.send_message(QueueUrl=fifo_queue_url, MessageBody='a{}'.format(i), MessageGroupId='a', MessageDeduplicationId='a{}'.format(i))
+        await sqs.send_message(QueueUrl=fifo_queue_url, MessageBody='a0', MessageGroupId='a', MessageDeduplicationId='a0')
+        await sqs.send_message(QueueUrl=fifo_queue_url, MessageBody='b0', MessageGroupId='b')
+
+        response = await sqs.receive_message(QueueUrl=fifo_queue_url, MaxNumberOfMessages=2)
+        assert [message.get('Body') for message in response.get('Messages')] == ['a0', 'a1']
+        response = await sqs.receive_message(QueueUrl=fifo_queue_url, MaxNumberOfMessages=10)
+        assert [message.get('Body') for message in response.get('Messages')] == ['b0']
+
+        with pytest.raises(botocore.exceptions.ClientError) as e:
+            await sqs.get_queue_url(QueueName='non-existent-queue')
+        assert 'AWS.SimpleQueueService.NonExistentQueue' in str(e.value)
+
+    loop.run_until_complete(_async())
+
+
+class MemoryConsumerService(object):
+    pass
+
+
+def start_memory_consumer(monkeypatch: Any, loop: Any, handler: Any, options: Optional[Dict] = None, queue_attributes: Optional[Dict] = None, **kwargs: Any) -> Tuple[Any, Any, str, Dict]:
+    # Consumes a queue of an in-memory backend of its own, with the handler taking the place of a decorated function
+    backend = AWSSNSSQSMemoryBackend()
+    sqs = backend.create_client('sqs')
+    context = {'options': {'aws_sns_sqs': dict({'backend': backend, 'wait_time_seconds': 1}, **(options or {}))}}
+
+    monkeypatch.setattr(AWSSNSSQSTransport, 'clients', {'sqs': sqs})
+    monkeypatch.setattr(AWSSNSSQSTransport, 'close_waiter', None)
+    monkeypatch.setattr(AWSSNSSQSTransport, 'queue_metrics', {})
+
+    service = MemoryConsumerService()
+
+    async def _async() -> str:
+        queue_url = (await sqs.create_queue(QueueName='test-queue', Attributes=queue_attributes or {})).get('QueueUrl')
+        await AWSSNSSQSTransport.consume_queue(AWSSNSSQSTransport, service, context, handler, queue_url, raw_message_delivery=True, **kwargs)
+        return queue_url
+
+    queue_url = loop.run_until_complete(_async())
+    return service, sqs, queue_url, context
+
+
+def test_consume_queue_slow_message(monkeypatch: Any, loop: Any) -> None:
+    handled = []  # type: List
+
+    async def handler(payload: str, receipt_handle: str, queue_url: str, receive_count: int) -> None:
+        if payload == 'slow':
+            await asyncio.sleep(1)
+        handled.append(payload)
+        await AWSSNSSQSTransport.delete_message(AWSSNSSQSTransport, receipt_handle, queue_url, context)
+
+    service, sqs, queue_url, context = start_memory_consumer(monkeypatch, loop, handler, pollers=1, max_in_flight=5)
+
+    async def _async() -> None:
+        await sqs.send_message_batch(QueueUrl=queue_url, Entries=[{'Id': str(i), 'MessageBody': body} for i, body in enumerate(['slow', 'a', 'b', 'c', 'd'])])
+        await service._started_service()
+        await asyncio.sleep(0.2)
+        assert handled == ['a', 'b', 'c', 'd']
+
+        # In-flight slots are released as soon as each message has been handled, without waiting for the slow
+        # message received in the same batch
+        await sqs.send_message_batch(QueueUrl=queue_url, Entries=[{'Id': str(i), 'MessageBody': body} for i, body in enumerate(['e', 'f', 'g', 'h', 'i', 'j'])])
+        await asyncio.sleep(0.2)
+        assert handled == ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j']
+
+        await asyncio.sleep(1)
+        assert handled[-1] == 'slow'
+        await service._stop_service()
+        assert (await sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['All'])).get('Attributes').get('ApproximateNumberOfMessagesNotVisible') == '0'
+
+    loop.run_until_complete(_async())
+
+
+def test_consume_queue_max_in_flight(monkeypatch: Any, loop: Any) -> None:
+    handled = []  # type: List
+    running = [0, 0]
+
+    async def handler(payload: str, receipt_handle: str, queue_url: str, receive_count: int) -> None:
+        running[0] += 1
+        running[1] = max(running)
+        await asyncio.sleep(0.02)
+        running[0] -= 1
+        handled.append(payload)
+        await AWSSNSSQSTransport.delete_message(AWSSNSSQSTransport, receipt_handle, queue_url, context)
+
+    service, sqs, queue_url, context = start_memory_consumer(monkeypatch, loop, handler, pollers=2, max_in_flight=4)
+
+    async def _async() -> None:
+        for i in range(0, 40, 10):
+            await sqs.send_message_batch(QueueUrl=queue_url, Entries=[{'Id': str(j), 'MessageBody': str(j)} for j in range(i, i + 10)])
+        await service._started_service()
+        for _ in range(50):
+            if len(handled) == 40:
+                break
+            await asyncio.sleep(0.1)
+        await service._stop_service()
+
+    loop.run_until_complete(_async())
+
+    assert sorted(handled, key=int) == [str(i) for i in range(40)]
+    assert running[1] == 4
+
+
+def test_consume_queue_autoscale_pollers(monkeypatch: Any, loop: Any) -> None:
+    receives = [0]
+    samples = []  # type: List[int]
+
+    async def handler(payload: str, receipt_handle: str, queue_url: str, receive_count: int) -> None:
+        await AWSSNSSQSTransport.delete_message(AWSSNSSQSTransport, receipt_handle, queue_url, context)
+
+    options = {'wait_time_seconds': 0, 'poller_autoscale_interval': 0.05}
+    service, sqs, queue_url, context = start_memory_consumer(monkeypatch, loop, handler, options=options, pollers=1, max_pollers=3, max_in_flight=100)
+    receive_message = sqs.receive_message
+
+    async def _receive_message(**kwargs: Any) -> Dict:
+        # Each receive takes a while, as it would over the network, which is what more pollers make up for
+        receives[0] += 1
+        samples.append(receives[0])
+        try:
+            await asyncio.sleep(0.05)
+            return await receive_message(**kwargs)
+        finally:
+            receives[0] -= 1
+
+    sqs.receive_message = _receive_message
+
+    async def _async() -> None:
+        for i in range(0, 500, 10):
+            await sqs.send_message_batch(QueueUrl=queue_url, Entries=[{'Id': str(j), 'MessageBody': str(j)} for j in range(i, i + 10)])
+        await service._started_service()
+
+        # Pollers are added up to max_pollers while there is a backlog, and removed down to pollers once the queue is empty
+        for _ in range(50):
+            attributes = (await sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['All'])).get('Attributes')
+            if attributes.get('ApproximateNumberOfMessages') == '0' and attributes.get('ApproximateNumberOfMessagesNotVisible') == '0':
+                break
+            await asyncio.sleep(0.1)
+        assert max(samples) == 3
+
+        await asyncio.sleep(1)
+        del samples[:]
+        await asyncio.sleep(0.5)
+        assert samples and max(samples) == 1
+        await service._stop_service()
+
+    loop.run_until_complete(_async())
+
+
+def test_consume_queue_stop_without_drain(monkeypatch: Any, loop: Any) -> None:
+    handled = []  # type: List
+    calls = []  # type: List
+
+    async def handler(payload: str, receipt_handle: str, queue_url: str, receive_count: int) -> None:
+        await asyncio.sleep(0.3)
+        handled.append(payload)
+        await AWSSNSSQSTransport.delete_message(AWSSNSSQSTransport, receipt_handle, queue_url, context)
+
+    options = {'wait_time_seconds': 20, 'delete_message_linger_time': 10}
+    service, sqs, queue_url, context = start_memory_consumer(monkeypatch, loop, handler, options=options)
+    delete_message_batch = sqs.delete_message_batch
+    close = sqs.close
+
+    async def _delete_message_batch(**kwargs: Any) -> Dict:
+        calls.append(('delete_message_batch', len(kwargs.get('Entries'))))
+        return await delete_message_batch(**kwargs)
+
+    async def _close() -> None:
+        calls.append(('close',))
+        await close()
+
+    sqs.delete_message_batch = _delete_message_batch
+    sqs.close = _close
+
+    async def _async() -> None:
+        await sqs.send_message(QueueUrl=queue_url, MessageBody='data')
+        await service._started_service()
+        await asyncio.sleep(0.1)
+
+        # The long poll is cancelled right away when stopping, without a message being sent to the queue to end it,
+        # and the in-flight message is handled and deleted before the clients are closed
+        start_time = time.time()
+        await service._stop_service()
+        assert time.time() - start_time < 1.5
+
+        assert handled == ['data']
+        assert calls == [('delete_message_batch', 1), ('close',)]
+        assert (await sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['All'])).get('Attributes').get('ApproximateNumberOfMessagesNotVisible') == '0'
+
+    loop.run_until_complete(_async())
+
+
+def test_consume_queue_delete_buffer(monkeypatch: Any, loop: Any) -> None:
+    calls = []  # type: List
+
+    async def handler(payload: str, receipt_handle: str, queue_url: str, receive_count: int) -> None:
+        await AWSSNSSQSTransport.delete_message(AWSSNSSQSTransport, receipt_handle, queue_url, context)
+
+    service, sqs, queue_url, context = start_memory_consumer(monkeypatch, loop, handler, options={'delete_message_linger_time': 10}, pollers=1, max_in_flight=10)
+    delete_message_batch = sqs.delete_message_batch
+    close = sqs.close
+
+    async def _delete_message_batch(**kwargs: Any) -> Dict:
+        calls.append(('delete_message_batch', len(kwargs.get('Entries'))))
+        return await delete_message_batch(**kwargs)
+
+    async def _close() -> None:
+        calls.append(('close',))
+        await close()
+
+    sqs.delete_message_batch = _delete_message_batch
+    sqs.close = _close
+
+    async def _async() -> None:
+        for i in range(0, 25, 10):
+            await sqs.send_message_batch(QueueUrl=queue_url, Entries=[{'Id': str(j), 'MessageBody': str(j)} for j in range(i, min(i + 10, 25))])
+
+        # Deletes are sent in batches of ten as soon as a batch is full, and the rest are flushed when stopping
+        await service._started_service()
+        await asyncio.sleep(0.2)
+        assert calls == [('delete_message_batch', 10), ('delete_message_batch', 10)]
+        await service._stop_service()
+        assert calls == [('delete_message_batch', 10), ('delete_message_batch', 10), ('delete_message_batch', 5), ('close',)]
+
+    loop.run_until_complete(_async())
+
+
+def test_delete_message_batch_failed_entries(monkeypatch: Any, loop: Any) -> None:
+    backend = AWSSNSSQSMemoryBackend()
+    sqs = backend.create_client('sqs')
+    calls = []  # type: List
+    delete_message_batch = sqs.delete_message_batch
+
+    async def _delete_message_batch(QueueUrl: str, Entries: List[Dict]) -> Dict:
+        # The first attempt to delete the first message fails on the side of AWS
+        calls.append([entry.get('ReceiptHandle') for entry in Entries])
+        if len(calls) == 1:
+            response = await delete_message_batch(QueueUrl=QueueUrl, Entries=Entries[1:])
+            response['Failed'].append({'Id': Entries[0].get('Id'), 'SenderFault': False, 'Code': 'InternalError', 'Message': 'Internal error'})
+            return response
+        return await delete_message_batch(QueueUrl=QueueUrl, Entries=Entries)
+
+    sqs.delete_message_batch = _delete_message_batch
+    monkeypatch.setattr(AWSSNSSQSTransport, 'clients', {'sqs': sqs})
+
+    async def _async() -> None:
+        queue_url = (await sqs.create_queue(QueueName='test-queue')).get('QueueUrl')
+        await sqs.send_message_batch(QueueUrl=queue_url, Entries=[{'Id': str(i), 'MessageBody': str(i)} for i in range(3)])
+        receipt_handles = [message.get('ReceiptHandle') for message in (await sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=3)).get('Messages')]
+
+        # Entries which failed on the side of AWS are retried, while entries with invalid receipt handles are not
+        await AWSSNSSQSTransport.delete_message_batch(AWSSNSSQSTransport, [(receipt_handle, 0) for receipt_handle in receipt_handles + ['invalid']], queue_url, {})
+        assert calls == [receipt_handles + ['invalid'], receipt_handles[:1]]
+        assert (await sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['All'])).get('Attributes').get('ApproximateNumberOfMessagesNotVisible') == '0'
+
+    loop.run_until_complete(_async())
+
+
+def test_delete_message_buffer(monkeypatch: Any, loop: Any) -> None:
+    backend = AWSSNSSQSMemoryBackend()
+    sqs = backend.create_client('sqs')
+    calls = []  # type: List
+    delete_message_batch = sqs.delete_message_batch
+
+    async def _delete_message_batch(QueueUrl: str, Entries: List[Dict]) -> Dict:
+        # The first batch fails with an unexpected error
+        calls.append([entry.get('ReceiptHandle') for entry in Entries])
+        if len(calls) == 1:
+            raise ValueError('Unexpected error')
+        return await delete_message_batch(QueueUrl=QueueUrl, Entries=Entries)
+
+    sqs.delete_message_batch = _delete_message_batch
+    monkeypatch.setattr(AWSSNSSQSTransport, 'clients', {'sqs': sqs})
+
+    async def _async() -> None:
+        queue_url = (await sqs.create_queue(QueueName='test-queue')).get('QueueUrl')
+        await sqs.send_message_batch(QueueUrl=queue_url, Entries=[{'Id': str(i), 'MessageBody': str(i)} for i in range(10)])
+        await sqs.send_message_batch(QueueUrl=queue_url, Entries=[{'Id': str(i), 'MessageBody': str(i)} for i in range(3)])
+        receipt_handles = [message.get('ReceiptHandle') for message in (await sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)).get('Messages')]
+        receipt_handles += [message.get('ReceiptHandle') for message in (await sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)).get('Messages')]
+        assert len(receipt_handles) == 13
+
+        # Each service context lingers according to its own options
+        context = {'options': {'aws_sns_sqs': {'delete_message_linger_time': 0.05}}}
+        other_context = {'options': {'aws_sns_sqs': {'delete_message_linger_time': 60}}}
+        for receipt_handle in receipt_handles[:11]:
+            await AWSSNSSQSTransport.delete_message(AWSSNSSQSTransport, receipt_handle, queue_url, context)
+        await AWSSNSSQSTransport.delete_message(AWSSNSSQSTransport, receipt_handles[11], queue_url, other_context)
+        await asyncio.sleep(0.2)
+
+        # The failing batch is logged and does not keep the rest of the buffer from being deleted
+        assert calls == [receipt_handles[:10], receipt_handles[10:11]]
+        assert (await sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['All'])).get('Attributes').get('ApproximateNumberOfMessagesNotVisible') == '12'
+
+        await AWSSNSSQSTransport.flush_delete_messages(AWSSNSSQSTransport, other_context)
+        assert calls[-1] == receipt_handles[11:12]
+        assert (await sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['All'])).get('Attributes').get('ApproximateNumberOfMessagesNotVisible') == '11'
+
+    loop.run_until_complete(_async())
+
+
+def test_consume_queue_visibility_heartbeat(monkeypatch: Any, loop: Any) -> None:
+    handled = []  # type: List
+    calls = []  # type: List
+
+    async def handler(payload: str, receipt_handle: str, queue_url: str, receive_count: int) -> None:
+        await asyncio.sleep(2.5)
+        handled.append((payload, receive_count))
+        await AWSSNSSQSTransport.delete_message(AWSSNSSQSTransport, receipt_handle, queue_url, context)
+
+    service, sqs, queue_url, context = start_memory_consumer(monkeypatch, loop, handler, queue_attributes={'VisibilityTimeout': '2'}, visibility_timeout=2)
+    change_message_visibility_batch = sqs.change_message_visibility_batch
+
+    async def _change_message_visibility_batch(**kwargs: Any) -> Dict:
+        calls.append([entry.get('VisibilityTimeout') for entry in kwargs.get('Entries')])
+        return await change_message_visibility_batch(**kwargs)
+
+    sqs.change_message_visibility_batch = _change_message_visibility_batch
+
+    async def _async() -> None:
+        # The visibility timeout of a message which is still being handled is extended, so that it isn't received again
+        await sqs.send_message(QueueUrl=queue_url, MessageBody='data')
+        await service._started_service()
+        await asyncio.sleep(3)
+        await service._stop_service()
+
+    loop.run_until_complete(_async())
+
+    assert handled == [('data', 1)]
+    assert calls and all(timeouts == [2] for timeouts in calls)
+
+
+def test_consume_queue_idle_backoff(monkeypatch: Any, loop: Any) -> None:
+    handled = []  # type: List
+    receives = [0]
+
+    async def handler(payload: str, receipt_handle: str, queue_url: str, receive_count: int) -> None:
+        handled.append(payload)
+        await AWSSNSSQSTransport.delete_message(AWSSNSSQSTransport, receipt_handle, queue_url, context)
+
+    options = {'wait_time_seconds': 0, 'max_idle_backoff': 0.4}
+    service, sqs, queue_url, context = start_memory_consumer(monkeypatch, loop, handler, options=options, idle_backoff=0.1)
+    receive_message = sqs.receive_message
+
+    async def _receive_message(**kwargs: Any) -> Dict:
+        receives[0] += 1
+        return await receive_message(**kwargs)
+
+    sqs.receive_message = _receive_message
+
+    async def _async() -> None:
+        # Empty receives are followed by a pause that doubles up to max_idle_backoff, instead of polling in a tight loop
+        await service._started_service()
+        await asyncio.sleep(1.5)
+        assert 4 <= receives[0] <= 8
+        assert AWSSNSSQSTransport.queue_metrics[queue_url]['idle_backoff_time'] > 1
+
+        # Messages are still picked up within max_idle_backoff
+        await sqs.send_message(QueueUrl=queue_url, MessageBody='data')
+        await asyncio.sleep(0.6)
+        assert handled == ['data']
+        await service._stop_service()
+
+    loop.run_until_complete(_async())
+
+
+def test_wildcard_subscription_refresh(monkeypatch: Any, loop: Any, caplog: Any) -> None:
+    backend = AWSSNSSQSMemoryBackend()
+    sns = backend.create_client('sns')
+    sqs = backend.create_client('sqs')
+    context = {'options': {'aws_sns_sqs': {'backend': backend, 'wait_time_seconds': 1, 'wildcard_topic_refresh_interval': 0.05}}}  # type: Dict
+    handled = []  # type: List
+
+    for name, value in [('clients', {'sns': sns, 'sqs': sqs}), ('close_waiter', None), ('topics', {}), ('topic_cache_loaded', True), ('topic_catalog', None),
+                        ('topic_catalog_names', None), ('queue_urls', None), ('queue_attributes', None), ('queue_metrics', {}), ('wildcard_subscription_task', None)]:
+        monkeypatch.setattr(AWSSNSSQSTransport, name, value)
+
+    service = MemoryConsumerService()
+    setattr(service, 'uuid', '5d0b530f-5c44-4981-b01f-342801bd48f5')
+    setattr(service, 'context', context)
+
+    async def func(self: Any, data: Any) -> None:
+        handled.append(data)
+
+    list_topics = sns.list_topics
+    failures = [1]
+
+    async def _list_topics(**kwargs: Any) -> Dict:
+        if failures[0] and AWSSNSSQSTransport.wildcard_subscription_task:
+            failures[0] -= 1
+            raise RuntimeError('list_topics failed')
+        return await list_topics(**kwargs)
+
+    sns.list_topics = _list_topics
+
+    async def _async() -> None:
+        await sns.create_topic(Name='test-topic___2e_a')
+        _subscribe = await AWSSNSSQSTransport.subscribe_handler(AWSSNSSQSTransport, service, context, func, 'test-topic.*', raw_message_delivery=True)
+
+        # Setting up the subscriptions again replaces the running refresh task rather than adding another one
+        await _subscribe()
+        task = AWSSNSSQSTransport.wildcard_subscription_task
+        await _subscribe()
+        await asyncio.sleep(0)
+        assert task.cancelled()
+        assert AWSSNSSQSTransport.wildcard_subscription_task is not task
+        await service._started_service()
+
+        # Topics created later are subscribed to by the refresh task, which keeps going after a failed refresh
+        await sns.create_topic(Name='test-topic___2e_b')
+        await asyncio.sleep(0.3)
+        assert 'Unable to refresh topic catalog [sns] on AWS (list_topics failed)' in caplog.text
+        await AWSSNSSQSTransport.publish(service, 'data', 'test-topic.b')
+        await asyncio.sleep(0.2)
+        assert handled == ['data']
+
+        task = AWSSNSSQSTransport.wildcard_subscription_task
+        await service._stop_service()
+        assert task.done()
+        assert AWSSNSSQSTransport.wildcard_subscription_task is None
+
+    loop.run_until_complete(_async())
+
+
+def test_topology_manifest(monkeypatch: Any, loop: Any, tmpdir: Any) -> None:
+    backend = AWSSNSSQSMemoryBackend()
+    sns = backend.create_client('sns')
+    sqs = backend.create_client('sqs')
+    context = {'options': {'aws_sns_sqs': {'backend': backend, 'wait_time_seconds': 1, 'topology_manifest_file': str(tmpdir.join('topology.json'))}}}  # type: Dict
+    calls = []  # type: List
+
+    for name, value in [('clients', {'sns': sns, 'sqs': sqs}), ('close_waiter', None), ('topics', {}), ('topic_cache_loaded', True), ('queue_urls', None),
+                        ('queue_attributes', None), ('queue_metrics', {}), ('wildcard_subscription_task', None)]:
+        monkeypatch.setattr(AWSSNSSQSTransport, name, value)
+
+    service = MemoryConsumerService()
+    setattr(service, 'uuid', '5d0b530f-5c44-4981-b01f-342801bd48f5')
+    setattr(service, 'context', context)
+
+    async def func(self: Any, data: Any) -> None:
+        pass
+
+    create_queue = sqs.create_queue
+
+    async def _create_queue(**kwargs: Any) -> Dict:
+        calls.append(kwargs.get('QueueName'))
+        return await create_queue(**kwargs)
+
+    sqs.create_queue = _create_queue
+
+    async def _async() -> None:
+        _subscribe = await AWSSNSSQSTransport.subscribe_handler(AWSSNSSQSTransport, service, context, func, 'test-topic', queue_name='test-queue')
+        await _subscribe()
+        assert calls == ['test-queue']
+        subscription_arn = ujson.loads(tmpdir.join('topology.json').read()).get('test-queue').get('subscription_arns')[0]
+
+        # Warm starts only verify that the queue and its subscription still exist
+        await _subscribe()
+        assert calls == ['test-queue']
+
+        # Subscriptions which have been removed or changed since the manifest was written are set up again
+        backend.subscriptions[subscription_arn]['Attributes']['RawMessageDelivery'] = 'true'
+        await _subscribe()
+        assert calls == ['test-queue', 'test-queue']
+
+        backend.topics[backend.subscriptions.pop(subscription_arn)['TopicArn']]['Subscriptions'].remove(subscription_arn)
+        await _subscribe()
+        assert calls == ['test-queue', 'test-queue', 'test-queue']
+        assert ujson.loads(tmpdir.join('topology.json').read()).get('test-queue').get('subscription_arns')[0] != subscription_arn
+
+        await service._started_service()
+        await service._stop_service()
+
+    loop.run_until_complete(_async())
+
+
+def test_failed_messages_dead_lettered(monkeypatch: Any, loop: Any) -> None:
+    backend = AWSSNSSQSMemoryBackend()
+    sns = backend.create_client('sns')
+    sqs = backend.create_client('sqs')
+    context = {'options': {'aws_sns_sqs': {'backend': backend, 'wait_time_seconds': 1}}}  # type: Dict
+    received = []  # type: List
+
+    for name, value in [('clients', {'sns': sns, 'sqs': sqs}), ('close_waiter', None), ('topics', {}), ('topic_cache_loaded', True), ('queue_urls', None),
+                        ('queue_attributes', None), ('queue_metrics', {}), ('wildcard_subscription_task', None)]:
+        monkeypatch.setattr(AWSSNSSQSTransport, name, value)
+
+    service = MemoryConsumerService()
+    setattr(service, 'uuid', '5d0b530f-5c44-4981-b01f-342801bd48f5')
+    setattr(service, 'context', context)
+
+    async def func(self: Any, data: Any) -> None:
+        received.append(data)
+        raise Exception('failed')
+
+    async def _async() -> None:
+        _subscribe = await AWSSNSSQSTransport.subscribe_handler(AWSSNSSQSTransport, service, context, func, 'test-topic', queue_name='test-queue', visibility_timeout=0,
+                                                                max_receive_count=2, raw_message_delivery=True)
+        await _subscribe()
+        await service._started_service()
+
+        # Messages whose handler raised are left on the queue, and moved to the dead-letter queue after max_receive_count receives
+        await AWSSNSSQSTransport.publish(service, 'data', 'test-topic')
+        await asyncio.sleep(0.5)
+        await service._stop_service()
+
+        assert received == ['data', 'data']
+        dlq_url = (await sqs.get_queue_url(QueueName='test-queue-dlq')).get('QueueUrl')
+        response = await sqs.receive_message(QueueUrl=dlq_url, WaitTimeSeconds=0)
+        assert [message.get('Body') for message in response.get('Messages')] == ['data']
+
+    loop.run_until_complete(_async())
@@ -0,0 +1,59 @@
+import asyncio
+import pytest
+from typing import Any
+from tomodachi.helpers.blob_store import BlobStore, LocalFileBlobStore, BlobCache
+
+
+def test_local_file_blob_store(tmpdir: Any, loop: Any) -> None:
+    blob_store = LocalFileBlobStore(str(tmpdir))
+
+    async def _async() -> None:
+        key = blob_store.generate_key('prefix/')
+        await blob_store.put(key, b'data')
+        assert await blob_store.get(key) == b'data'
+
+        with pytest.raises(ValueError):
+            await blob_store.get('../outside')
+
+    loop.run_until_complete(_async())
+
+
+def test_blob_store_interface() -> None:
+    class IncompleteBlobStore(BlobStore):
+        async def put(self, key: str, data: bytes) -> None:
+            pass
+
+    # Blob stores must implement both put and get
+    with pytest.raises(TypeError):
+        BlobStore()  # type: ignore
+    with pytest.raises(TypeError):
+        IncompleteBlobStore()  # type: ignore
+
+
+def test_blob_cache(loop: Any) -> None:
+    blob_cache = BlobCache(10)
+    fetches = []
+
+    async def _async() -> None:
+        async def fetch() -> bytes:
+            fetches.append(True)
+            await asyncio.sleep(0.01)
+            return b'12345'
+
+        results = await asyncio.gather(*[blob_cache.get('a', fetch) for _ in range(10)])
+        assert results == [b'12345'] * 10
+        assert len(fetches) == 1
+
+        await blob_cache.get('b', fetch)
+        assert len(fetches) == 2
+        assert await blob_cache.get('a', fetch) == b'12345'
+        assert len(fetches) == 2
+
+        # The least recently used blob is evicted once the cache is full
+        await blob_cache.get('c', fetch)
+        assert len(fetches) == 3
+        assert len(blob_cache) == 2
+        assert 'b' not in blob_cache.blobs
+        assert blob_cache.size == 10
+
+    loop.run_until_complete(_async())
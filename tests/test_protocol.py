@@ -269,3 +269,33 @@ def test_protobuf_object_static_validation_function_fail(monkeypatch: Any, capsy
 
     os.kill(os.getpid(), signal.SIGINT)
     loop.run_until_complete(future)
+
+
+def test_protobuf_binary_base(monkeypatch: Any, capsys: Any, loop: Any) -> None:
+    from tomodachi.protocol import ProtobufBinaryBase
+
+    services, future = start_service('tests/services/dummy_protobuf_service.py', monkeypatch)
+
+    instance = services.get('test_dummy_protobuf')
+
+    async def _async() -> None:
+        data = Person()
+        data.name = 'John Doe'
+        data.id = '12'
+        protobuf_message = await ProtobufBinaryBase.build_message(instance, 'topic', data)
+        assert type(protobuf_message) is bytes
+        assert len(protobuf_message) < len(await instance.message_protocol.build_message(instance, 'topic', data))
+
+        result, message_uuid, timestamp = await ProtobufBinaryBase.parse_message(memoryview(protobuf_message), Person)
+        assert result.get('data') == data
+        assert result.get('metadata', {}).get('data_encoding') == 'proto'
+        assert message_uuid[0:36] == instance.uuid
+
+        message = SNSSQSMessage()
+        message.ParseFromString(protobuf_message)
+        assert message.metadata.topic == 'topic'
+
+    loop.run_until_complete(_async())
+
+    os.kill(os.getpid(), signal.SIGINT)
+    loop.run_until_complete(future)
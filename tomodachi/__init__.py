@@ -9,12 +9,17 @@ except Exception:  # pragma: no cover
 
 try:
     from tomodachi.transport.amqp import (amqp,
-                                          amqp_publish)
+                                          amqp_publish,
+                                          amqp_rpc,
+                                          amqp_rpc_handler)
 except Exception:  # pragma: no cover
     pass
 try:
     from tomodachi.transport.aws_sns_sqs import (aws_sns_sqs,
-                                                 aws_sns_sqs_publish)
+                                                 aws_sns_sqs_publish,
+                                                 sqs,
+                                                 sqs_send,
+                                                 sqs_send_batch)
 except Exception:  # pragma: no cover
     pass
 try:
@@ -39,8 +44,8 @@ except Exception:  # pragma: no cover
 
 __all__ = ['service', 'Service', '__version__', '__version_info__',
            'decorator',
-           'amqp', 'amqp_publish',
-           'aws_sns_sqs', 'aws_sns_sqs_publish',
+           'amqp', 'amqp_publish', 'amqp_rpc', 'amqp_rpc_handler',
+           'aws_sns_sqs', 'aws_sns_sqs_publish', 'sqs', 'sqs_send', 'sqs_send_batch',
            'http', 'http_error', 'http_static', 'websocket', 'ws', 'HttpResponse', 'HttpException',
            'schedule', 'heartbeat', 'minutely', 'hourly', 'daily', 'monthly']
 
@@ -0,0 +1,126 @@
+import abc
+import asyncio
+import os
+import re
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Callable, Awaitable
+
+BLOB_KEY_PATTERN = re.compile(r'^[a-zA-Z0-9_.-]+(/[a-zA-Z0-9_.-]+)*$')
+
+
+class BlobStore(abc.ABC):
+    name = ''
+
+    @classmethod
+    def generate_key(cls, prefix: Optional[str] = None) -> str:
+        return '{}{}'.format(prefix or '', str(uuid.uuid4()))
+
+    @abc.abstractmethod
+    async def put(self, key: str, data: bytes) -> None:
+        pass
+
+    @abc.abstractmethod
+    async def get(self, key: str) -> bytes:
+        pass
+
+
+class LocalFileBlobStore(BlobStore):
+    name = 'file'
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def get_filename(self, key: str) -> str:
+        if not BLOB_KEY_PATTERN.match(key) or '..' in key.split('/'):
+            raise ValueError('Invalid blob key "{}"'.format(key))
+        return os.path.join(self.path, *key.split('/'))
+
+    async def put(self, key: str, data: bytes) -> None:
+        filename = self.get_filename(key)
+
+        def _put() -> None:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open('{}.tmp'.format(filename), 'wb') as file:
+                file.write(data)
+            os.replace('{}.tmp'.format(filename), filename)
+
+        loop = asyncio.get_event_loop()  # type: Any
+        await loop.run_in_executor(None, _put)
+
+    async def get(self, key: str) -> bytes:
+        filename = self.get_filename(key)
+
+        def _get() -> bytes:
+            with open(filename, 'rb') as file:
+                return file.read()
+
+        loop = asyncio.get_event_loop()  # type: Any
+        data = await loop.run_in_executor(None, _get)  # type: bytes
+        return data
+
+
+class S3BlobStore(BlobStore):
+    name = 's3'
+
+    def __init__(self, client: Any, bucket: str) -> None:
+        self.client = client
+        self.bucket = bucket
+
+    async def put(self, key: str, data: bytes) -> None:
+        await self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+
+    async def get(self, key: str) -> bytes:
+        response = await self.client.get_object(Bucket=self.bucket, Key=key)
+        body = response.get('Body')
+        try:
+            data = await body.read()  # type: bytes
+        finally:
+            body.close()
+        return data
+
+
+class BlobCache(object):
+    # Least recently used blobs are evicted when the total size of cached blobs exceeds max_size bytes. Concurrent
+    # lookups of a blob that isn't cached will await the same fetch.
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.size = 0
+        self.blobs = OrderedDict()  # type: OrderedDict
+        self.fetch_tasks = {}  # type: Dict[str, asyncio.Future]
+
+    def __len__(self) -> int:
+        return len(self.blobs)
+
+    def add(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_size:
+            return
+
+        if key in self.blobs:
+            self.size -= len(self.blobs.pop(key))
+        self.blobs[key] = data
+        self.size += len(data)
+
+        while self.size > self.max_size:
+            _, evicted_data = self.blobs.popitem(last=False)
+            self.size -= len(evicted_data)
+
+    async def get(self, key: str, fetch: Callable[[], Awaitable[bytes]]) -> bytes:
+        data = self.blobs.get(key)  # type: Optional[bytes]
+        if data is not None:
+            self.blobs.move_to_end(key)
+            return data
+
+        task = self.fetch_tasks.get(key)
+        if not task:
+            async def _fetch() -> bytes:
+                data = await fetch()
+                self.add(key, data)
+                return data
+
+            task = asyncio.ensure_future(_fetch())
+            self.fetch_tasks[key] = task
+            task.add_done_callback(lambda t: self.fetch_tasks.pop(key, None))
+
+        result = await asyncio.shield(task)  # type: bytes
+        return result
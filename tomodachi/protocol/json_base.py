@@ -36,27 +36,29 @@ class JsonBase(object):
     @classmethod
     async def parse_message(cls, payload: str) -> Union[Dict, Tuple]:
         message = ujson.loads(payload)
+        metadata = message.get('metadata', {})
+        service = message.get('service', {})
 
-        protocol_version = message.get('metadata', {}).get('protocol_version')
-        message_uuid = message.get('metadata', {}).get('message_uuid')
-        timestamp = message.get('metadata', {}).get('timestamp')
+        message_uuid = metadata.get('message_uuid')
+        timestamp = metadata.get('timestamp')
 
-        if message.get('metadata', {}).get('data_encoding') == 'raw':
+        data_encoding = metadata.get('data_encoding')
+        if data_encoding == 'raw':
             data = message.get('data')
-        elif message.get('metadata', {}).get('data_encoding') == 'base64_gzip_json':
+        elif data_encoding == 'base64_gzip_json':
             data = ujson.loads(zlib.decompress(base64.b64decode(message.get('data').encode('utf-8'))).decode('utf-8'))
 
         return {
             'service': {
-                'name': message.get('service', {}).get('name'),
-                'uuid': message.get('service', {}).get('uuid')
+                'name': service.get('name'),
+                'uuid': service.get('uuid')
             },
             'metadata': {
-                'message_uuid': message.get('metadata', {}).get('message_uuid'),
-                'protocol_version': message.get('metadata', {}).get('protocol_version'),
-                'timestamp': message.get('metadata', {}).get('timestamp'),
-                'topic': message.get('metadata', {}).get('topic'),
-                'data_encoding': message.get('metadata', {}).get('data_encoding')
+                'message_uuid': message_uuid,
+                'protocol_version': metadata.get('protocol_version'),
+                'timestamp': timestamp,
+                'topic': metadata.get('topic'),
+                'data_encoding': data_encoding
             },
             'data': data
         }, message_uuid, timestamp
@@ -11,6 +11,8 @@ PROTOCOL_VERSION = 'tomodachi-protobuf-base--1.0.0'
 
 
 class ProtobufBase(object):
+    binary = False
+
     @classmethod
     def validate(cls, **kwargs: Any) -> None:
         if 'proto_class' not in kwargs:
@@ -19,7 +21,7 @@ class ProtobufBase(object):
             raise Exception('proto_class is not a GeneratedProtocolMessageType')
 
     @classmethod
-    async def build_message(cls, service: Any, topic: str, data: Any) -> str:
+    async def build_message(cls, service: Any, topic: str, data: Any) -> Any:
         message_data = data.SerializeToString()
 
         data_encoding = 'proto'
@@ -37,12 +39,20 @@ class ProtobufBase(object):
         message.metadata.data_encoding = data_encoding
         message.data = message_data
 
-        return base64.b64encode(message.SerializeToString()).decode('ascii')
+        return cls.encode_payload(message.SerializeToString())
+
+    @classmethod
+    def encode_payload(cls, payload: bytes) -> Any:
+        return base64.b64encode(payload).decode('ascii')
+
+    @classmethod
+    def decode_payload(cls, payload: Any) -> bytes:
+        return base64.b64decode(payload)
 
     @classmethod
-    async def parse_message(cls, payload: str, proto_class: Any = None, validator: Any = None) -> Union[Dict, Tuple]:
+    async def parse_message(cls, payload: Any, proto_class: Any = None, validator: Any = None) -> Union[Dict, Tuple]:
         message = SNSSQSMessage()
-        message.ParseFromString(base64.b64decode(payload))
+        message.ParseFromString(cls.decode_payload(payload))
 
         message_uuid = message.metadata.message_uuid
         timestamp = message.metadata.timestamp
@@ -91,3 +101,19 @@ class ProtobufBase(object):
             },
             'data': raw_data if raw_data is not None else obj
         }, message_uuid, timestamp
+
+
+class ProtobufBinaryBase(ProtobufBase):
+    # The same envelope as ProtobufBase, without base64 encoding. Only for transports that can carry binary
+    # payloads, such as AMQP.
+    binary = True
+
+    @classmethod
+    def encode_payload(cls, payload: bytes) -> Any:
+        return payload
+
+    @classmethod
+    def decode_payload(cls, payload: Any) -> bytes:
+        if isinstance(payload, str):
+            return base64.b64decode(payload)
+        return bytes(payload)
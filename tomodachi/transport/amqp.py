@@ -1,4 +1,5 @@
 import logging
+import json
 import aioamqp
 import time
 import hashlib
@@ -6,9 +7,35 @@ import re
 import binascii
 import asyncio
 import inspect
-from typing import Any, Dict, Union, Optional, Callable, Match, Awaitable
+import random
+import functools
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Union, Optional, Callable, Match, Awaitable, Set, List, Tuple
 from tomodachi.invoker import Invoker
 
+DEFAULT_PREFETCH_COUNT = 100
+DEFAULT_MAX_UNCONFIRMED_PUBLISHES = 1000
+DEFAULT_PUBLISH_CHANNELS = 2
+DEFAULT_HEARTBEAT = 60
+DEFAULT_RECONNECT_MIN_BACKOFF = 1
+DEFAULT_RECONNECT_MAX_BACKOFF = 30
+DEFAULT_PUBLISH_BUFFER_SIZE = 10000
+DEFAULT_PUBLISH_MAX_ATTEMPTS = 5
+DEFAULT_PUBLISH_RETRY_BACKOFF = 0.1
+MAX_PUBLISH_RETRY_BACKOFF = 2
+DEFAULT_ACK_BATCH_SIZE = 50
+DEFAULT_ACK_LINGER_TIME = 0.01
+DEFAULT_MAX_RETRY_BACKOFF = 900
+RETRY_COUNT_HEADER = 'x-retry-count'
+MESSAGE_PROPERTIES = ('content_type', 'content_encoding', 'headers', 'delivery_mode', 'priority', 'correlation_id', 'reply_to', 'expiration', 'message_id',
+                      'timestamp', 'type', 'user_id', 'app_id', 'cluster_id')
+SHARD_KEY_HEADER = 'x-shard-key'
+DEFAULT_RPC_TIMEOUT = 10
+DEFAULT_MAX_CONCURRENT_RPC_CALLS = 100
+RPC_REPLY_TO = 'amq.rabbitmq.reply-to'
+RPC_ERROR_HEADER = 'x-rpc-error'
+
 
 class AmqpException(Exception):
     def __init__(self, *args: Any, **kwargs: Any) -> None:
@@ -43,17 +70,236 @@ class AmqpChannelClosed(AmqpException):
     pass
 
 
+class AmqpChannelError(AmqpChannelClosed):
+    pass
+
+
+class AmqpPublishNotConfirmed(AmqpException):
+    pass
+
+
+class AmqpRpcTimeout(AmqpException):
+    pass
+
+
+class AmqpRpcError(AmqpException):
+    pass
+
+
+class AmqpPublisherConfirms(object):
+    # Publishes on a channel in confirm mode are numbered by delivery tag, and resolved when the broker acks (or
+    # nacks) them. Acks with the multiple flag set resolves every outstanding publish up to and including the
+    # delivery tag. At most max_outstanding publishes are awaiting confirmation at the same time.
+    def __init__(self, channel: Any, max_outstanding: Optional[int] = None) -> None:
+        self.channel = channel
+        self.delivery_tag = 0
+        self.futures = OrderedDict()  # type: OrderedDict
+        self.semaphore = asyncio.Semaphore(max_outstanding) if max_outstanding else None
+
+        # The frame handlers of aioamqp only resolve a single delivery tag per ack, which is why they're replaced
+        connection_closed = channel.connection_closed
+
+        def _connection_closed(server_code: Optional[int] = None, server_reason: Optional[str] = None, exception: Optional[Exception] = None) -> Any:
+            if exception is None and server_code is not None:
+                # The channel was closed by the broker because of a channel error, such as publishing to an exchange
+                # which doesn't exist, which won't be solved by publishing again
+                self.fail(AmqpChannelError('Channel closed by the broker ({} {})'.format(server_code, server_reason or '')))
+            else:
+                self.fail(AmqpChannelClosed('Channel closed before the publish was confirmed'))
+            return connection_closed(server_code, server_reason, exception)
+
+        channel.connection_closed = _connection_closed
+        channel.basic_server_ack = self.server_ack
+        channel.basic_server_nack = self.server_nack
+
+    async def enable(self) -> None:
+        await self.channel.confirm_select()
+
+    async def publish(self, payload: Union[bytes, bytearray, memoryview], exchange_name: str, routing_key: str, properties: Optional[Dict] = None) -> asyncio.Future:
+        if self.semaphore:
+            await self.semaphore.acquire()
+
+        self.delivery_tag += 1
+        delivery_tag = self.delivery_tag
+        future = asyncio.Future()  # type: asyncio.Future
+        self.futures[delivery_tag] = future
+        if self.semaphore:
+            semaphore = self.semaphore
+            future.add_done_callback(lambda f: semaphore.release())
+
+        try:
+            await self.channel.basic_publish(payload, exchange_name, routing_key, properties=properties)
+        except Exception:
+            # The exception is raised to the caller, so the future is only cancelled to release its place in the window
+            self.futures.pop(delivery_tag, None)
+            future.cancel()
+            raise
+
+        return future
+
+    def resolve(self, delivery_tag: int, multiple: bool, exception: Optional[Exception] = None) -> None:
+        if multiple:
+            futures = []
+            while self.futures:
+                tag = next(iter(self.futures))
+                if tag > delivery_tag:
+                    break
+                futures.append(self.futures.pop(tag))
+        else:
+            futures = [self.futures.pop(delivery_tag)] if delivery_tag in self.futures else []
+
+        for future in futures:
+            if future.done():
+                continue
+            if exception:
+                future.set_exception(exception)
+            else:
+                future.set_result(None)
+
+    def fail(self, exception: Exception) -> None:
+        futures = list(self.futures.values())
+        self.futures = OrderedDict()
+        for future in futures:
+            if not future.done():
+                future.set_exception(exception)
+
+    async def server_ack(self, frame: Any) -> None:
+        decoder = aioamqp.frame.AmqpDecoder(frame.payload)
+        delivery_tag = decoder.read_long_long()
+        self.resolve(delivery_tag, bool(decoder.read_bit()))
+
+    async def server_nack(self, frame: Any) -> None:
+        decoder = aioamqp.frame.AmqpDecoder(frame.payload)
+        delivery_tag = decoder.read_long_long()
+        self.resolve(delivery_tag, bool(decoder.read_bit()), AmqpPublishNotConfirmed('Publish was rejected by the broker'))
+
+
+class AmqpAckCoalescer(object):
+    # Acks of handled messages are collected per channel and sent as a single ack with the multiple flag set, up to
+    # the highest delivery tag below every delivery on the channel which is still outstanding. Collected acks are
+    # flushed when batch_size messages have been handled or after linger_time seconds. Acks above a delivery which is
+    # still being handled are sent one by one, so that a slow message won't hold back the prefetch window. Nacks are
+    # sent right away.
+    def __init__(self, channel: Any, batch_size: Optional[int] = None, linger_time: Optional[float] = None) -> None:
+        self.channel = channel
+        self.batch_size = batch_size or 0
+        self.linger_time = linger_time or 0
+        self.outstanding = set()  # type: Set[int]
+        self.pending = set()  # type: Set[int]
+        self.timer = None  # type: Any
+        self.closed = False
+
+        connection_closed = channel.connection_closed
+
+        def _connection_closed(*args: Any, **kwargs: Any) -> Any:
+            # Unacked messages are redelivered by the broker once the channel is closed
+            self.outstanding = set()
+            self.pending = set()
+            self.close()
+            return connection_closed(*args, **kwargs)
+
+        channel.connection_closed = _connection_closed
+
+    def received(self, delivery_tag: int) -> None:
+        self.outstanding.add(delivery_tag)
+
+    def release(self, delivery_tag: int) -> None:
+        # Deliveries which are done without having been acked or nacked are acked, so that they won't stay in the
+        # prefetch window until the channel is closed
+        if delivery_tag in self.outstanding:
+            self.outstanding.discard(delivery_tag)
+            self.pending.add(delivery_tag)
+            self.schedule_flush()
+
+    async def ack(self, delivery_tag: int) -> None:
+        self.outstanding.discard(delivery_tag)
+        self.pending.add(delivery_tag)
+        if len(self.pending) >= self.batch_size:
+            await self.flush()
+        else:
+            self.schedule_flush()
+
+    async def nack(self, delivery_tag: int, requeue: bool = True) -> None:
+        self.outstanding.discard(delivery_tag)
+        await self.channel.basic_client_nack(delivery_tag, requeue=requeue)
+
+    def schedule_flush(self) -> None:
+        if self.timer or self.closed:
+            return
+
+        async def _flush() -> None:
+            self.timer = None
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.getLogger('transport.amqp').warning('Unable to acknowledge message [amqp] ({})'.format(str(e)))
+
+        loop = asyncio.get_event_loop()  # type: Any
+        self.timer = loop.call_later(self.linger_time, lambda: asyncio.ensure_future(_flush()))
+
+    async def flush(self) -> None:
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+
+        pending = self.pending
+        self.pending = set()
+
+        # A multiple ack settles every unacked delivery up to its delivery tag, which is why it may only cover
+        # deliveries which have been handled
+        lowest_outstanding = min(self.outstanding) if self.outstanding else None
+        multiple_delivery_tags = [delivery_tag for delivery_tag in pending if lowest_outstanding is None or delivery_tag < lowest_outstanding]
+        multiple_delivery_tag = max(multiple_delivery_tags) if multiple_delivery_tags else None
+
+        if multiple_delivery_tag is not None:
+            await self.channel.basic_client_ack(multiple_delivery_tag, multiple=True)
+        for delivery_tag in sorted(pending):
+            if multiple_delivery_tag is None or delivery_tag > multiple_delivery_tag:
+                await self.channel.basic_client_ack(delivery_tag)
+
+    def close(self) -> None:
+        self.closed = True
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+
 class AmqpTransport(Invoker):
     channel = None  # type: Any
     protocol = None  # type: Any
     transport = None  # type: Any
+    publish_channels = []  # type: List[Tuple[Any, Optional[AmqpPublisherConfirms]]]
+    publish_channel_index = 0
+    reopen_publish_channel_tasks = {}  # type: Dict[Any, asyncio.Future]
+    handler_tasks = set()  # type: Set[asyncio.Future]
+    ack_coalescers = set()  # type: Set[AmqpAckCoalescer]
+    shard_keys = {}  # type: Dict[str, str]
+    rpc_channel = None  # type: Any
+    rpc_futures = {}  # type: Dict[str, asyncio.Future]
+    rpc_semaphore = None  # type: Optional[asyncio.Semaphore]
+    reconnect_waiter = None  # type: Optional[asyncio.Future]
+    buffered_publishes = 0
+    closing = False
 
     @classmethod
-    async def publish(cls, service: Any, data: Any, routing_key: str = '', exchange_name: str = '', wait: bool = True) -> None:
+    async def publish(cls, service: Any, data: Any, routing_key: str = '', exchange_name: str = '', wait: bool = True, shard_key: Optional[str] = None) -> None:
         if not cls.channel:
             await cls.connect(cls, service, service.context)
         exchange_name = exchange_name or cls.exchange_name or 'amq.topic'
 
+        # Messages to sharded subscriptions are hashed on the value of the shard_key field of the message, given
+        # either as an argument, in options.amqp.shard_keys or by a sharded subscription in the same process
+        properties = None
+        shard_key = shard_key or (service.context.get('options', {}).get('amqp', {}).get('shard_keys') or {}).get(routing_key) or cls.shard_keys.get(routing_key)
+        if shard_key:
+            shard_value = data.get(shard_key) if isinstance(data, dict) else getattr(data, shard_key, None)
+            if shard_value is None:
+                logging.getLogger('transport.amqp').error('Unable to publish message [amqp] to "{}", shard key field "{}" is missing'.format(routing_key, shard_key))
+                raise AmqpException('Shard key field "{}" is missing'.format(shard_key), log_level=service.context.get('log_level'))
+            properties = {'headers': {SHARD_KEY_HEADER: str(shard_value)}}
+
         message_protocol = getattr(service, 'message_protocol', None)
 
         payload = data
@@ -62,20 +308,160 @@ class AmqpTransport(Invoker):
             if build_message_func:
                 payload = await build_message_func(service, routing_key, data)
 
+        # Binary payloads, such as the ones built by binary message protocols, are published as is
+        body = payload if isinstance(payload, (bytes, bytearray, memoryview)) else str.encode(payload)
+        if not body:
+            raise AmqpException('Unable to publish an empty message', log_level=service.context.get('log_level'))
+
         async def _publish_message() -> None:
+            # A publish which fails because its channel or the connection was closed is made again, with backoff, up
+            # to options.amqp.publish_max_attempts times
+            max_attempts = max(int(service.context.get('options', {}).get('amqp', {}).get('publish_max_attempts', DEFAULT_PUBLISH_MAX_ATTEMPTS) or 1), 1)
+            attempt = 0
             success = False
             while not success:
+                if cls.reconnect_waiter and not cls.reconnect_waiter.done():
+                    # Publishes made while the connection is being recovered are held back until it's reestablished,
+                    # and are then made in the order they were buffered
+                    if cls.buffered_publishes >= int(service.context.get('options', {}).get('amqp', {}).get('publish_buffer_size', DEFAULT_PUBLISH_BUFFER_SIZE) or 0):
+                        logging.getLogger('transport.amqp').warning('Unable to publish message [amqp] (publish buffer is full while reconnecting)')
+                        raise AmqpConnectionException('Publish buffer is full while reconnecting', log_level=service.context.get('log_level'))
+                    cls.buffered_publishes += 1
+                    try:
+                        await asyncio.shield(cls.reconnect_waiter)
+                    finally:
+                        cls.buffered_publishes -= 1
+                    continue
                 try:
-                    await cls.channel.basic_publish(str.encode(payload), exchange_name, cls.encode_routing_key(cls.get_routing_key(routing_key, service.context)))
+                    # With publisher confirms the publish is done once the broker has confirmed it, and is made
+                    # again on another channel if the channel is closed before that
+                    channel, publisher_confirms = await cls.get_publish_channel(cls, service.context)
+                    if publisher_confirms:
+                        confirm = await publisher_confirms.publish(body, exchange_name, cls.encode_routing_key(cls.get_routing_key(routing_key, service.context)), properties=properties)
+                        await confirm
+                    else:
+                        await channel.basic_publish(body, exchange_name, cls.encode_routing_key(cls.get_routing_key(routing_key, service.context)), properties=properties)
                     success = True
-                except AssertionError as e:
-                    await cls.connect(cls, service, service.context)
+                except AmqpChannelError as e:
+                    logging.getLogger('transport.amqp').warning('Unable to publish message [amqp] ({})'.format(str(e)))
+                    raise AmqpChannelError(str(e), log_level=service.context.get('log_level')) from e
+                except (AssertionError, AmqpChannelClosed, aioamqp.exceptions.ChannelClosed, aioamqp.exceptions.AmqpClosedConnection) as e:
+                    if cls.closing or not cls.protocol:
+                        raise AmqpConnectionException('Connection closed', log_level=service.context.get('log_level')) from e
+                    attempt += 1
+                    if attempt >= max_attempts:
+                        logging.getLogger('transport.amqp').warning('Unable to publish message [amqp] (channel closed, gave up after {} attempts)'.format(attempt))
+                        raise AmqpChannelClosed('Unable to publish message after {} attempts'.format(attempt), log_level=service.context.get('log_level')) from e
+                    if not cls.is_connected(cls):
+                        cls.reconnect(cls, service, service.context)
+                    else:
+                        retry_backoff = float(service.context.get('options', {}).get('amqp', {}).get('publish_retry_backoff', DEFAULT_PUBLISH_RETRY_BACKOFF))
+                        await asyncio.sleep(random.uniform(0.5, 1) * min(retry_backoff * 2 ** (attempt - 1), MAX_PUBLISH_RETRY_BACKOFF))
+                except AmqpPublishNotConfirmed as e:
+                    logging.getLogger('transport.amqp').warning('Unable to publish message [amqp] ({})'.format(str(e)))
+                    raise AmqpPublishNotConfirmed(str(e), log_level=service.context.get('log_level')) from e
 
         if wait:
             await _publish_message()
         else:
             loop = asyncio.get_event_loop()  # type: Any
-            loop.create_task(_publish_message())
+            task = loop.create_task(_publish_message())
+
+            def _done(t: asyncio.Future) -> None:
+                # Nobody awaits the publish, so its exception is retrieved here rather than reported by the event loop
+                if not t.cancelled() and t.exception():
+                    logging.getLogger('transport.amqp').warning('Unable to publish message [amqp] ({})'.format(str(t.exception())))
+
+            task.add_done_callback(_done)
+
+    @classmethod
+    async def rpc(cls, service: Any, routing_key: str, data: Any, timeout: Optional[float] = None, exchange_name: str = '') -> Any:
+        # Requests are published on a channel consuming from the direct reply-to pseudo queue, and the reply is matched
+        # to the request by its correlation id
+        if not cls.channel:
+            await cls.connect(cls, service, service.context)
+        exchange_name = exchange_name or service.context.get('options', {}).get('amqp', {}).get('exchange_name', 'amq.topic')
+        timeout = timeout if timeout is not None else service.context.get('options', {}).get('amqp', {}).get('rpc_timeout', DEFAULT_RPC_TIMEOUT)
+
+        message_protocol = getattr(service, 'message_protocol', None)
+
+        payload = data
+        if message_protocol:
+            build_message_func = getattr(message_protocol, 'build_message', None)
+            if build_message_func:
+                payload = await build_message_func(service, routing_key, data)
+        body = payload if isinstance(payload, (bytes, bytearray, memoryview)) else str.encode(payload)
+
+        if not cls.rpc_semaphore:
+            cls.rpc_semaphore = asyncio.Semaphore(int(service.context.get('options', {}).get('amqp', {}).get('max_concurrent_rpc_calls', DEFAULT_MAX_CONCURRENT_RPC_CALLS)))
+
+        async with cls.rpc_semaphore:
+            channel = await cls.get_rpc_channel(cls)
+            correlation_id = str(uuid.uuid4())
+            future = asyncio.Future()  # type: asyncio.Future
+            cls.rpc_futures[correlation_id] = future
+            try:
+                properties = {'reply_to': RPC_REPLY_TO, 'correlation_id': correlation_id}
+                if timeout:
+                    # Requests which haven't been handled before the call has timed out are dropped by the broker
+                    properties['expiration'] = str(int(timeout * 1000))
+                await channel.basic_publish(body, exchange_name, cls.encode_routing_key(cls.get_routing_key(routing_key, service.context)), properties=properties)
+                try:
+                    reply_body, reply_properties = await asyncio.wait_for(future, timeout=timeout or None)
+                except asyncio.TimeoutError as e:
+                    logging.getLogger('transport.amqp').warning('RPC call timed out [amqp] to "{}" after {} seconds'.format(routing_key, timeout))
+                    raise AmqpRpcTimeout('RPC call to "{}" timed out'.format(routing_key), log_level=service.context.get('log_level')) from e
+            finally:
+                cls.rpc_futures.pop(correlation_id, None)
+
+        error_message = (getattr(reply_properties, 'headers', None) or {}).get(RPC_ERROR_HEADER)
+        if error_message is not None:
+            raise AmqpRpcError(error_message, log_level=service.context.get('log_level'))
+
+        if message_protocol:
+            parse_message_func = getattr(message_protocol, 'parse_message', None)
+            if parse_message_func:
+                message, _, _ = await parse_message_func(reply_body if getattr(message_protocol, 'binary', False) else reply_body.decode())
+                return message.get('data') if isinstance(message, dict) else message
+        return reply_body.decode()
+
+    async def get_rpc_channel(cls: Any) -> Any:
+        if cls.rpc_channel and cls.rpc_channel.is_open and cls.is_connected(cls):
+            return cls.rpc_channel
+
+        channel = await cls.protocol.channel()
+        connection_closed = channel.connection_closed
+
+        def _connection_closed(*args: Any, **kwargs: Any) -> Any:
+            # Calls awaiting a reply on the channel won't get one once it's closed
+            for correlation_id, future in list(cls.rpc_futures.items()):
+                if not future.done():
+                    future.set_exception(AmqpChannelClosed('Channel closed before a reply was received'))
+            return connection_closed(*args, **kwargs)
+
+        channel.connection_closed = _connection_closed
+
+        async def _callback(channel: Any, body: bytes, envelope: Any, properties: Any) -> None:
+            future = cls.rpc_futures.get(getattr(properties, 'correlation_id', None) or '')
+            if future and not future.done():
+                future.set_result((body, properties))
+
+        await channel.basic_consume(_callback, queue_name=RPC_REPLY_TO, no_ack=True)
+        cls.rpc_channel = channel
+        return channel
+
+    async def publish_rpc_reply(cls: Any, context: Dict, body: bytes, reply_to: str, correlation_id: Optional[str], headers: Optional[Dict] = None) -> None:
+        properties = {'correlation_id': correlation_id}  # type: Dict[str, Any]
+        if headers:
+            properties['headers'] = headers
+
+        channel, publisher_confirms = await cls.get_publish_channel(cls, context)
+        if publisher_confirms:
+            # Replies aren't retried, which is why the confirm isn't awaited
+            confirm = await publisher_confirms.publish(body, '', reply_to, properties=properties)
+            confirm.add_done_callback(lambda f: f.cancelled() or f.exception())
+        else:
+            await channel.basic_publish(body, '', reply_to, properties=properties)
 
     @classmethod
     def get_routing_key(cls, routing_key: str, context: Dict) -> str:
@@ -114,7 +500,9 @@ class AmqpTransport(Invoker):
             return '{}{}'.format(context.get('options', {}).get('amqp', {}).get('queue_name_prefix'), queue_name)
         return queue_name
 
-    async def subscribe_handler(cls: Any, obj: Any, context: Dict, func: Any, routing_key: str, callback_kwargs: Optional[Union[list, set, tuple]] = None, exchange_name: str = '', competing: Optional[bool] = None, queue_name: Optional[str] = None, **kwargs: Any) -> Any:
+    async def subscribe_handler(cls: Any, obj: Any, context: Dict, func: Any, routing_key: str, callback_kwargs: Optional[Union[list, set, tuple]] = None, exchange_name: str = '', competing: Optional[bool] = None, queue_name: Optional[str] = None,
+                                prefetch_count: Optional[int] = None, prefetch_size: Optional[int] = None, retry_backoff: Optional[int] = None, max_retries: Optional[int] = None,
+                                dead_letter_exchange_name: Optional[str] = None, shards: Optional[int] = None, shard_key: Optional[str] = None, rpc: bool = False, **kwargs: Any) -> Any:
         parser_kwargs = kwargs
         message_protocol = context.get('message_protocol')
 
@@ -124,7 +512,29 @@ class AmqpTransport(Invoker):
             if protocol_kwargs_validation_func:
                 protocol_kwargs_validation_func(**parser_kwargs)
 
-        async def handler(payload: Any, delivery_tag: Any) -> Any:
+        async def send_reply(properties: Any, return_value: Any = None, error: Optional[Exception] = None) -> None:
+            reply_to = getattr(properties, 'reply_to', None)
+            if not rpc or not reply_to:
+                return
+
+            try:
+                # Empty messages can't be published, which is why errors and None return values are replied with a
+                # body as well. The caller raises on the error header without parsing the body of an error reply.
+                headers = None
+                payload = return_value
+                if error is not None:
+                    headers = {RPC_ERROR_HEADER: str(error) or error.__class__.__name__}
+                    payload = json.dumps({'error': headers[RPC_ERROR_HEADER]})
+                elif message_protocol and getattr(message_protocol, 'build_message', None):
+                    payload = await message_protocol.build_message(obj, routing_key, return_value)
+                elif return_value is None:
+                    payload = json.dumps(None)
+                body = payload if isinstance(payload, (bytes, bytearray, memoryview)) else str.encode(payload)
+                await cls.publish_rpc_reply(cls, context, body, reply_to, getattr(properties, 'correlation_id', None), headers)
+            except Exception as e:
+                logging.getLogger('transport.amqp').warning('Unable to publish RPC reply [amqp] ({})'.format(str(e)))
+
+        async def handler(payload: Any, delivery_tag: Any, acks: AmqpAckCoalescer, nack: Callable[[], Awaitable], properties: Any = None) -> Any:
             _callback_kwargs = callback_kwargs  # type: Any
             values = inspect.getfullargspec(func)
             if not _callback_kwargs:
@@ -150,6 +560,8 @@ class AmqpTransport(Invoker):
                             context['_amqp_received_messages'] = {}
                         message_key = '{}:{}'.format(message_uuid, func.__name__)
                         if context['_amqp_received_messages'].get(message_key):
+                            # Duplicates are acked, every delivery must be settled to free its slot in the prefetch window
+                            await acks.ack(delivery_tag)
                             return
                         context['_amqp_received_messages'][message_key] = time.time()
                         _received_messages = context['_amqp_received_messages']
@@ -164,12 +576,12 @@ class AmqpTransport(Invoker):
                             kwargs['message'] = message
                 except Exception as e:
                     logging.getLogger('exception').exception('Uncaught exception: {}'.format(str(e)))
-                    if message is not False and not message_uuid:
-                        await cls.channel.basic_client_ack(delivery_tag)
-                    elif message is False and message_uuid:
-                        pass  # incompatible protocol, should probably ack if old message
-                    elif message is False:
-                        await cls.channel.basic_client_ack(delivery_tag)
+                    if message is False and message_uuid:
+                        # Incompatible protocol, rejected without requeue (and dead-lettered if the queue has a
+                        # dead-letter exchange) instead of being left unacked in the prefetch window
+                        await acks.nack(delivery_tag, requeue=False)
+                    else:
+                        await acks.ack(delivery_tag)
                     return
 
             try:
@@ -188,9 +600,10 @@ class AmqpTransport(Invoker):
                 if issubclass(e.__class__, (AmqpInternalServiceError, AmqpInternalServiceErrorException, AmqpInternalServiceException)):
                     if message_key:
                         del context['_amqp_received_messages'][message_key]
-                    await cls.channel.basic_client_nack(delivery_tag)
+                    await nack()
                     return
-                await cls.channel.basic_client_ack(delivery_tag)
+                await send_reply(properties, error=e)
+                await acks.ack(delivery_tag)
                 return
 
             if isinstance(routine, Awaitable):
@@ -201,25 +614,75 @@ class AmqpTransport(Invoker):
                     if issubclass(e.__class__, (AmqpInternalServiceError, AmqpInternalServiceErrorException, AmqpInternalServiceException)):
                         if message_key:
                             del context['_amqp_received_messages'][message_key]
-                        await cls.channel.basic_client_nack(delivery_tag)
+                        await nack()
                         return
-                    await cls.channel.basic_client_ack(delivery_tag)
+                    await send_reply(properties, error=e)
+                    await acks.ack(delivery_tag)
                     return
             else:
                 return_value = routine
 
-            await cls.channel.basic_client_ack(delivery_tag)
+            await send_reply(properties, return_value)
+            await acks.ack(delivery_tag)
 
             return return_value
 
         exchange_name = exchange_name or context.get('options', {}).get('amqp', {}).get('exchange_name', 'amq.topic')
 
         context['_amqp_subscribers'] = context.get('_amqp_subscribers', [])
-        context['_amqp_subscribers'].append((routing_key, exchange_name, competing, queue_name, func, handler))
+        if not shards:
+            context['_amqp_subscribers'].append((routing_key, exchange_name, competing, queue_name, func, handler, prefetch_count, prefetch_size, retry_backoff, max_retries, dead_letter_exchange_name, None))
+        else:
+            # Messages are distributed over the shard queues by a consistent-hash exchange, bound to the exchange with
+            # the routing key. Each instance consumes the shards claimed by it, given options.amqp.shard_instances and
+            # options.amqp.shard_instance, one message at a time per shard to keep the order of messages per key.
+            if shard_key:
+                cls.shard_keys[routing_key] = shard_key
+            shard_instances = max(int(context.get('options', {}).get('amqp', {}).get('shard_instances') or 1), 1)
+            shard_instance = int(context.get('options', {}).get('amqp', {}).get('shard_instance') or 0)
+            shard_queue_name = queue_name or cls.get_queue_name(cls.encode_routing_key(routing_key), func.__name__, obj.uuid, True, {})
+            shard_exchange_name = '{}.shards'.format(cls.prefix_queue_name(shard_queue_name, context))
+            for shard in range(int(shards)):
+                if shard % shard_instances != shard_instance % shard_instances:
+                    continue
+                context['_amqp_subscribers'].append((routing_key, exchange_name, True, '{}.shard.{}'.format(shard_queue_name, shard), func, handler, prefetch_count, prefetch_size,
+                                                     retry_backoff, max_retries, dead_letter_exchange_name, shard_exchange_name))
 
         start_func = cls.subscribe(cls, obj, context)
         return (await start_func) if start_func else None
 
+    async def subscribe_rpc_handler(cls: Any, obj: Any, context: Dict, func: Any, routing_key: str, callback_kwargs: Optional[Union[list, set, tuple]] = None, exchange_name: str = '',
+                                    queue_name: Optional[str] = None, max_concurrency: Optional[int] = None, **kwargs: Any) -> Any:
+        # RPC requests are consumed from a queue shared by every instance of the service, and the return value of the
+        # handler is published to the reply-to address of the request. At most max_concurrency requests are handled
+        # at the same time.
+        if max_concurrency is None:
+            max_concurrency = context.get('options', {}).get('amqp', {}).get('rpc_max_concurrency', DEFAULT_PREFETCH_COUNT)
+        return await cls.subscribe_handler(cls, obj, context, func, routing_key, callback_kwargs=callback_kwargs, exchange_name=exchange_name, competing=True, queue_name=queue_name,
+                                           prefetch_count=max_concurrency, rpc=True, **kwargs)
+
+    @classmethod
+    def get_retry_delays(cls, retry_backoff: Optional[int], max_retries: Optional[int], context: Dict) -> List[int]:
+        # Retries are delayed by retry_backoff * 2 ** (retry_count - 1) seconds, capped at max_retry_backoff. Retries
+        # beyond the last delay use the last delay.
+        if not retry_backoff:
+            return [0] if max_retries else []
+
+        max_retry_backoff = context.get('options', {}).get('amqp', {}).get('max_retry_backoff', DEFAULT_MAX_RETRY_BACKOFF)
+        retry_delays = []  # type: List[int]
+        while not max_retries or len(retry_delays) < max_retries:
+            retry_delay = int(min(retry_backoff * 2 ** len(retry_delays), max_retry_backoff))
+            if retry_delays and retry_delay == retry_delays[-1]:
+                break
+            retry_delays.append(retry_delay)
+        return retry_delays
+
+    @classmethod
+    def get_retry_queue_name(cls, queue_name: str, retry_delay: int) -> str:
+        if not retry_delay:
+            return queue_name
+        return '{}.retry.{}'.format(queue_name, retry_delay)
+
     async def connect(cls: Any, obj: Any, context: Dict) -> Any:
         logging.getLogger('aioamqp.protocol').setLevel(logging.WARNING)
         logging.getLogger('aioamqp.channel').setLevel(logging.WARNING)
@@ -228,9 +691,10 @@ class AmqpTransport(Invoker):
         port = context.get('options', {}).get('amqp', {}).get('port', 5672)
         login = context.get('options', {}).get('amqp', {}).get('login', 'guest')
         password = context.get('options', {}).get('amqp', {}).get('password', 'guest')
+        heartbeat = context.get('options', {}).get('amqp', {}).get('heartbeat', DEFAULT_HEARTBEAT)
 
         try:
-            transport, protocol = await aioamqp.connect(host=host, port=port, login=login, password=password)
+            transport, protocol = await aioamqp.connect(host=host, port=port, login=login, password=password, heartbeat=int(heartbeat or 0))
             cls.protocol = protocol
             cls.transport = transport
         except ConnectionRefusedError as e:
@@ -246,39 +710,152 @@ class AmqpTransport(Invoker):
             logging.getLogger('transport.amqp').warning('Unable to connect [amqp] to {}:{} ({})'.format(host, port, error_message))
             raise AmqpConnectionException(str(e), log_level=context.get('log_level')) from e
 
-        channel = await protocol.channel()
         if not cls.channel:
             stop_method = getattr(obj, '_stop_service', None)
 
             async def stop_service(*args: Any, **kwargs: Any) -> None:
                 if stop_method:
                     await stop_method(*args, **kwargs)
+                if cls.handler_tasks:
+                    # Messages already being handled are finished and acked before the connection is closed
+                    await asyncio.wait(list(cls.handler_tasks), timeout=30)
+                for ack_coalescer in list(cls.ack_coalescers):
+                    try:
+                        await ack_coalescer.flush()
+                    except Exception as e:
+                        logging.getLogger('transport.amqp').warning('Unable to acknowledge message [amqp] ({})'.format(str(e)))
+                    ack_coalescer.close()
+                cls.ack_coalescers = set()
                 logging.getLogger('aioamqp.protocol').setLevel(logging.ERROR)
-                await cls.protocol.close()
-                cls.transport.close()
-                cls.channel = None
-                cls.transport = None
-                cls.protocol = None
+                cls.closing = True
+                try:
+                    if cls.is_connected(cls):
+                        await cls.protocol.close()
+                    if cls.transport:
+                        cls.transport.close()
+                finally:
+                    cls.channel = None
+                    cls.transport = None
+                    cls.protocol = None
+                    cls.closing = False
 
             setattr(obj, '_stop_service', stop_service)
 
+        # Messages are published round-robin over a small pool of channels, separate from the consumer channels
+        publish_channel_count = max(int(context.get('options', {}).get('amqp', {}).get('publish_channels', DEFAULT_PUBLISH_CHANNELS) or 1), 1)
+        cls.publish_channels = [await cls.open_publish_channel(cls, context) for _ in range(publish_channel_count)]
+        cls.publish_channel_index = 0
+
+        channel, _ = cls.publish_channels[0]
         cls.channel = channel
         cls.exchange_name = context.get('options', {}).get('amqp', {}).get('exchange_name', 'amq.topic')
 
+        async def _supervise_connection() -> None:
+            # Heartbeats from the broker are checked by aioamqp, which closes the connection if they're missed
+            await protocol.connection_closed.wait()
+            if not cls.closing and cls.protocol is protocol:
+                cls.reconnect(cls, obj, context)
+
+        asyncio.ensure_future(_supervise_connection())
+
         return channel
 
+    def is_connected(cls: Any) -> bool:
+        return bool(cls.protocol and cls.protocol.state == aioamqp.protocol.OPEN)
+
+    def reconnect(cls: Any, obj: Any, context: Dict) -> asyncio.Future:
+        waiter = cls.reconnect_waiter  # type: Optional[asyncio.Future]
+        if waiter and not waiter.done():
+            return waiter
+
+        waiter = asyncio.Future()
+        cls.reconnect_waiter = waiter
+
+        async def _reconnect() -> None:
+            # Reconnects with exponential backoff and full jitter, after which the exchanges, queues and bindings of
+            # the consumers are declared again and the consumers are restored
+            min_backoff = float(context.get('options', {}).get('amqp', {}).get('reconnect_min_backoff', DEFAULT_RECONNECT_MIN_BACKOFF))
+            max_backoff = float(context.get('options', {}).get('amqp', {}).get('reconnect_max_backoff', DEFAULT_RECONNECT_MAX_BACKOFF))
+            attempt = 0
+            while not cls.closing and cls.protocol:
+                delay = random.uniform(0, min(max_backoff, min_backoff * (2 ** attempt)))
+                attempt += 1
+                logging.getLogger('transport.amqp').warning('Connection lost [amqp] - reconnecting in {:.1f} seconds'.format(delay))
+                await asyncio.sleep(delay)
+                if cls.closing or not cls.protocol:
+                    break
+
+                try:
+                    await cls.connect(cls, obj, context)
+                    restore_consumers = context.get('_amqp_restore_consumers')
+                    if restore_consumers:
+                        await restore_consumers()
+                except Exception as e:
+                    logging.getLogger('transport.amqp').warning('Unable to reconnect [amqp] ({})'.format(str(e)))
+                    if cls.is_connected(cls):
+                        try:
+                            await cls.protocol.close()
+                        except Exception:
+                            pass
+                    continue
+
+                logging.getLogger('transport.amqp').warning('Reconnected [amqp]')
+                break
+
+            if not waiter.done():
+                waiter.set_result(None)
+
+        asyncio.ensure_future(_reconnect())
+        return waiter
+
+    async def open_publish_channel(cls: Any, context: Dict) -> Tuple[Any, Optional[AmqpPublisherConfirms]]:
+        channel = await cls.protocol.channel()
+        if not context.get('options', {}).get('amqp', {}).get('publisher_confirms', True):
+            return channel, None
+
+        publisher_confirms = AmqpPublisherConfirms(channel, context.get('options', {}).get('amqp', {}).get('max_unconfirmed_publishes', DEFAULT_MAX_UNCONFIRMED_PUBLISHES))
+        await publisher_confirms.enable()
+        return channel, publisher_confirms
+
+    async def get_publish_channel(cls: Any, context: Dict) -> Tuple[Any, Optional[AmqpPublisherConfirms]]:
+        index = cls.publish_channel_index % len(cls.publish_channels)
+        cls.publish_channel_index = index + 1
+
+        channel, publisher_confirms = cls.publish_channels[index]
+        if not channel.is_open:
+            # A publish channel closed by a channel error is reopened on its own, as long as the connection is open.
+            # Publishes which find the channel closed at the same time await the same reopen.
+            publish_channels = cls.publish_channels
+            reopen_task = cls.reopen_publish_channel_tasks.get(channel)
+            if not reopen_task:
+                async def _reopen() -> Tuple[Any, Optional[AmqpPublisherConfirms]]:
+                    publish_channel = await cls.open_publish_channel(cls, context)  # type: Tuple[Any, Optional[AmqpPublisherConfirms]]
+                    if publish_channels is cls.publish_channels and publish_channels[index][0] is channel:
+                        publish_channels[index] = publish_channel
+                        if index == 0:
+                            cls.channel = publish_channel[0]
+                    return publish_channel
+
+                reopen_task = asyncio.ensure_future(_reopen())
+                cls.reopen_publish_channel_tasks[channel] = reopen_task
+                reopen_task.add_done_callback(lambda t: cls.reopen_publish_channel_tasks.pop(channel, None))
+            channel, publisher_confirms = await asyncio.shield(reopen_task)
+
+        return channel, publisher_confirms
+
     async def subscribe(cls: Any, obj: Any, context: Dict) -> Optional[Callable]:
         if context.get('_amqp_subscribed'):
             return None
         context['_amqp_subscribed'] = True
 
         cls.channel = None
-        channel = await cls.connect(cls, obj, context)
+        await cls.connect(cls, obj, context)
 
         async def _subscribe() -> None:
-            async def declare_queue(routing_key: str, func: Callable, exchange_name: str = '', exchange_type: str = 'topic', queue_name: Optional[str] = None,
+            async def declare_queue(channel: Any, routing_key: str, func: Callable, exchange_name: str = '', exchange_type: str = 'topic', queue_name: Optional[str] = None,
                                     passive: bool = False, durable: bool = True, exclusive: bool = False, auto_delete: bool = False,
-                                    competing_consumer: Optional[bool] = None) -> Optional[str]:
+                                    competing_consumer: Optional[bool] = None, retry_delays: Optional[List[int]] = None, max_retries: Optional[int] = None,
+                                    dead_letter_exchange_name: Optional[str] = None, shard_exchange_name: Optional[str] = None) -> Optional[str]:
                 try:
                     if exchange_name and exchange_name != 'amq.topic':
                         await channel.exchange_declare(exchange_name=exchange_name, type_name=exchange_type, passive=False, durable=True, auto_delete=False)
@@ -305,11 +882,52 @@ class AmqpTransport(Invoker):
                 else:
                     queue_name = cls.prefix_queue_name(queue_name, context)
 
-                amqp_arguments = {}
+                amqp_arguments = {}  # type: Dict[str, Any]
                 ttl = context.get('options', {}).get('amqp', {}).get('queue_ttl', 86400)
                 if ttl:
                     amqp_arguments['x-expires'] = int(ttl * 1000)
 
+                dead_letter_exchange_auto_delete = False
+                if max_retries is not None and not dead_letter_exchange_name:
+                    dead_letter_exchange_name = '{}.dlx'.format(queue_name)
+                    # The exchange of a non-competing consumer is named after a queue which is unique to the instance,
+                    # and is removed together with its dead-letter queue
+                    dead_letter_exchange_auto_delete = not competing_consumer
+                if dead_letter_exchange_name:
+                    # Messages which are rejected after their last retry are routed to the dead-letter exchange with
+                    # the name of the queue as routing key, which routes them to the dead-letter queue of this queue
+                    # only, even if the exchange is shared with other queues
+                    amqp_arguments['x-dead-letter-exchange'] = dead_letter_exchange_name
+                    amqp_arguments['x-dead-letter-routing-key'] = queue_name
+                    dead_letter_arguments = {}  # type: Dict[str, Any]
+                    if ttl and not competing_consumer:
+                        # The dead-letter queue of a non-competing consumer would otherwise be left behind by every instance
+                        dead_letter_arguments['x-expires'] = int(ttl * 1000)
+                    await channel.exchange_declare(exchange_name=dead_letter_exchange_name, type_name='direct', passive=False, durable=True, auto_delete=dead_letter_exchange_auto_delete)
+                    await channel.queue_declare('{}.dlq'.format(queue_name), durable=True, arguments=dead_letter_arguments)
+                    await channel.queue_bind('{}.dlq'.format(queue_name), dead_letter_exchange_name, queue_name)
+
+                for retry_delay in sorted(set(retry_delays or [])):
+                    if not retry_delay:
+                        continue
+                    # Failed messages wait in a delay queue until their TTL has expired, and are then dead-lettered
+                    # back to the queue through the default exchange
+                    retry_arguments = {
+                        'x-message-ttl': int(retry_delay * 1000),
+                        'x-dead-letter-exchange': '',
+                        'x-dead-letter-routing-key': queue_name
+                    }  # type: Dict[str, Any]
+                    if ttl:
+                        retry_arguments['x-expires'] = int(max(ttl, retry_delay * 2) * 1000)
+                    await channel.queue_declare(cls.get_retry_queue_name(queue_name, retry_delay), durable=True, arguments=retry_arguments)
+
+                if shard_exchange_name:
+                    # Only one consumer at a time receives the messages of a shard
+                    amqp_arguments['x-single-active-consumer'] = True
+                    await channel.exchange_declare(exchange_name=shard_exchange_name, type_name='x-consistent-hash', passive=False, durable=True, auto_delete=False,
+                                                   arguments={'hash-header': SHARD_KEY_HEADER})
+                    await channel.exchange_bind(shard_exchange_name, exchange_name or 'amq.topic', cls.encode_routing_key(cls.get_routing_key(routing_key, context)))
+
                 try:
                     data = await channel.queue_declare(queue_name, passive=passive, durable=durable, exclusive=exclusive, auto_delete=auto_delete, arguments=amqp_arguments)
                     if max_consumers is not None and data.get('consumer_count', 0) >= max_consumers:
@@ -318,21 +936,145 @@ class AmqpTransport(Invoker):
                 except aioamqp.exceptions.ChannelClosed as e:
                     if e.args[0] == 405:
                         raise AmqpExclusiveQueueLockedException(str(e)) from e
+                    if e.args[0] == 406:
+                        # Arguments of an existing queue can't be changed, for example when retries or a dead-letter exchange
+                        # are added to a subscription which was previously deployed without them
+                        logging.getLogger('transport.amqp').warning('Unable to change arguments of existing queue [amqp] "{}", the queue must be deleted to be recreated ({})'.format(queue_name, e.args[1] if len(e.args) > 1 else str(e)))
                     raise AmqpException(str(e)) from e
 
-                await channel.queue_bind(queue_name, exchange_name or 'amq.topic', cls.encode_routing_key(cls.get_routing_key(routing_key, context)))
+                if shard_exchange_name:
+                    # The binding key of a consistent-hash exchange is the weight of the queue
+                    await channel.queue_bind(queue_name, shard_exchange_name, '1')
+                else:
+                    await channel.queue_bind(queue_name, exchange_name or 'amq.topic', cls.encode_routing_key(cls.get_routing_key(routing_key, context)))
 
                 return queue_name
 
-            def callback(routing_key: str, handler: Callable) -> Callable:
-                async def _callback(self: Any, body: bytes, envelope: Any, properties: Any) -> None:
-                    # await channel.basic_reject(delivery_tag, requeue=True)
-                    await asyncio.shield(handler(body.decode(), envelope.delivery_tag))
+            def callback(routing_key: str, handler: Callable, max_concurrency: int, acks: AmqpAckCoalescer, nack: Callable[..., Callable[[], Awaitable]]) -> Callable:
+                # Deliveries are handled in tasks of their own, so that the connection isn't blocked while a handler
+                # is running. At most max_concurrency handlers run at the same time, matching the prefetch_count of
+                # the consumer so that the broker won't deliver more messages than can be handled. The callback is
+                # awaited by the frame reader of the connection and must never block, which is why the semaphore is
+                # acquired within the task.
+                semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+
+                # Message protocols which declare themselves as binary are handed the message body as is
+                binary = bool(getattr(context.get('message_protocol'), 'binary', False))
+
+                async def _handle(body: bytes, envelope: Any, properties: Any) -> None:
+                    if not semaphore:
+                        await handler(body if binary else body.decode(), envelope.delivery_tag, acks, nack(body, properties, envelope.delivery_tag), properties)
+                        return
+                    async with semaphore:
+                        await handler(body if binary else body.decode(), envelope.delivery_tag, acks, nack(body, properties, envelope.delivery_tag), properties)
+
+                async def _callback(channel: Any, body: bytes, envelope: Any, properties: Any) -> None:
+                    acks.received(envelope.delivery_tag)
+                    task = asyncio.ensure_future(_handle(body, envelope, properties))
+                    cls.handler_tasks.add(task)
+
+                    def _done(t: asyncio.Future) -> None:
+                        cls.handler_tasks.discard(t)
+                        acks.release(envelope.delivery_tag)
+                        if not t.cancelled() and t.exception():
+                            # The message is redelivered by the broker if the channel was closed before it was acked
+                            logging.getLogger('transport.amqp').warning('Unable to acknowledge message [amqp] ({})'.format(str(t.exception())))
+
+                    task.add_done_callback(_done)
                 return _callback
 
-            for routing_key, exchange_name, competing, queue_name, func, handler in context.get('_amqp_subscribers', []):
-                queue_name = await declare_queue(routing_key, func, exchange_name=exchange_name, competing_consumer=competing, queue_name=queue_name)
-                await channel.basic_consume(callback(routing_key, handler), queue_name=queue_name)
+            def nack_message(acks: AmqpAckCoalescer, queue_name: str, retry_delays: List[int], max_retries: Optional[int], body: bytes, properties: Any,
+                             delivery_tag: int) -> Callable[[], Awaitable]:
+                async def _nack() -> None:
+                    if not retry_delays:
+                        await acks.nack(delivery_tag)
+                        return
+
+                    headers = dict(getattr(properties, 'headers', None) or {})
+                    retry_count = int(headers.get(RETRY_COUNT_HEADER) or 0)
+                    if max_retries is not None and retry_count >= max_retries:
+                        # Rejected without requeue, which routes the message to the dead-letter exchange of the queue
+                        await acks.nack(delivery_tag, requeue=False)
+                        return
+
+                    # The message is republished with the properties it was delivered with, so that reply_to, correlation_id and
+                    # headers such as the shard key are kept. The expiration of the message is dropped, since it would otherwise
+                    # cut the wait in the delay queue short.
+                    retry_properties = {}  # type: Dict[str, Any]
+                    for name in MESSAGE_PROPERTIES:
+                        value = getattr(properties, name, None)
+                        if value is not None:
+                            retry_properties[name] = value
+                    headers[RETRY_COUNT_HEADER] = retry_count + 1
+                    retry_properties['headers'] = headers
+                    retry_properties['delivery_mode'] = 2
+                    retry_properties.pop('expiration', None)
+
+                    # The message is only acked once the broker has confirmed the copy in the delay queue, and is
+                    # requeued if the copy couldn't be published
+                    retry_queue_name = cls.get_retry_queue_name(queue_name, retry_delays[min(retry_count, len(retry_delays) - 1)])
+                    try:
+                        publish_channel, publisher_confirms = await cls.get_publish_channel(cls, context)
+                        if publisher_confirms:
+                            confirm = await publisher_confirms.publish(body, '', retry_queue_name, properties=retry_properties)
+                            await confirm
+                        else:
+                            await publish_channel.basic_publish(body, '', retry_queue_name, properties=retry_properties)
+                    except (AssertionError, AmqpChannelError, AmqpChannelClosed, AmqpPublishNotConfirmed, aioamqp.exceptions.ChannelClosed, aioamqp.exceptions.AmqpClosedConnection) as e:
+                        logging.getLogger('transport.amqp').warning('Unable to publish message [amqp] to retry queue "{}" ({})'.format(retry_queue_name, str(e)))
+                        await acks.nack(delivery_tag)
+                        return
+                    await acks.ack(delivery_tag)
+
+                return _nack
+
+            async def start_consumer(routing_key: str, exchange_name: str, competing: Optional[bool], queue_name: Optional[str], func: Callable, handler: Callable,
+                                     prefetch_count: Optional[int], prefetch_size: Optional[int], retry_backoff: Optional[int], max_retries: Optional[int],
+                                     dead_letter_exchange_name: Optional[str], shard_exchange_name: Optional[str]) -> None:
+                # Each consumer has a channel of its own, so that flow control or a channel error on one consumer
+                # won't affect the others
+                protocol = cls.protocol
+                channel = await protocol.channel()
+                retry_delays = cls.get_retry_delays(retry_backoff, max_retries, context)
+                declared_queue_name = await declare_queue(channel, routing_key, func, exchange_name=exchange_name, competing_consumer=competing, queue_name=queue_name,
+                                                          retry_delays=retry_delays, max_retries=max_retries, dead_letter_exchange_name=dead_letter_exchange_name,
+                                                          shard_exchange_name=shard_exchange_name)
+
+                if shard_exchange_name:
+                    # Shards are consumed one message at a time, which keeps the order of messages per key
+                    prefetch_count = 1
+                elif prefetch_count is None:
+                    prefetch_count = context.get('options', {}).get('amqp', {}).get('prefetch_count', DEFAULT_PREFETCH_COUNT)
+                if prefetch_size is None:
+                    prefetch_size = context.get('options', {}).get('amqp', {}).get('prefetch_size', 0)
+                await channel.basic_qos(prefetch_size=int(prefetch_size or 0), prefetch_count=int(prefetch_count or 0), connection_global=False)
+
+                acks = AmqpAckCoalescer(channel, context.get('options', {}).get('amqp', {}).get('ack_batch_size', DEFAULT_ACK_BATCH_SIZE),
+                                        context.get('options', {}).get('amqp', {}).get('ack_linger_time', DEFAULT_ACK_LINGER_TIME))
+                cls.ack_coalescers.add(acks)
+                nack = functools.partial(nack_message, acks, str(declared_queue_name), retry_delays, max_retries)
+                await channel.basic_consume(callback(routing_key, handler, int(prefetch_count or 0), acks, nack), queue_name=declared_queue_name)
+
+                async def _recover_channel() -> None:
+                    # A consumer channel which is closed while the connection is still open is reopened on its own
+                    await channel.close_event.wait()
+                    cls.ack_coalescers.discard(acks)
+                    while cls.protocol is protocol and cls.is_connected(cls):
+                        logging.getLogger('transport.amqp').warning('Consumer channel closed [amqp] for queue "{}" - reopening'.format(declared_queue_name))
+                        await asyncio.sleep(1)
+                        try:
+                            await start_consumer(routing_key, exchange_name, competing, queue_name, func, handler, prefetch_count, prefetch_size, retry_backoff, max_retries, dead_letter_exchange_name, shard_exchange_name)
+                            return
+                        except Exception as e:
+                            logging.getLogger('transport.amqp').warning('Unable to reopen consumer channel [amqp] for queue "{}" ({})'.format(declared_queue_name, str(e)))
+
+                asyncio.ensure_future(_recover_channel())
+
+            for routing_key, exchange_name, competing, queue_name, func, handler, prefetch_count, prefetch_size, retry_backoff, max_retries, dead_letter_exchange_name, shard_exchange_name in context.get('_amqp_subscribers', []):
+                await start_consumer(routing_key, exchange_name, competing, queue_name, func, handler, prefetch_count, prefetch_size, retry_backoff, max_retries, dead_letter_exchange_name, shard_exchange_name)
+
+        # The recorded subscriptions are used to restore the consumers when the connection has been recovered
+        context['_amqp_restore_consumers'] = _subscribe
 
         return _subscribe
 
@@ -340,3 +1082,5 @@ class AmqpTransport(Invoker):
 amqp = AmqpTransport.decorator(AmqpTransport.subscribe_handler)
 amqp_publish = AmqpTransport.publish
 publish = AmqpTransport.publish
+amqp_rpc = AmqpTransport.rpc
+amqp_rpc_handler = AmqpTransport.decorator(AmqpTransport.subscribe_rpc_handler)
@@ -8,13 +8,43 @@ import hashlib
 import re
 import binascii
 import ujson
-import uuid
 import inspect
+import bisect
+import os
+from aiobotocore.config import AioConfig
 from botocore.parsers import ResponseParserError
-from typing import Any, Dict, Union, Optional, Callable, List, Tuple, Match, Awaitable
+from typing import Any, Dict, Union, Optional, Callable, List, Tuple, Match, Awaitable, Set, NamedTuple
 from tomodachi.invoker import Invoker
+from tomodachi.helpers.blob_store import BlobStore, LocalFileBlobStore, S3BlobStore, BlobCache
+from tomodachi.transport.aws_sns_sqs_memory import AWSSNSSQSMemoryBackend
 
 DRAIN_MESSAGE_PAYLOAD = '__TOMODACHI_DRAIN__cdab4416-1727-4603-87c9-0ff8dddf1f22__'
+MAX_BATCH_ENTRIES = 10
+MAX_DELETE_MESSAGE_ATTEMPTS = 3
+MAX_SEND_MESSAGE_ATTEMPTS = 3
+DEFAULT_VISIBILITY_TIMEOUT = 30
+DEFAULT_WAIT_TIME_SECONDS = 20
+DEFAULT_MAX_IDLE_BACKOFF = 300
+DEFAULT_MAX_POOL_CONNECTIONS = 50
+MAX_VISIBILITY_TIMEOUT = 43200
+DEFAULT_MAX_RECEIVE_COUNT = 5
+MAX_BATCH_SIZE = 262144
+FIFO_SUFFIX = '.fifo'
+MESSAGE_NOT_HANDLED = object()
+DEAD_LETTER_QUEUE_SUFFIX = '-dlq'
+DEFAULT_WILDCARD_TOPIC_REFRESH_INTERVAL = 300
+DEFAULT_CLAIM_CHECK_THRESHOLD = 200000
+DEFAULT_CLAIM_CHECK_CACHE_SIZE = 64 * 1024 * 1024
+CLAIM_CHECK_KEY = '__tomodachi_claim_check__'
+CLAIM_CHECK_PREFIX = '{"__tomodachi_claim_check__":'
+SNS_ENVELOPE_PATTERN = re.compile(r'^\s*{\s*"Type"\s*:\s*"Notification"\s*,')
+
+# The subscription of a handler, as registered by subscribe_handler and set up by subscribe
+AWSSNSSQSSubscriber = NamedTuple('AWSSNSSQSSubscriber', [('topic', Optional[str]), ('competing', Optional[bool]), ('queue_name', Optional[str]), ('func', Any), ('handler', Callable),
+                                                         ('pollers', Optional[int]), ('max_pollers', Optional[int]), ('max_in_flight', Optional[int]), ('visibility_timeout', Optional[int]),
+                                                         ('max_receive_count', Optional[int]), ('dead_letter_queue_name', Optional[str]), ('raw_message_delivery', Optional[bool]),
+                                                         ('filter_policy', Optional[Union[str, Dict]]), ('group_concurrency', Optional[int]), ('wait_time_seconds', Optional[int]),
+                                                         ('idle_backoff', Optional[float])])
 
 
 class AWSSNSSQSException(Exception):
@@ -40,11 +70,28 @@ class AWSSNSSQSInternalServiceException(AWSSNSSQSInternalServiceError):
 
 class AWSSNSSQSTransport(Invoker):
     clients = None
+    session = None  # type: Any
+    session_loop = None  # type: Any
     topics = {}  # type: Dict[str, str]
     close_waiter = None
+    topic_tasks = None  # type: Optional[Dict[str, asyncio.Future]]
+    queue_urls = None  # type: Optional[Dict[str, str]]
+    queue_url_tasks = None  # type: Optional[Dict[str, asyncio.Future]]
+    queue_attributes = None  # type: Optional[Dict[str, Dict]]
+    topic_catalog = None  # type: Optional[List[Tuple[str, str]]]
+    topic_catalog_names = None  # type: Optional[List[str]]
+    topic_catalog_updated_at = 0.0
+    topic_catalog_task = None  # type: Optional[asyncio.Future]
+    wildcard_subscription_task = None  # type: Optional[asyncio.Future]
+    blob_cache = None  # type: Optional[BlobCache]
+    queue_metrics = {}  # type: Dict[str, Dict[str, Union[int, float]]]
+    topic_cache_loaded = False
+    topic_cache_task = None  # type: Optional[asyncio.Future]
+    topic_cache_pending = False
 
     @classmethod
-    async def publish(cls, service: Any, data: Any, topic: str, wait: bool = True) -> None:
+    async def publish(cls, service: Any, data: Any, topic: str, wait: bool = True, attributes: Optional[Dict] = None, message_group_id: Optional[str] = None,
+                      message_deduplication_id: Optional[str] = None) -> None:
         message_protocol = getattr(service, 'message_protocol', None)
 
         payload = data
@@ -53,10 +100,26 @@ class AWSSNSSQSTransport(Invoker):
             if build_message_func:
                 payload = await build_message_func(service, topic, data)
 
+        payload = await cls.store_payload(cls, payload, service.context)
         topic_arn = await cls.create_topic(cls, topic, service.context)
+        message_attributes = cls.get_message_attributes(attributes) if attributes else None
+        fifo_kwargs = cls.get_fifo_message_kwargs(topic, payload, message_group_id, message_deduplication_id)
 
         async def _publish_message() -> None:
-            await cls.publish_message(cls, topic_arn, payload, service.context)
+            try:
+                await cls.publish_message(cls, topic_arn, payload, service.context, message_attributes=message_attributes, **fifo_kwargs)
+                return
+            except AWSSNSSQSException as e:
+                if not cls.is_not_found_error(e.__cause__):
+                    raise
+
+            # The topic has been deleted since its ARN was cached, which is why it's created again before the message
+            # is published once more
+            logging.getLogger('transport.aws_sns_sqs').warning('Topic [sns] "{}" not found on AWS - recreating topic'.format(topic))
+            if cls.topics and cls.topics.get(topic) == topic_arn:
+                cls.topics.pop(topic, None)
+            recreated_topic_arn = await cls.create_topic(cls, topic, service.context)
+            await cls.publish_message(cls, recreated_topic_arn, payload, service.context, message_attributes=message_attributes, **fifo_kwargs)
 
         if wait:
             await _publish_message()
@@ -64,6 +127,119 @@ class AWSSNSSQSTransport(Invoker):
             loop = asyncio.get_event_loop()  # type: Any
             loop.create_task(_publish_message())
 
+    @classmethod
+    async def send(cls, service: Any, data: Any, queue_name: str, wait: bool = True, attributes: Optional[Dict] = None, delay_seconds: Optional[int] = None,
+                   message_group_id: Optional[str] = None, message_deduplication_id: Optional[str] = None) -> None:
+        payload = await cls.build_queue_message(cls, service, data, queue_name)
+        queue_url = await cls.get_queue_url(cls, queue_name, service.context)
+        message_attributes = cls.get_message_attributes(attributes, sqs=True) if attributes else None
+        fifo_kwargs = cls.get_fifo_message_kwargs(queue_name, payload, message_group_id, message_deduplication_id)
+
+        async def _send_message() -> None:
+            try:
+                await cls.send_message(cls, queue_url, payload, service.context, message_attributes=message_attributes, delay_seconds=delay_seconds, **fifo_kwargs)
+            except AWSSNSSQSException as e:
+                if not cls.is_non_existent_queue_error(e.__cause__):
+                    raise
+                # The queue has been deleted since its url was cached, which is resolved again (recreating the queue) before a second attempt
+                new_queue_url = await cls.get_queue_url(cls, queue_name, service.context, refresh=True)
+                await cls.send_message(cls, new_queue_url, payload, service.context, message_attributes=message_attributes, delay_seconds=delay_seconds, **fifo_kwargs)
+
+        if wait:
+            await _send_message()
+        else:
+            loop = asyncio.get_event_loop()  # type: Any
+            loop.create_task(_send_message())
+
+    @classmethod
+    async def send_batch(cls, service: Any, data_list: List, queue_name: str, wait: bool = True, attributes: Optional[Dict] = None, delay_seconds: Optional[int] = None,
+                         message_group_id: Optional[str] = None) -> None:
+        payloads = [await cls.build_queue_message(cls, service, data, queue_name) for data in data_list]
+        queue_url = await cls.get_queue_url(cls, queue_name, service.context)
+        message_attributes = cls.get_message_attributes(attributes, sqs=True) if attributes else None
+
+        # Messages are sent in batches of at most 10 entries, and at most 256 KB in total
+        batches = []  # type: List[List[str]]
+        batch_size = 0
+        for payload in payloads:
+            size = len(payload.encode('utf-8')) if isinstance(payload, str) else len(payload)
+            if not batches or len(batches[-1]) >= MAX_BATCH_ENTRIES or batch_size + size > MAX_BATCH_SIZE:
+                batches.append([])
+                batch_size = 0
+            batches[-1].append(payload)
+            batch_size += size
+
+        async def _send_message_batches() -> None:
+            url = queue_url
+            refreshed = False
+            for batch in batches:
+                fifo_kwargs_list = [cls.get_fifo_message_kwargs(queue_name, payload, message_group_id) for payload in batch]
+                try:
+                    await cls.send_message_batch(cls, url, batch, service.context, message_attributes=message_attributes, delay_seconds=delay_seconds, fifo_kwargs_list=fifo_kwargs_list)
+                except AWSSNSSQSException as e:
+                    if refreshed or not cls.is_non_existent_queue_error(e.__cause__):
+                        raise
+                    # The queue has been deleted since its url was cached, which is resolved again (recreating the queue) before a second attempt
+                    refreshed = True
+                    url = await cls.get_queue_url(cls, queue_name, service.context, refresh=True)
+                    await cls.send_message_batch(cls, url, batch, service.context, message_attributes=message_attributes, delay_seconds=delay_seconds, fifo_kwargs_list=fifo_kwargs_list)
+
+        if wait:
+            await _send_message_batches()
+        else:
+            loop = asyncio.get_event_loop()  # type: Any
+            loop.create_task(_send_message_batches())
+
+    async def build_queue_message(cls: Any, service: Any, data: Any, queue_name: str) -> Any:
+        message_protocol = getattr(service, 'message_protocol', None)
+
+        payload = data
+        if message_protocol:
+            build_message_func = getattr(message_protocol, 'build_message', None)
+            if build_message_func:
+                payload = await build_message_func(service, queue_name, data)
+
+        return await cls.store_payload(cls, payload, service.context)
+
+    @classmethod
+    def get_message_attributes(cls, attributes: Dict, sqs: bool = False) -> Dict:
+        message_attributes = {}
+        for name, value in attributes.items():
+            if value is None:
+                continue
+            if isinstance(value, dict) and value.get('DataType'):
+                message_attributes[name] = value
+            elif isinstance(value, bool):
+                message_attributes[name] = {'DataType': 'String', 'StringValue': 'true' if value else 'false'}
+            elif isinstance(value, (int, float)):
+                message_attributes[name] = {'DataType': 'Number', 'StringValue': str(value)}
+            elif isinstance(value, (list, tuple, set)):
+                # SQS has no array data type, which is why lists are sent as JSON strings to queues
+                message_attributes[name] = {'DataType': 'String.Array' if not sqs else 'String', 'StringValue': ujson.dumps(list(value))}
+            elif isinstance(value, bytes):
+                message_attributes[name] = {'DataType': 'Binary', 'BinaryValue': value}
+            else:
+                message_attributes[name] = {'DataType': 'String', 'StringValue': str(value)}
+
+        return message_attributes
+
+    @classmethod
+    def get_filter_policy(cls, filter_policy: Optional[Union[str, Dict]]) -> Optional[str]:
+        if filter_policy is None:
+            return None
+        if isinstance(filter_policy, str):
+            return filter_policy
+        return ujson.dumps(filter_policy, sort_keys=True)
+
+    async def sqs_handler(cls: Any, obj: Any, context: Dict, func: Any, queue_name: str, callback_kwargs: Optional[Union[list, set, tuple]] = None, pollers: Optional[int] = None, max_pollers: Optional[int] = None,
+                          max_in_flight: Optional[int] = None, visibility_timeout: Optional[int] = None, retry_backoff: Optional[int] = None, max_receive_count: Optional[int] = None,
+                          dead_letter_queue_name: Optional[str] = None, group_concurrency: Optional[int] = None, wait_time_seconds: Optional[int] = None, idle_backoff: Optional[float] = None,
+                          **kwargs: Any) -> Any:
+        return await cls.subscribe_handler(cls, obj, context, func, None, callback_kwargs=callback_kwargs, competing=True, queue_name=queue_name, pollers=pollers, max_pollers=max_pollers,
+                                           max_in_flight=max_in_flight, visibility_timeout=visibility_timeout, retry_backoff=retry_backoff, max_receive_count=max_receive_count,
+                                           dead_letter_queue_name=dead_letter_queue_name, raw_message_delivery=True, group_concurrency=group_concurrency,
+                                           wait_time_seconds=wait_time_seconds, idle_backoff=idle_backoff, **kwargs)
+
     @classmethod
     def get_topic_name(cls, topic: str, context: Dict) -> str:
         if context.get('options', {}).get('aws_sns_sqs', {}).get('topic_prefix'):
@@ -82,8 +258,25 @@ class AWSSNSSQSTransport(Invoker):
         def encode(match: Match) -> str:
             return '___' + binascii.hexlify(match.group(1).encode('utf-8')).decode('utf-8') + '_'
 
+        # The .fifo suffix of FIFO topics is kept as is, since AWS requires the names of FIFO topics to end with it
+        if topic.endswith(FIFO_SUFFIX):
+            return '{}{}'.format(re.sub(r'([^a-zA-Z0-9_*#-])', encode, topic[:-len(FIFO_SUFFIX)]), FIFO_SUFFIX)
         return re.sub(r'([^a-zA-Z0-9_*#-])', encode, topic)
 
+    @classmethod
+    def is_fifo(cls, name: Optional[str]) -> bool:
+        return bool(name and name.endswith(FIFO_SUFFIX))
+
+    @classmethod
+    def get_fifo_message_kwargs(cls, name: str, message: Any, message_group_id: Optional[str] = None, message_deduplication_id: Optional[str] = None) -> Dict:
+        # Messages to FIFO topics and queues are grouped by the topic or queue name and deduplicated on their
+        # content, unless a message group id and deduplication id are specified.
+        if not cls.is_fifo(name):
+            return {}
+        if not message_deduplication_id:
+            message_deduplication_id = hashlib.sha256(message.encode('utf-8') if isinstance(message, str) else message).hexdigest()
+        return {'MessageGroupId': message_group_id or name[:-len(FIFO_SUFFIX)] or name, 'MessageDeduplicationId': message_deduplication_id}
+
     @classmethod
     def get_queue_name(cls, topic: str, func_name: str, _uuid: str, competing_consumer: bool, context: Dict) -> str:
         if not competing_consumer:
@@ -101,7 +294,21 @@ class AWSSNSSQSTransport(Invoker):
             return '{}{}'.format(context.get('options', {}).get('aws_sns_sqs', {}).get('queue_name_prefix'), queue_name)
         return queue_name
 
-    async def subscribe_handler(cls: Any, obj: Any, context: Dict, func: Any, topic: str, callback_kwargs: Optional[Union[list, set, tuple]] = None, competing: Optional[bool] = None, queue_name: Optional[str] = None, **kwargs: Any) -> Any:
+    @classmethod
+    def get_dead_letter_queue_name(cls, queue_name: str, dead_letter_queue_name: Optional[str], context: Dict) -> str:
+        if dead_letter_queue_name:
+            return cls.prefix_queue_name(dead_letter_queue_name, context)
+        if cls.is_fifo(queue_name):
+            return '{}{}{}'.format(queue_name[:-len(FIFO_SUFFIX)], DEAD_LETTER_QUEUE_SUFFIX, FIFO_SUFFIX)
+        return '{}{}'.format(queue_name, DEAD_LETTER_QUEUE_SUFFIX)
+
+    @classmethod
+    def get_retry_backoff(cls, receive_count: int, retry_backoff: int, context: Dict) -> int:
+        max_retry_backoff = context.get('options', {}).get('aws_sns_sqs', {}).get('max_retry_backoff', 900)
+        return int(min(retry_backoff * 2 ** (max(receive_count, 1) - 1), max_retry_backoff, MAX_VISIBILITY_TIMEOUT))
+
+    async def subscribe_handler(cls: Any, obj: Any, context: Dict, func: Any, topic: Optional[str], callback_kwargs: Optional[Union[list, set, tuple]] = None, competing: Optional[bool] = None, queue_name: Optional[str] = None, pollers: Optional[int] = None, max_pollers: Optional[int] = None, max_in_flight: Optional[int] = None, visibility_timeout: Optional[int] = None, retry_backoff: Optional[int] = None, max_receive_count: Optional[int] = None, dead_letter_queue_name: Optional[str] = None, raw_message_delivery: Optional[bool] = None, filter_policy: Optional[Union[str, Dict]] = None,
+                                group_concurrency: Optional[int] = None, wait_time_seconds: Optional[int] = None, idle_backoff: Optional[float] = None, **kwargs: Any) -> Any:
         parser_kwargs = kwargs
         message_protocol = context.get('message_protocol')
 
@@ -111,11 +318,35 @@ class AWSSNSSQSTransport(Invoker):
             if protocol_kwargs_validation_func:
                 protocol_kwargs_validation_func(**parser_kwargs)
 
-        async def handler(payload: Optional[str], receipt_handle: Optional[str] = None, queue_url: Optional[str] = None) -> Any:
+        # Subscriptions with retries or a dead-letter queue keep every message whose handler failed on the queue, so
+        # that messages which keep failing are moved to the dead-letter queue after max_receive_count receives
+        retry_failed_messages = bool(retry_backoff or max_receive_count or dead_letter_queue_name)
+
+        async def handle_exception(e: Exception, receipt_handle: Optional[str], queue_url: Optional[str], receive_count: Optional[int], message_key: Optional[str]) -> Any:
+            logging.getLogger('exception').exception('Uncaught exception: {}'.format(str(e)))
+            if retry_failed_messages or issubclass(e.__class__, (AWSSNSSQSInternalServiceError, AWSSNSSQSInternalServiceErrorException, AWSSNSSQSInternalServiceException)):
+                if message_key:
+                    context['_aws_sns_sqs_received_messages'].pop(message_key, None)
+                if retry_backoff:
+                    await cls.change_message_visibility(cls, receipt_handle, queue_url, cls.get_retry_backoff(receive_count or 1, retry_backoff, context), context)
+                return MESSAGE_NOT_HANDLED
+            await cls.delete_message(cls, receipt_handle, queue_url, context)
+            return None
+
+        async def handler(payload: Optional[str], receipt_handle: Optional[str] = None, queue_url: Optional[str] = None, receive_count: Optional[int] = None) -> Any:
+            # Drain messages are no longer published on shutdown, but may still be received from older services
             if not payload or payload == DRAIN_MESSAGE_PAYLOAD:
                 await cls.delete_message(cls, receipt_handle, queue_url, context)
                 return
 
+            claim_check = cls.get_claim_check(payload)
+            if claim_check:
+                try:
+                    payload = await cls.fetch_payload(cls, claim_check, context)
+                except Exception as e:
+                    logging.getLogger('transport.aws_sns_sqs').warning('Unable to fetch message payload from blob store ({})'.format(str(e)))
+                    return MESSAGE_NOT_HANDLED
+
             _callback_kwargs = callback_kwargs  # type: Any
             values = inspect.getfullargspec(func)
             if not _callback_kwargs:
@@ -175,25 +406,13 @@ class AWSSNSSQSTransport(Invoker):
                     kwargs = {}
                     routine = func(*(obj,), **kwargs)
             except Exception as e:
-                logging.getLogger('exception').exception('Uncaught exception: {}'.format(str(e)))
-                if issubclass(e.__class__, (AWSSNSSQSInternalServiceError, AWSSNSSQSInternalServiceErrorException, AWSSNSSQSInternalServiceException)):
-                    if message_key:
-                        del context['_aws_sns_sqs_received_messages'][message_key]
-                    return
-                await cls.delete_message(cls, receipt_handle, queue_url, context)
-                return
+                return await handle_exception(e, receipt_handle, queue_url, receive_count, message_key)
 
             if isinstance(routine, Awaitable):
                 try:
                     return_value = await routine
                 except Exception as e:
-                    logging.getLogger('exception').exception('Uncaught exception: {}'.format(str(e)))
-                    if issubclass(e.__class__, (AWSSNSSQSInternalServiceError, AWSSNSSQSInternalServiceErrorException, AWSSNSSQSInternalServiceException)):
-                        if message_key:
-                            del context['_aws_sns_sqs_received_messages'][message_key]
-                        return
-                    await cls.delete_message(cls, receipt_handle, queue_url, context)
-                    return
+                    return await handle_exception(e, receipt_handle, queue_url, receive_count, message_key)
             else:
                 return_value = routine
 
@@ -202,18 +421,59 @@ class AWSSNSSQSTransport(Invoker):
             return return_value
 
         context['_aws_sns_sqs_subscribers'] = context.get('_aws_sns_sqs_subscribers', [])
-        context['_aws_sns_sqs_subscribers'].append((topic, competing, queue_name, func, handler))
+        context['_aws_sns_sqs_subscribers'].append(AWSSNSSQSSubscriber(topic=topic, competing=competing, queue_name=queue_name, func=func, handler=handler, pollers=pollers, max_pollers=max_pollers,
+                                                                       max_in_flight=max_in_flight, visibility_timeout=visibility_timeout, max_receive_count=max_receive_count,
+                                                                       dead_letter_queue_name=dead_letter_queue_name, raw_message_delivery=raw_message_delivery, filter_policy=filter_policy,
+                                                                       group_concurrency=group_concurrency, wait_time_seconds=wait_time_seconds, idle_backoff=idle_backoff))
 
         start_func = cls.subscribe(cls, obj, context)
         return (await start_func) if start_func else None
 
+    @classmethod
+    def get_client_config(cls, context: Dict) -> AioConfig:
+        client_config = context.get('options', {}).get('aws_sns_sqs', {}).get('client_config') or {}
+
+        config_kwargs = {'max_pool_connections': client_config.get('max_pool_connections', DEFAULT_MAX_POOL_CONNECTIONS)}  # type: Dict[str, Any]
+        if client_config.get('connect_timeout') is not None:
+            config_kwargs['connect_timeout'] = client_config.get('connect_timeout')
+        if client_config.get('read_timeout') is not None:
+            config_kwargs['read_timeout'] = client_config.get('read_timeout')
+
+        retries = {}  # type: Dict[str, Any]
+        if client_config.get('max_attempts') is not None:
+            retries['max_attempts'] = client_config.get('max_attempts')
+        if client_config.get('retry_mode'):
+            retries['mode'] = client_config.get('retry_mode')
+        if retries:
+            config_kwargs['retries'] = retries
+
+        connector_args = {}  # type: Dict[str, Any]
+        if client_config.get('keepalive_timeout') is not None:
+            connector_args['keepalive_timeout'] = client_config.get('keepalive_timeout')
+
+        return AioConfig(connector_args=connector_args or None, **config_kwargs)
+
     def create_client(cls: Any, name: str, context: Dict) -> None:
         logging.getLogger('botocore.vendored.requests.packages.urllib3.connectionpool').setLevel(logging.WARNING)
 
+        # The in-memory backend emulates SNS, SQS and S3 within the process, for tests and benchmarks
+        backend = context.get('options', {}).get('aws_sns_sqs', {}).get('backend')
+        if backend == 'memory' or isinstance(backend, AWSSNSSQSMemoryBackend):
+            if not cls.clients:
+                cls.clients = {}
+            cls.clients[name] = (backend if isinstance(backend, AWSSNSSQSMemoryBackend) else AWSSNSSQSMemoryBackend.get_default_backend()).create_client(name)
+            return
+
+        # A single session is shared by all clients, as long as the event loop stays the same
+        loop = asyncio.get_event_loop()
+        if not cls.session or cls.session_loop is not loop:
+            cls.session = aiobotocore.get_session(loop=loop)
+            cls.session_loop = loop
+            cls.clients = None
+        session = cls.session
+
         if not cls.clients:
             cls.clients = {}
-        loop = asyncio.get_event_loop()
-        session = aiobotocore.get_session(loop=loop)
 
         config_base = context.get('options', {}).get('aws_sns_sqs', context.get('options', {}).get('aws', {}))
         aws_config_base = context.get('options', {}).get('aws', {})
@@ -232,26 +492,206 @@ class AWSSNSSQSTransport(Invoker):
             context.get('options', {}).get('aws_endpoint_urls', {}).get(name)
 
         try:
-            cls.clients[name] = session.create_client(name, region_name=region_name, aws_secret_access_key=aws_secret_access_key, aws_access_key_id=aws_access_key_id, endpoint_url=endpoint_url)
+            cls.clients[name] = session.create_client(name, region_name=region_name, aws_secret_access_key=aws_secret_access_key, aws_access_key_id=aws_access_key_id, endpoint_url=endpoint_url,
+                                                      config=cls.get_client_config(context))
         except (botocore.exceptions.PartialCredentialsError, botocore.exceptions.NoRegionError) as e:
             error_message = str(e)
             logging.getLogger('transport.aws_sns_sqs').warning('Invalid credentials [{}] to AWS ({})'.format(name, error_message))
             raise AWSSNSSQSConnectionException(error_message, log_level=context.get('log_level')) from e
 
+    def get_blob_store(cls: Any, context: Dict) -> Optional[BlobStore]:
+        claim_check_store = context.get('options', {}).get('aws_sns_sqs', {}).get('claim_check_store')
+        if not claim_check_store:
+            return None
+        if isinstance(claim_check_store, BlobStore):
+            return claim_check_store
+
+        if claim_check_store == LocalFileBlobStore.name:
+            claim_check_path = context.get('options', {}).get('aws_sns_sqs', {}).get('claim_check_path')
+            if not claim_check_path:
+                raise AWSSNSSQSException('Missing claim_check_path for file blob store', log_level=context.get('log_level'))
+            return LocalFileBlobStore(claim_check_path)
+
+        if claim_check_store == S3BlobStore.name:
+            claim_check_bucket = context.get('options', {}).get('aws_sns_sqs', {}).get('claim_check_bucket')
+            if not claim_check_bucket:
+                raise AWSSNSSQSException('Missing claim_check_bucket for s3 blob store', log_level=context.get('log_level'))
+            if not cls.clients or not cls.clients.get('s3'):
+                cls.create_client(cls, 's3', context)
+            return S3BlobStore(cls.clients.get('s3'), claim_check_bucket)
+
+        raise AWSSNSSQSException('Invalid claim_check_store "{}"'.format(claim_check_store), log_level=context.get('log_level'))
+
+    def get_blob_cache(cls: Any, context: Dict) -> BlobCache:
+        if not cls.blob_cache:
+            cls.blob_cache = BlobCache(context.get('options', {}).get('aws_sns_sqs', {}).get('claim_check_cache_size', DEFAULT_CLAIM_CHECK_CACHE_SIZE))
+        blob_cache = cls.blob_cache  # type: BlobCache
+        return blob_cache
+
+    async def store_payload(cls: Any, payload: Any, context: Dict) -> Any:
+        # Payloads above the claim check threshold are written to the blob store and replaced with a reference
+        blob_store = cls.get_blob_store(cls, context)
+        if not blob_store or not isinstance(payload, str):
+            return payload
+
+        data = payload.encode('utf-8')
+        if len(data) < context.get('options', {}).get('aws_sns_sqs', {}).get('claim_check_threshold', DEFAULT_CLAIM_CHECK_THRESHOLD):
+            return payload
+
+        key = blob_store.generate_key(context.get('options', {}).get('aws_sns_sqs', {}).get('claim_check_key_prefix'))
+        try:
+            await blob_store.put(key, data)
+        except Exception as e:
+            error_message = str(e)
+            logging.getLogger('transport.aws_sns_sqs').warning('Unable to store message payload in blob store ({})'.format(error_message))
+            raise AWSSNSSQSException(error_message, log_level=context.get('log_level')) from e
+
+        cls.get_blob_cache(cls, context).add('{}:{}'.format(blob_store.name, key), data)
+
+        return ujson.dumps({CLAIM_CHECK_KEY: {'store': blob_store.name, 'key': key, 'size': len(data)}})
+
+    @classmethod
+    def get_claim_check(cls, payload: Any) -> Optional[Dict]:
+        # Only a payload which consists of nothing but the reserved key set by store_payload is a claim check, so that
+        # published JSON payloads are never mistaken for a reference
+        if not isinstance(payload, str) or not payload.startswith(CLAIM_CHECK_PREFIX):
+            return None
+        try:
+            data = ujson.loads(payload)
+        except ValueError:
+            return None
+        if not isinstance(data, dict) or len(data) != 1:
+            return None
+        reference = data.get(CLAIM_CHECK_KEY)
+        if not isinstance(reference, dict) or not isinstance(reference.get('store'), str) or not isinstance(reference.get('key'), str):
+            return None
+        return reference
+
+    async def fetch_payload(cls: Any, reference: Dict, context: Dict) -> str:
+        blob_store = cls.get_blob_store(cls, context)
+        if not blob_store or blob_store.name != reference.get('store'):
+            raise AWSSNSSQSException('No blob store configured for "{}" claim check'.format(reference.get('store')), log_level=context.get('log_level'))
+
+        key = reference.get('key')
+
+        async def _fetch() -> bytes:
+            data = await blob_store.get(key)  # type: bytes
+            return data
+
+        data = await cls.get_blob_cache(cls, context).get('{}:{}'.format(blob_store.name, key), _fetch)  # type: bytes
+        return data.decode('utf-8')
+
+    def load_topic_cache(cls: Any, context: Dict) -> None:
+        # Topic ARNs resolved by earlier runs are read from options.aws_sns_sqs.topic_cache_file, if specified,
+        # so that publishing won't need any CreateTopic calls on startup.
+        if cls.topic_cache_loaded:
+            return
+        cls.topic_cache_loaded = True
+
+        topic_cache_file = context.get('options', {}).get('aws_sns_sqs', {}).get('topic_cache_file')
+        if not topic_cache_file or not os.path.isfile(topic_cache_file):
+            return
+
+        try:
+            with open(topic_cache_file, 'r') as file:
+                topic_cache = ujson.loads(file.read())
+        except (OSError, ValueError) as e:
+            logging.getLogger('transport.aws_sns_sqs').warning('Unable to read topic cache file "{}" ({})'.format(topic_cache_file, str(e)))
+            return
+
+        if not cls.topics:
+            cls.topics = {}
+        topic_prefix = context.get('options', {}).get('aws_sns_sqs', {}).get('topic_prefix') or ''
+        for topic_name, topic_arn in topic_cache.items():
+            if not topic_name.startswith(topic_prefix) or not topic_arn or not isinstance(topic_arn, str):
+                continue
+            topic = topic_name[len(topic_prefix):]
+            if not cls.topics.get(topic):
+                cls.topics[topic] = topic_arn
+
+    def store_topic_cache(cls: Any, context: Dict) -> Optional[asyncio.Future]:
+        # The cache file is written in an executor to keep file I/O off the event loop. Topics resolved while a write
+        # is in progress are stored by a single write once it's done.
+        topic_cache_file = context.get('options', {}).get('aws_sns_sqs', {}).get('topic_cache_file')
+        if not topic_cache_file:
+            return None
+
+        cls.topic_cache_pending = True
+        task = cls.topic_cache_task  # type: Optional[asyncio.Future]
+        if task and not task.done():
+            return task
+
+        async def _store() -> None:
+            loop = asyncio.get_event_loop()  # type: Any
+            while cls.topic_cache_pending:
+                cls.topic_cache_pending = False
+                topic_cache = {cls.get_topic_name(topic, context): topic_arn for topic, topic_arn in (cls.topics or {}).items()
+                               if topic_arn and isinstance(topic_arn, str) and not re.search(r'([*#])', topic)}
+                await loop.run_in_executor(None, cls.write_topic_cache, topic_cache_file, topic_cache)
+
+        task = asyncio.ensure_future(_store())
+        cls.topic_cache_task = task
+        return task
+
+    @classmethod
+    def write_topic_cache(cls, topic_cache_file: str, topic_cache: Dict[str, str]) -> None:
+        # Topics of other services sharing the cache file are kept, and the file is replaced in a single step
+        stored_topic_cache = {}  # type: Dict[str, str]
+        if os.path.isfile(topic_cache_file):
+            try:
+                with open(topic_cache_file, 'r') as file:
+                    stored_topic_cache = ujson.loads(file.read())
+            except (OSError, ValueError):
+                pass
+        if not isinstance(stored_topic_cache, dict):
+            stored_topic_cache = {}
+        stored_topic_cache.update(topic_cache)
+
+        try:
+            with open('{}.tmp'.format(topic_cache_file), 'w') as file:
+                file.write(ujson.dumps(stored_topic_cache))
+            os.replace('{}.tmp'.format(topic_cache_file), topic_cache_file)
+        except OSError as e:
+            logging.getLogger('transport.aws_sns_sqs').warning('Unable to write topic cache file "{}" ({})'.format(topic_cache_file, str(e)))
+
+    def invalidate_topic_cache(cls: Any, context: Dict) -> None:
+        cls.topics = {}
+        topic_cache_file = context.get('options', {}).get('aws_sns_sqs', {}).get('topic_cache_file')
+        if topic_cache_file and os.path.isfile(topic_cache_file):
+            try:
+                os.remove(topic_cache_file)
+            except OSError:
+                pass
+
     async def create_topic(cls: Any, topic: str, context: Dict) -> str:
         if not cls.topics:
             cls.topics = {}
+        cls.load_topic_cache(cls, context)
         if cls.topics.get(topic):
             topic_arn = cls.topics.get(topic)
             if topic_arn and isinstance(topic_arn, str):
                 return topic_arn
 
+        # Concurrent calls for the same topic will await a single in-flight CreateTopic request
+        if not cls.topic_tasks:
+            cls.topic_tasks = {}
+        if not cls.topic_tasks.get(topic):
+            task = asyncio.ensure_future(cls.create_topic_arn(cls, topic, context))
+            cls.topic_tasks[topic] = task
+            task.add_done_callback(lambda t: cls.topic_tasks.pop(topic, None))
+
+        return await asyncio.shield(cls.topic_tasks[topic])
+
+    async def create_topic_arn(cls: Any, topic: str, context: Dict) -> str:
         if not cls.clients or not cls.clients.get('sns'):
             cls.create_client(cls, 'sns', context)
         client = cls.clients.get('sns')
 
         try:
-            response = await asyncio.wait_for(client.create_topic(Name=cls.encode_topic(cls.get_topic_name(topic, context))), timeout=30)
+            if cls.is_fifo(topic):
+                response = await asyncio.wait_for(client.create_topic(Name=cls.encode_topic(cls.get_topic_name(topic, context)), Attributes={'FifoTopic': 'true'}), timeout=30)
+            else:
+                response = await asyncio.wait_for(client.create_topic(Name=cls.encode_topic(cls.get_topic_name(topic, context))), timeout=30)
         except (botocore.exceptions.NoCredentialsError, aiohttp.client_exceptions.ClientOSError) as e:
             error_message = str(e)
             logging.getLogger('transport.aws_sns_sqs').warning('Unable to connect [sns] to AWS ({})'.format(error_message))
@@ -267,20 +707,36 @@ class AWSSNSSQSTransport(Invoker):
             logging.getLogger('transport.aws_sns_sqs').warning('Unable to create topic [sns] on AWS ({})'.format(error_message))
             raise AWSSNSSQSException(error_message, log_level=context.get('log_level'))
 
+        if not cls.topics:
+            cls.topics = {}
         cls.topics[topic] = topic_arn
+        cls.store_topic_cache(cls, context)
 
         return topic_arn
 
-    async def publish_message(cls: Any, topic_arn: str, message: Any, context: Dict) -> str:
+    @classmethod
+    def is_not_found_error(cls, e: Optional[BaseException]) -> bool:
+        return isinstance(e, botocore.exceptions.ClientError) and e.response.get('Error', {}).get('Code') == 'NotFound'
+
+    @classmethod
+    def is_non_existent_queue_error(cls, e: Optional[BaseException]) -> bool:
+        return isinstance(e, botocore.exceptions.ClientError) and e.response.get('Error', {}).get('Code') in ('AWS.SimpleQueueService.NonExistentQueue', 'QueueDoesNotExist')
+
+    async def publish_message(cls: Any, topic_arn: str, message: Any, context: Dict, message_attributes: Optional[Dict] = None, **kwargs: Any) -> str:
         if not cls.clients or not cls.clients.get('sns'):
             cls.create_client(cls, 'sns', context)
         client = cls.clients.get('sns')
 
+        publish_kwargs = {'TopicArn': topic_arn, 'Message': message}  # type: Dict[str, Any]
+        if message_attributes:
+            publish_kwargs['MessageAttributes'] = message_attributes
+        publish_kwargs.update(kwargs)
+
         try:
-            response = await asyncio.wait_for(client.publish(TopicArn=topic_arn, Message=message), timeout=30)
+            response = await asyncio.wait_for(client.publish(**publish_kwargs), timeout=30)
         except (aiohttp.client_exceptions.ServerDisconnectedError, RuntimeError) as e:
             await asyncio.sleep(1)
-            response = await asyncio.wait_for(client.publish(TopicArn=topic_arn, Message=message), timeout=30)
+            response = await asyncio.wait_for(client.publish(**publish_kwargs), timeout=30)
         except (botocore.exceptions.ClientError, aiohttp.client_exceptions.ClientConnectorError, asyncio.TimeoutError) as e:
             error_message = str(e) if not isinstance(e, asyncio.TimeoutError) else 'Network timeout'
             logging.getLogger('transport.aws_sns_sqs').warning('Unable to publish message [sns] on AWS ({})'.format(error_message))
@@ -294,28 +750,236 @@ class AWSSNSSQSTransport(Invoker):
 
         return message_id
 
+    async def get_queue_url(cls: Any, queue_name: str, context: Dict, refresh: bool = False) -> str:
+        if not cls.queue_urls:
+            cls.queue_urls = {}
+        if refresh:
+            cls.queue_urls.pop(queue_name, None)
+        elif cls.queue_urls.get(queue_name):
+            queue_url = cls.queue_urls.get(queue_name)
+            if queue_url and isinstance(queue_url, str):
+                return queue_url
+
+        # Concurrent calls for the same queue will await a single in-flight GetQueueUrl request
+        if not cls.queue_url_tasks:
+            cls.queue_url_tasks = {}
+        if not cls.queue_url_tasks.get(queue_name):
+            task = asyncio.ensure_future(cls.get_queue_url_from_name(cls, queue_name, context))
+            cls.queue_url_tasks[queue_name] = task
+            task.add_done_callback(lambda t: cls.queue_url_tasks.pop(queue_name, None))
+
+        return await asyncio.shield(cls.queue_url_tasks[queue_name])
+
+    async def get_queue_url_from_name(cls: Any, queue_name: str, context: Dict) -> str:
+        if not cls.clients or not cls.clients.get('sqs'):
+            cls.create_client(cls, 'sqs', context)
+        client = cls.clients.get('sqs')
+
+        try:
+            response = await asyncio.wait_for(client.get_queue_url(QueueName=cls.prefix_queue_name(queue_name, context)), timeout=30)
+            queue_url = response.get('QueueUrl')
+        except botocore.exceptions.ClientError as e:
+            if 'AWS.SimpleQueueService.NonExistentQueue' not in str(e):
+                error_message = str(e)
+                logging.getLogger('transport.aws_sns_sqs').warning('Unable to get queue url [sqs] on AWS ({})'.format(error_message))
+                raise AWSSNSSQSException(error_message, log_level=context.get('log_level')) from e
+            queue_url, _ = await cls.create_queue(cls, cls.prefix_queue_name(queue_name, context), context)
+        except (botocore.exceptions.NoCredentialsError, aiohttp.client_exceptions.ClientOSError, asyncio.TimeoutError) as e:
+            error_message = str(e) if not isinstance(e, asyncio.TimeoutError) else 'Network timeout'
+            logging.getLogger('transport.aws_sns_sqs').warning('Unable to connect [sqs] to AWS ({})'.format(error_message))
+            raise AWSSNSSQSConnectionException(error_message, log_level=context.get('log_level')) from e
+
+        if not queue_url:
+            error_message = 'Missing Queue URL in response'
+            logging.getLogger('transport.aws_sns_sqs').warning('Unable to get queue url [sqs] on AWS ({})'.format(error_message))
+            raise AWSSNSSQSException(error_message, log_level=context.get('log_level'))
+
+        cls.queue_urls[queue_name] = queue_url
+        return str(queue_url)
+
+    async def send_message(cls: Any, queue_url: str, message: Any, context: Dict, message_attributes: Optional[Dict] = None, delay_seconds: Optional[int] = None, **kwargs: Any) -> str:
+        if not cls.clients or not cls.clients.get('sqs'):
+            cls.create_client(cls, 'sqs', context)
+        client = cls.clients.get('sqs')
+
+        send_kwargs = {'QueueUrl': queue_url, 'MessageBody': message}  # type: Dict[str, Any]
+        if message_attributes:
+            send_kwargs['MessageAttributes'] = message_attributes
+        if delay_seconds is not None:
+            send_kwargs['DelaySeconds'] = int(delay_seconds)
+        send_kwargs.update(kwargs)
+
+        try:
+            response = await asyncio.wait_for(client.send_message(**send_kwargs), timeout=30)
+        except (aiohttp.client_exceptions.ServerDisconnectedError, RuntimeError) as e:
+            await asyncio.sleep(1)
+            response = await asyncio.wait_for(client.send_message(**send_kwargs), timeout=30)
+        except (botocore.exceptions.ClientError, aiohttp.client_exceptions.ClientConnectorError, asyncio.TimeoutError) as e:
+            error_message = str(e) if not isinstance(e, asyncio.TimeoutError) else 'Network timeout'
+            logging.getLogger('transport.aws_sns_sqs').warning('Unable to send message [sqs] on AWS ({})'.format(error_message))
+            raise AWSSNSSQSException(error_message, log_level=context.get('log_level')) from e
+
+        message_id = response.get('MessageId')
+        if not message_id or not isinstance(message_id, str):
+            error_message = 'Missing MessageId in response'
+            logging.getLogger('transport.aws_sns_sqs').warning('Unable to send message [sqs] on AWS ({})'.format(error_message))
+            raise AWSSNSSQSException(error_message, log_level=context.get('log_level'))
+
+        return message_id
+
+    async def send_message_batch(cls: Any, queue_url: str, messages: List, context: Dict, message_attributes: Optional[Dict] = None, delay_seconds: Optional[int] = None,
+                                 fifo_kwargs_list: Optional[List[Dict]] = None) -> List[str]:
+        if not cls.clients or not cls.clients.get('sqs'):
+            cls.create_client(cls, 'sqs', context)
+        client = cls.clients.get('sqs')
+
+        entries = {}  # type: Dict[str, Dict[str, Any]]
+        for i, message in enumerate(messages):
+            entry = {'Id': str(i), 'MessageBody': message}  # type: Dict[str, Any]
+            if message_attributes:
+                entry['MessageAttributes'] = message_attributes
+            if delay_seconds is not None:
+                entry['DelaySeconds'] = int(delay_seconds)
+            if fifo_kwargs_list:
+                entry.update(fifo_kwargs_list[i])
+            entries[str(i)] = entry
+
+        message_ids = {}  # type: Dict[str, str]
+        attempt = 0
+        while entries:
+            attempt += 1
+            try:
+                response = await asyncio.wait_for(client.send_message_batch(QueueUrl=queue_url, Entries=list(entries.values())), timeout=30)
+            except (aiohttp.client_exceptions.ServerDisconnectedError, RuntimeError, asyncio.TimeoutError) as e:
+                error_message = str(e) if not isinstance(e, asyncio.TimeoutError) else 'Network timeout'
+                if attempt >= MAX_SEND_MESSAGE_ATTEMPTS:
+                    logging.getLogger('transport.aws_sns_sqs').warning('Unable to send message [sqs] on AWS ({})'.format(error_message))
+                    raise AWSSNSSQSException(error_message, log_level=context.get('log_level')) from e
+                await asyncio.sleep(1)
+                continue
+            except (botocore.exceptions.ClientError, aiohttp.client_exceptions.ClientConnectorError) as e:
+                error_message = str(e)
+                logging.getLogger('transport.aws_sns_sqs').warning('Unable to send message [sqs] on AWS ({})'.format(error_message))
+                raise AWSSNSSQSException(error_message, log_level=context.get('log_level')) from e
+
+            for successful in response.get('Successful', []):
+                message_ids[successful.get('Id')] = successful.get('MessageId')
+                entries.pop(successful.get('Id'), None)
+
+            # Entries that failed on the AWS side are retried, while entries which were rejected are not
+            for failed in response.get('Failed', []):
+                if failed.get('SenderFault') or attempt >= MAX_SEND_MESSAGE_ATTEMPTS:
+                    error_message = failed.get('Message') or failed.get('Code')
+                    logging.getLogger('transport.aws_sns_sqs').warning('Unable to send message [sqs] on AWS ({})'.format(error_message))
+                    raise AWSSNSSQSException(error_message, log_level=context.get('log_level'))
+
+            if entries:
+                await asyncio.sleep(1)
+
+        return [message_ids[str(i)] for i in range(len(messages))]
+
     async def delete_message(cls: Any, receipt_handle: Optional[str], queue_url: Optional[str], context: Dict) -> None:
-        if not receipt_handle:
+        if not receipt_handle or not queue_url:
             return
+
+        # Buffers and linger tasks are kept in the service context, so that each service batches its deletes with its own options
+        if not context.get('_aws_sns_sqs_delete_message_buffers'):
+            context['_aws_sns_sqs_delete_message_buffers'] = {}
+        if not context.get('_aws_sns_sqs_delete_message_tasks'):
+            context['_aws_sns_sqs_delete_message_tasks'] = {}
+
+        buffer = context['_aws_sns_sqs_delete_message_buffers'].setdefault(queue_url, [])
+        buffer.append((receipt_handle, 0))
+
+        if len(buffer) >= MAX_BATCH_ENTRIES:
+            cls.flush_delete_message_buffer(cls, queue_url, context)
+        elif not context['_aws_sns_sqs_delete_message_tasks'].get(queue_url):
+            linger_time = context.get('options', {}).get('aws_sns_sqs', {}).get('delete_message_linger_time', 0.05)
+
+            async def _linger() -> None:
+                await asyncio.sleep(linger_time or 0)
+                context['_aws_sns_sqs_delete_message_tasks'].pop(queue_url, None)
+                cls.flush_delete_message_buffer(cls, queue_url, context)
+
+            context['_aws_sns_sqs_delete_message_tasks'][queue_url] = asyncio.ensure_future(_linger())
+
+    def flush_delete_message_buffer(cls: Any, queue_url: str, context: Dict) -> None:
+        async def _flush() -> None:
+            buffers = context.get('_aws_sns_sqs_delete_message_buffers') or {}
+            while buffers.get(queue_url):
+                buffer = buffers[queue_url]
+                entries = buffer[:MAX_BATCH_ENTRIES]
+                del buffer[:MAX_BATCH_ENTRIES]
+                try:
+                    await cls.delete_message_batch(cls, entries, queue_url, context)
+                except Exception as e:
+                    # A failing batch must not keep the remaining buffered receipt handles from being deleted
+                    logging.getLogger('transport.aws_sns_sqs').warning('Unable to delete message [sqs] on AWS ({})'.format(str(e)))
+
+        if '_aws_sns_sqs_delete_message_flush_tasks' not in context:
+            context['_aws_sns_sqs_delete_message_flush_tasks'] = set()
+        flush_tasks = context['_aws_sns_sqs_delete_message_flush_tasks']
+        task = asyncio.ensure_future(_flush())
+        flush_tasks.add(task)
+        task.add_done_callback(flush_tasks.discard)
+
+    async def delete_message_batch(cls: Any, entries: List[Tuple[str, int]], queue_url: str, context: Dict) -> None:
         if not cls.clients or not cls.clients.get('sqs'):
             cls.create_client(cls, 'sqs', context)
         client = cls.clients.get('sqs')
 
-        async def _delete_message() -> None:
+        while entries:
+            batch_entries = {str(i): entry for i, entry in enumerate(entries)}
+            retry_entries = []  # type: List[Tuple[str, int]]
             try:
-                await asyncio.wait_for(client.delete_message(ReceiptHandle=receipt_handle, QueueUrl=queue_url), timeout=30)
-            except (aiohttp.client_exceptions.ServerDisconnectedError, RuntimeError) as e:
-                await asyncio.sleep(1)
-                await asyncio.wait_for(client.delete_message(ReceiptHandle=receipt_handle, QueueUrl=queue_url), timeout=30)
+                response = await asyncio.wait_for(client.delete_message_batch(QueueUrl=queue_url, Entries=[{'Id': id_, 'ReceiptHandle': receipt_handle} for id_, (receipt_handle, _) in batch_entries.items()]), timeout=30)
+                for failed in response.get('Failed', []):
+                    receipt_handle, attempt = batch_entries[failed.get('Id')]
+                    if failed.get('SenderFault') or attempt + 1 >= MAX_DELETE_MESSAGE_ATTEMPTS:
+                        logging.getLogger('transport.aws_sns_sqs').warning('Unable to delete message [sqs] on AWS ({})'.format(failed.get('Message') or failed.get('Code')))
+                        continue
+                    retry_entries.append((receipt_handle, attempt + 1))
+            except (aiohttp.client_exceptions.ServerDisconnectedError, aiohttp.client_exceptions.ClientConnectorError, aiohttp.client_exceptions.ClientOSError, RuntimeError, asyncio.TimeoutError) as e:
+                error_message = str(e) if not isinstance(e, asyncio.TimeoutError) else 'Network timeout'
+                retry_entries = [(receipt_handle, attempt + 1) for receipt_handle, attempt in entries if attempt + 1 < MAX_DELETE_MESSAGE_ATTEMPTS]
+                if len(retry_entries) < len(entries):
+                    logging.getLogger('transport.aws_sns_sqs').warning('Unable to delete message [sqs] on AWS ({})'.format(error_message))
             except botocore.exceptions.ClientError as e:
                 error_message = str(e)
                 logging.getLogger('transport.aws_sns_sqs').warning('Unable to delete message [sqs] on AWS ({})'.format(error_message))
-            except asyncio.TimeoutError as e:
-                error_message = 'Network timeout'
-                logging.getLogger('transport.aws_sns_sqs').warning('Unable to delete message [sqs] on AWS ({})'.format(error_message))
-                raise AWSSNSSQSException(error_message, log_level=context.get('log_level')) from e
 
-        await _delete_message()
+            if retry_entries:
+                await asyncio.sleep(1)
+            entries = retry_entries
+
+    async def flush_delete_messages(cls: Any, context: Dict) -> None:
+        tasks = context.get('_aws_sns_sqs_delete_message_tasks') or {}
+        for task in tasks.values():
+            if not task.done():
+                task.cancel()
+        context['_aws_sns_sqs_delete_message_tasks'] = {}
+
+        for queue_url in list((context.get('_aws_sns_sqs_delete_message_buffers') or {}).keys()):
+            cls.flush_delete_message_buffer(cls, queue_url, context)
+
+        if context.get('_aws_sns_sqs_delete_message_flush_tasks'):
+            await asyncio.wait(list(context['_aws_sns_sqs_delete_message_flush_tasks']), timeout=35)
+
+    async def change_message_visibility(cls: Any, receipt_handle: Optional[str], queue_url: Optional[str], visibility_timeout: int, context: Dict) -> None:
+        if not receipt_handle or not queue_url:
+            return
+        if not cls.clients or not cls.clients.get('sqs'):
+            cls.create_client(cls, 'sqs', context)
+        client = cls.clients.get('sqs')
+
+        try:
+            await asyncio.wait_for(client.change_message_visibility(ReceiptHandle=receipt_handle, QueueUrl=queue_url, VisibilityTimeout=visibility_timeout), timeout=30)
+        except (aiohttp.client_exceptions.ServerDisconnectedError, RuntimeError) as e:
+            await asyncio.sleep(1)
+            await asyncio.wait_for(client.change_message_visibility(ReceiptHandle=receipt_handle, QueueUrl=queue_url, VisibilityTimeout=visibility_timeout), timeout=30)
+        except (botocore.exceptions.ClientError, asyncio.TimeoutError) as e:
+            error_message = str(e) if not isinstance(e, asyncio.TimeoutError) else 'Network timeout'
+            logging.getLogger('transport.aws_sns_sqs').warning('Unable to change message visibility [sqs] on AWS ({})'.format(error_message))
 
     async def create_queue(cls: Any, queue_name: str, context: Dict) -> Tuple[str, str]:
         if not cls.clients or not cls.clients.get('sqs'):
@@ -323,7 +987,10 @@ class AWSSNSSQSTransport(Invoker):
         client = cls.clients.get('sqs')
 
         try:
-            response = await client.create_queue(QueueName=queue_name)
+            if cls.is_fifo(queue_name):
+                response = await client.create_queue(QueueName=queue_name, Attributes={'FifoQueue': 'true'})
+            else:
+                response = await client.create_queue(QueueName=queue_name)
         except (botocore.exceptions.NoCredentialsError, botocore.exceptions.PartialCredentialsError, aiohttp.client_exceptions.ClientOSError) as e:
             error_message = str(e)
             logging.getLogger('transport.aws_sns_sqs').warning('Unable to connect [sqs] to AWS ({})'.format(error_message))
@@ -340,7 +1007,7 @@ class AWSSNSSQSTransport(Invoker):
             raise AWSSNSSQSException(error_message, log_level=context.get('log_level'))
 
         try:
-            response = await client.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['QueueArn'])
+            response = await client.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['All'])
         except botocore.exceptions.ClientError as e:
             error_message = str(e)
             logging.getLogger('transport.aws_sns_sqs').warning('Unable to get queue attributes [sqs] on AWS ({})'.format(error_message))
@@ -352,8 +1019,128 @@ class AWSSNSSQSTransport(Invoker):
             logging.getLogger('transport.aws_sns_sqs').warning('Unable to get queue attributes [sqs] on AWS ({})'.format(error_message))
             raise AWSSNSSQSException(error_message, log_level=context.get('log_level'))
 
+        if not cls.queue_attributes:
+            cls.queue_attributes = {}
+        cls.queue_attributes[queue_url] = response.get('Attributes', {})
+
         return queue_url, queue_arn
 
+    async def queue_exists(cls: Any, queue_url: str, queue_arn: str, context: Dict) -> bool:
+        if not cls.clients or not cls.clients.get('sqs'):
+            cls.create_client(cls, 'sqs', context)
+        client = cls.clients.get('sqs')
+
+        try:
+            response = await asyncio.wait_for(client.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['QueueArn']), timeout=30)
+        except (botocore.exceptions.ClientError, aiohttp.client_exceptions.ClientError, asyncio.TimeoutError):
+            return False
+
+        return bool(response.get('Attributes', {}).get('QueueArn') == queue_arn)
+
+    async def subscriptions_exist(cls: Any, subscription_arn_list: List[str], queue_arn: Optional[str], subscription_attributes: Dict, context: Dict) -> bool:
+        if not cls.clients or not cls.clients.get('sns'):
+            cls.create_client(cls, 'sns', context)
+        client = cls.clients.get('sns')
+
+        for subscription_arn in subscription_arn_list:
+            try:
+                response = await asyncio.wait_for(client.get_subscription_attributes(SubscriptionArn=subscription_arn), timeout=30)
+            except (botocore.exceptions.ClientError, aiohttp.client_exceptions.ClientError, asyncio.TimeoutError):
+                return False
+
+            attributes = response.get('Attributes', {})
+            if attributes.get('Endpoint') != queue_arn:
+                return False
+            if str(attributes.get('RawMessageDelivery', 'false')).lower() != subscription_attributes.get('RawMessageDelivery', 'false'):
+                return False
+            try:
+                if (ujson.loads(attributes['FilterPolicy']) if attributes.get('FilterPolicy') else None) != \
+                        (ujson.loads(subscription_attributes['FilterPolicy']) if subscription_attributes.get('FilterPolicy') else None):
+                    return False
+            except ValueError:
+                return False
+
+        return True
+
+    @classmethod
+    def get_changed_queue_attributes(cls, current_attributes: Dict, attributes: Dict) -> Dict:
+        changed_attributes = {}
+        for name, value in attributes.items():
+            current_value = current_attributes.get(name)
+            if name in ('Policy', 'RedrivePolicy') and current_value:
+                try:
+                    if ujson.loads(current_value) == ujson.loads(value):
+                        continue
+                    if name == 'RedrivePolicy' and {k: str(v) for k, v in ujson.loads(current_value).items()} == {k: str(v) for k, v in ujson.loads(value).items()}:
+                        continue
+                except ValueError:
+                    pass
+            elif current_value == value:
+                continue
+            changed_attributes[name] = value
+        return changed_attributes
+
+    @classmethod
+    def decode_message_body(cls, body: Optional[str], raw_message_delivery: bool = False) -> Optional[str]:
+        if not body:
+            return None
+
+        # Bodies of subscriptions with raw message delivery are the payload itself
+        if raw_message_delivery and not SNS_ENVELOPE_PATTERN.match(body):
+            return body
+
+        # Only the JSON string value of the "Message" key in SNS envelopes is decoded. Quotes within the value are
+        # always escaped, so the value ends at the last quote before the "Timestamp" key that follows it.
+        start = body.find('"Message"')
+        end = body.find('"Timestamp"', start) if start != -1 else -1
+        if end != -1:
+            begin = body.find('"', start + 9, end)
+            end = body.rfind('"', begin + 1, end) if begin != -1 else -1
+            if end != -1 and body[start + 9:begin].strip() == ':':
+                try:
+                    payload = ujson.loads(body[begin:end + 1])
+                    if isinstance(payload, str):
+                        return payload
+                except ValueError:
+                    pass
+
+        message_body = ujson.loads(body)
+        if not isinstance(message_body, dict):
+            return None
+        return message_body.get('Message')
+
+    @classmethod
+    def get_topology_digest(cls, *args: Any) -> str:
+        return hashlib.sha256(ujson.dumps(args, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def load_topology_manifest(cls, context: Dict) -> Dict:
+        topology_manifest_file = context.get('options', {}).get('aws_sns_sqs', {}).get('topology_manifest_file')
+        if not topology_manifest_file or not os.path.isfile(topology_manifest_file):
+            return {}
+
+        try:
+            with open(topology_manifest_file, 'r') as file:
+                topology_manifest = ujson.loads(file.read())
+        except (OSError, ValueError) as e:
+            logging.getLogger('transport.aws_sns_sqs').warning('Unable to read topology manifest file "{}" ({})'.format(topology_manifest_file, str(e)))
+            return {}
+
+        return topology_manifest if isinstance(topology_manifest, dict) else {}
+
+    @classmethod
+    def store_topology_manifest(cls, topology_manifest: Dict, context: Dict) -> None:
+        topology_manifest_file = context.get('options', {}).get('aws_sns_sqs', {}).get('topology_manifest_file')
+        if not topology_manifest_file:
+            return
+
+        try:
+            with open('{}.tmp'.format(topology_manifest_file), 'w') as file:
+                file.write(ujson.dumps(topology_manifest, sort_keys=True, indent=2))
+            os.replace('{}.tmp'.format(topology_manifest_file), topology_manifest_file)
+        except OSError as e:
+            logging.getLogger('transport.aws_sns_sqs').warning('Unable to write topology manifest file "{}" ({})'.format(topology_manifest_file, str(e)))
+
     @classmethod
     def generate_queue_policy(cls, queue_arn: str, topic_arn_list: List, context: Dict) -> Dict:
         if len(topic_arn_list) == 1:
@@ -384,7 +1171,7 @@ class AWSSNSSQSTransport(Invoker):
             "Id": "{}/SQSDefaultPolicy".format(queue_arn),
             "Statement": [
                 {
-                    "Sid": "{}{}".format(str(uuid.uuid4()), ('%.3f' % time.time()).replace('.', '')),
+                    "Sid": hashlib.sha256('{}{}'.format(queue_arn, source_arn).encode('utf-8')).hexdigest(),
                     "Effect": "Allow",
                     "Principal": "*",
                     "Action": "SQS:SendMessage",
@@ -399,16 +1186,29 @@ class AWSSNSSQSTransport(Invoker):
         }
         return queue_policy
 
-    async def subscribe_wildcard_topic(cls: Any, topic: str, queue_arn: str, queue_url: str, context: Dict) -> Optional[List]:
+    async def refresh_topic_catalog(cls: Any, context: Dict, max_age: float = 0.0) -> None:
+        # A single listing of all topics is shared by every wildcard subscription, and concurrent refreshes
+        # will await the same in-flight listing.
+        if cls.topic_catalog is not None and cls.topic_catalog_updated_at + max_age > time.time():
+            return
+
+        if not cls.topic_catalog_task:
+            cls.topic_catalog_task = asyncio.ensure_future(cls.list_topic_catalog(cls, context))
+
+            def _done(task: asyncio.Future) -> None:
+                cls.topic_catalog_task = None
+
+            cls.topic_catalog_task.add_done_callback(_done)
+
+        await asyncio.shield(cls.topic_catalog_task)
+
+    async def list_topic_catalog(cls: Any, context: Dict) -> None:
         if not cls.clients or not cls.clients.get('sns'):
             cls.create_client(cls, 'sns', context)
         client = cls.clients.get('sns')
 
-        pattern = r'^arn:aws:sns:[^:]+:[^:]+:{}$'.format(cls.encode_topic(cls.get_topic_name(topic, context)).replace(cls.encode_topic('*'), '((?!{}).)*'.format(cls.encode_topic('.'))).replace(cls.encode_topic('#'), '.*'))
-        compiled_pattern = re.compile(pattern)
-
+        topic_catalog = []  # type: List[Tuple[str, str]]
         next_token = False
-        topic_arn_list = None
         while next_token is not None:
             try:
                 if next_token:
@@ -421,41 +1221,129 @@ class AWSSNSSQSTransport(Invoker):
                 raise AWSSNSSQSException(error_message, log_level=context.get('log_level')) from e
 
             next_token = response.get('NextToken')
-            topics = response.get('Topics', [])
-            topic_arn_list = [t.get('TopicArn') for t in topics if t.get('TopicArn') and compiled_pattern.match(t.get('TopicArn'))]
+            topic_catalog.extend([(t.get('TopicArn').rsplit(':', 1)[-1], t.get('TopicArn')) for t in response.get('Topics', []) if t.get('TopicArn')])
+
+        topic_catalog.sort()
+        cls.topic_catalog = topic_catalog
+        cls.topic_catalog_names = [name for name, _ in topic_catalog]
+        cls.topic_catalog_updated_at = time.time()
+
+    def get_wildcard_topic_arns(cls: Any, topic: str, context: Dict) -> List[str]:
+        encoded_topic = cls.encode_topic(cls.get_topic_name(topic, context))
+        pattern = r'^{}$'.format(encoded_topic.replace(cls.encode_topic('*'), '((?!{}).)*'.format(cls.encode_topic('.'))).replace(cls.encode_topic('#'), '.*'))
+        compiled_pattern = re.compile(pattern)
+
+        # Only topic names sharing the literal prefix of the wildcard topic are matched against the pattern
+        prefix = re.split(r'[*#]', encoded_topic, 1)[0]
+        topic_catalog = cls.topic_catalog or []
+        topic_catalog_names = cls.topic_catalog_names or []
+        index = bisect.bisect_left(topic_catalog_names, prefix)
+
+        topic_arn_list = []
+        while index < len(topic_catalog) and topic_catalog_names[index].startswith(prefix):
+            name, topic_arn = topic_catalog[index]
+            if compiled_pattern.match(name):
+                topic_arn_list.append(topic_arn)
+            index += 1
+
+        return topic_arn_list
+
+    async def subscribe_wildcard_topic(cls: Any, topic: str, queue_arn: str, queue_url: str, context: Dict, queue_attributes: Optional[Dict] = None, subscription_attributes: Optional[Dict] = None) -> Optional[List]:
+        # Wildcard subscriptions set up at the same time will share the same topic listing
+        await cls.refresh_topic_catalog(cls, context, max_age=10)
+        topic_arn_list = cls.get_wildcard_topic_arns(cls, topic, context)
+
+        context['_aws_sns_sqs_wildcard_subscriptions'] = context.get('_aws_sns_sqs_wildcard_subscriptions', [])
+        context['_aws_sns_sqs_wildcard_subscriptions'].append((topic, queue_arn, queue_url, queue_attributes, subscription_attributes, set(topic_arn_list)))
 
         if topic_arn_list:
             queue_policy = cls.generate_queue_policy(queue_arn, topic_arn_list, context)
             cls.topics[topic] = topic_arn_list[0]
-            return await cls.subscribe_topics(cls, topic_arn_list, queue_arn, queue_url, context, queue_policy=queue_policy)
+            subscription_arn_list = await cls.subscribe_topics(cls, topic_arn_list, queue_arn, queue_url, context, queue_policy=queue_policy, queue_attributes=queue_attributes, subscription_attributes=subscription_attributes)  # type: List
+            return subscription_arn_list
 
         return None
 
-    async def subscribe_topics(cls: Any, topic_arn_list: List, queue_arn: str, queue_url: str, context: Dict, queue_policy: Optional[Dict] = None) -> List:
-        if not cls.clients or not cls.clients.get('sns'):
-            cls.create_client(cls, 'sns', context)
-        client = cls.clients.get('sns')
+    async def refresh_wildcard_subscriptions(cls: Any, context: Dict) -> None:
+        refresh_interval = context.get('options', {}).get('aws_sns_sqs', {}).get('wildcard_topic_refresh_interval', DEFAULT_WILDCARD_TOPIC_REFRESH_INTERVAL)
+        if not refresh_interval:
+            return
+
+        close_waiter = cls.close_waiter
+        while not close_waiter.done():
+            await asyncio.wait([close_waiter], timeout=refresh_interval)
+            if close_waiter.done() or not context.get('_aws_sns_sqs_wildcard_subscriptions'):
+                continue
 
+            try:
+                await cls.refresh_topic_catalog(cls, context)
+            except Exception as e:
+                logging.getLogger('transport.aws_sns_sqs').warning('Unable to refresh topic catalog [sns] on AWS ({})'.format(str(e)))
+                continue
+
+            for topic, queue_arn, queue_url, queue_attributes, subscription_attributes, subscribed_topic_arns in context.get('_aws_sns_sqs_wildcard_subscriptions', []):
+                topic_arn_list = cls.get_wildcard_topic_arns(cls, topic, context)
+                new_topic_arn_list = [topic_arn for topic_arn in topic_arn_list if topic_arn not in subscribed_topic_arns]
+                if not new_topic_arn_list:
+                    continue
+
+                try:
+                    queue_policy = cls.generate_queue_policy(queue_arn, topic_arn_list, context)
+                    await cls.subscribe_topics(cls, new_topic_arn_list, queue_arn, queue_url, context, queue_policy=queue_policy, queue_attributes=queue_attributes, subscription_attributes=subscription_attributes)
+                    subscribed_topic_arns.update(new_topic_arn_list)
+                    logging.getLogger('transport.aws_sns_sqs').info('Subscribed to {} new topic(s) matching wildcard topic "{}"'.format(len(new_topic_arn_list), topic))
+                except Exception as e:
+                    logging.getLogger('transport.aws_sns_sqs').warning('Unable to subscribe to new topics matching wildcard topic "{}" ({})'.format(topic, str(e)))
+
+    async def set_queue_attributes(cls: Any, queue_url: str, attributes: Dict, context: Dict) -> None:
         if not cls.clients or not cls.clients.get('sqs'):
             cls.create_client(cls, 'sqs', context)
-        sqs_client = cls.clients.get('sqs')
+        client = cls.clients.get('sqs')
 
-        if not queue_policy:
-            queue_policy = cls.generate_queue_policy(queue_arn, topic_arn_list, context)
+        # Attributes are only written if they differ from the ones fetched when the queue was created
+        current_attributes = (cls.queue_attributes or {}).get(queue_url, {})
+        attributes = cls.get_changed_queue_attributes(current_attributes, attributes)
+        if not attributes:
+            return
 
         try:
             # MessageRetentionPeriod (default 4 days, set to context value)
-            # VisibilityTimeout (default 30 seconds)
-            response = await sqs_client.set_queue_attributes(QueueUrl=queue_url, Attributes={'Policy': ujson.dumps(queue_policy)})
+            await client.set_queue_attributes(QueueUrl=queue_url, Attributes=attributes)
         except botocore.exceptions.ClientError as e:
             error_message = str(e)
             logging.getLogger('transport.aws_sns_sqs').warning('Unable to set queue attributes [sqs] on AWS ({})'.format(error_message))
             raise AWSSNSSQSException(error_message, log_level=context.get('log_level')) from e
+        if cls.queue_attributes and queue_url in cls.queue_attributes:
+            cls.queue_attributes[queue_url].update(attributes)
+
+    async def subscribe_topics(cls: Any, topic_arn_list: List, queue_arn: str, queue_url: str, context: Dict, queue_policy: Optional[Dict] = None, queue_attributes: Optional[Dict] = None, subscription_attributes: Optional[Dict] = None) -> List:
+        if not cls.clients or not cls.clients.get('sns'):
+            cls.create_client(cls, 'sns', context)
+        client = cls.clients.get('sns')
+
+        if not queue_policy:
+            queue_policy = cls.generate_queue_policy(queue_arn, topic_arn_list, context)
+
+        attributes = {'Policy': ujson.dumps(queue_policy)}
+        if queue_attributes:
+            attributes.update(queue_attributes)
+        await cls.set_queue_attributes(cls, queue_url, attributes, context)
 
         subscription_arn_list = []
         for topic_arn in topic_arn_list:
             try:
-                response = await client.subscribe(TopicArn=topic_arn, Protocol='sqs', Endpoint=queue_arn)
+                if subscription_attributes:
+                    try:
+                        response = await client.subscribe(TopicArn=topic_arn, Protocol='sqs', Endpoint=queue_arn, Attributes=subscription_attributes)
+                    except botocore.exceptions.ClientError as e:
+                        if 'InvalidParameter' not in str(e):
+                            raise
+                        # The subscription already exists with other attributes which are then updated one by one
+                        response = await client.subscribe(TopicArn=topic_arn, Protocol='sqs', Endpoint=queue_arn)
+                        for attribute_name, attribute_value in subscription_attributes.items():
+                            await client.set_subscription_attributes(SubscriptionArn=response.get('SubscriptionArn'), AttributeName=attribute_name, AttributeValue=attribute_value)
+                else:
+                    response = await client.subscribe(TopicArn=topic_arn, Protocol='sqs', Endpoint=queue_arn)
             except botocore.exceptions.ClientError as e:
                 error_message = str(e)
                 logging.getLogger('transport.aws_sns_sqs').warning('Unable to subscribe to topic [sns] on AWS ({})'.format(error_message))
@@ -471,7 +1359,8 @@ class AWSSNSSQSTransport(Invoker):
 
         return subscription_arn_list
 
-    async def consume_queue(cls: Any, obj: Any, context: Dict, handler: Callable, queue_url: str) -> None:
+    async def consume_queue(cls: Any, obj: Any, context: Dict, handler: Callable, queue_url: str, pollers: Optional[int] = None, max_pollers: Optional[int] = None, max_in_flight: Optional[int] = None, visibility_timeout: Optional[int] = None, raw_message_delivery: bool = False, group_concurrency: Optional[int] = None,
+                            wait_time_seconds: Optional[int] = None, idle_backoff: Optional[float] = None) -> None:
         if not cls.clients or not cls.clients.get('sqs'):
             cls.create_client(cls, 'sqs', context)
         client = cls.clients.get('sqs')
@@ -481,76 +1370,271 @@ class AWSSNSSQSTransport(Invoker):
         stop_waiter = asyncio.Future()  # type: asyncio.Future
         start_waiter = asyncio.Future()  # type: asyncio.Future
 
-        async def receive_messages() -> None:
-            def callback(payload: Optional[str], receipt_handle: Optional[str], queue_url: Optional[str]) -> Callable:
-                async def _callback() -> None:
-                    await handler(payload, receipt_handle, queue_url)
-                return _callback
+        min_pollers = max(pollers or context.get('options', {}).get('aws_sns_sqs', {}).get('pollers') or 1, 1)
+        max_pollers = max(max_pollers or context.get('options', {}).get('aws_sns_sqs', {}).get('max_pollers') or min_pollers, min_pollers)
+        max_in_flight = max_in_flight or context.get('options', {}).get('aws_sns_sqs', {}).get('max_in_flight') or MAX_BATCH_ENTRIES * max_pollers
+
+        semaphore = asyncio.Semaphore(max_in_flight)
+        message_tasks = set()  # type: Set[asyncio.Future]
+        poller_tasks = {}  # type: Dict[asyncio.Future, asyncio.Future]
+        receive_stats = {'receives': 0, 'empty_receives': 0}
+
+        # Queues are long polled for wait_time_seconds, receiving again right away as long as there are messages. With
+        # idle_backoff set, consecutive empty receives are followed by an exponentially increasing pause.
+        wait_time_seconds = min(max(int(context.get('options', {}).get('aws_sns_sqs', {}).get('wait_time_seconds', DEFAULT_WAIT_TIME_SECONDS) if wait_time_seconds is None else wait_time_seconds), 0), 20)
+        idle_backoff = context.get('options', {}).get('aws_sns_sqs', {}).get('idle_backoff') if idle_backoff is None else idle_backoff
+        max_idle_backoff = context.get('options', {}).get('aws_sns_sqs', {}).get('max_idle_backoff', DEFAULT_MAX_IDLE_BACKOFF)
+        queue_metrics = {'receives': 0, 'empty_receives': 0, 'messages': 0, 'idle_backoff_time': 0.0, 'saved_requests': 0}  # type: Dict[str, Union[int, float]]
+        cls.queue_metrics[queue_url] = queue_metrics
+        in_flight_messages = {}  # type: Dict[str, List[float]]
+
+        # Messages of FIFO queues are handled in order within each message group, while up to group_concurrency
+        # message groups are handled in parallel
+        is_fifo_queue = cls.is_fifo(queue_url)
+        group_concurrency = group_concurrency or context.get('options', {}).get('aws_sns_sqs', {}).get('group_concurrency') or max_in_flight
+        group_semaphore = asyncio.Semaphore(group_concurrency)
+        group_tasks = {}  # type: Dict[str, asyncio.Future]
+
+        async def process_message(payload: Optional[str], receipt_handle: Optional[str], receive_count: int, previous_task: Optional[asyncio.Future] = None) -> bool:
+            if receipt_handle:
+                in_flight_messages[receipt_handle] = [time.time(), time.time() + (visibility_timeout or DEFAULT_VISIBILITY_TIMEOUT)]
+            try:
+                if previous_task and not await previous_task:
+                    # A previous message in the same group wasn't handled, so this one is returned to the queue
+                    # to be redelivered after it
+                    await cls.change_message_visibility(cls, receipt_handle, queue_url, 0, context)
+                    return False
+
+                if is_fifo_queue:
+                    async with group_semaphore:
+                        if cls.close_waiter.done():
+                            # Messages which haven't been started when the service is stopping are released right away
+                            await cls.change_message_visibility(cls, receipt_handle, queue_url, 0, context)
+                            return False
+                        return await handler(payload, receipt_handle, queue_url, receive_count) is not MESSAGE_NOT_HANDLED
+
+                return await handler(payload, receipt_handle, queue_url, receive_count) is not MESSAGE_NOT_HANDLED
+            except Exception:
+                return False
+            finally:
+                if receipt_handle:
+                    in_flight_messages.pop(receipt_handle, None)
+                semaphore.release()
+
+        attribute_names = ['ApproximateReceiveCount', 'MessageGroupId'] if is_fifo_queue else ['ApproximateReceiveCount']
+
+        def start_message_task(payload: Optional[str], receipt_handle: Optional[str], receive_count: int, message_group_id: Optional[str] = None) -> None:
+            previous_task = group_tasks.get(message_group_id) if message_group_id else None
+            task = asyncio.ensure_future(process_message(payload, receipt_handle, receive_count, previous_task))
+            message_tasks.add(task)
+            task.add_done_callback(message_tasks.discard)
+
+            if message_group_id:
+                group_tasks[message_group_id] = task
+
+                def _done(t: asyncio.Future) -> None:
+                    if group_tasks.get(message_group_id) is t:
+                        group_tasks.pop(message_group_id, None)
+
+                task.add_done_callback(_done)
+
+        async def extend_visibility_timeouts() -> None:
+            # Messages still being handled when their visibility timeout is about to expire are kept hidden
+            # from other consumers, up to a total of max_visibility_timeout_extension seconds per message.
+            max_extension = context.get('options', {}).get('aws_sns_sqs', {}).get('max_visibility_timeout_extension', 3600)
+            while not stop_waiter.done():
+                timeout = visibility_timeout or DEFAULT_VISIBILITY_TIMEOUT
+                interval = max(min(timeout / 3.0, 10.0), 1.0)
+                await asyncio.wait([stop_waiter], timeout=interval)
+
+                current_time = time.time()
+                entries = []
+                for receipt_handle, (received_at, visible_until) in in_flight_messages.items():
+                    if visible_until - current_time > interval * 2:
+                        continue
+                    extended_timeout = int(min(timeout, received_at + max_extension - current_time))
+                    if extended_timeout <= visible_until - current_time:
+                        continue
+                    entries.append((receipt_handle, extended_timeout))
+
+                for i in range(0, len(entries), MAX_BATCH_ENTRIES):
+                    batch_entries = {str(j): entry for j, entry in enumerate(entries[i:i + MAX_BATCH_ENTRIES])}
+                    try:
+                        response = await asyncio.wait_for(client.change_message_visibility_batch(QueueUrl=queue_url, Entries=[{'Id': id_, 'ReceiptHandle': receipt_handle, 'VisibilityTimeout': extended_timeout} for id_, (receipt_handle, extended_timeout) in batch_entries.items()]), timeout=30)
+                    except (botocore.exceptions.ClientError, aiohttp.client_exceptions.ClientError, RuntimeError, asyncio.TimeoutError) as e:
+                        error_message = str(e) if not isinstance(e, asyncio.TimeoutError) else 'Network timeout'
+                        logging.getLogger('transport.aws_sns_sqs').warning('Unable to change message visibility [sqs] on AWS ({})'.format(error_message))
+                        continue
+
+                    for successful in response.get('Successful', []):
+                        receipt_handle, extended_timeout = batch_entries[successful.get('Id')]
+                        if receipt_handle in in_flight_messages:
+                            in_flight_messages[receipt_handle][1] = current_time + extended_timeout
+                    for failed in response.get('Failed', []):
+                        receipt_handle, _ = batch_entries[failed.get('Id')]
+                        logging.getLogger('transport.aws_sns_sqs').warning('Unable to change message visibility [sqs] on AWS ({})'.format(failed.get('Message') or failed.get('Code')))
 
+        async def receive_messages(poller_stop: asyncio.Future) -> None:
             await start_waiter
             is_disconnected = False
-            while not cls.close_waiter.done():
+            empty_receives = 0
+            while not cls.close_waiter.done() and not poller_stop.done():
+                if idle_backoff and empty_receives:
+                    backoff_start_time = time.time()
+                    await asyncio.wait([cls.close_waiter, poller_stop], timeout=min(idle_backoff * 2 ** (empty_receives - 1), max_idle_backoff), return_when=asyncio.FIRST_COMPLETED)
+                    queue_metrics['idle_backoff_time'] += time.time() - backoff_start_time
+                    queue_metrics['saved_requests'] = int(queue_metrics['idle_backoff_time'] / max(wait_time_seconds, 1))
+                    if cls.close_waiter.done() or poller_stop.done():
+                        break
+
+                # Reserve as many in-flight slots as a single receive may fill, waiting for at least one
+                await semaphore.acquire()
+                capacity = 1
+                while capacity < MAX_BATCH_ENTRIES and not semaphore.locked():
+                    await semaphore.acquire()
+                    capacity += 1
+
+                received = 0
                 try:
-                    response = await asyncio.wait_for(client.receive_message(QueueUrl=queue_url, WaitTimeSeconds=20, MaxNumberOfMessages=10), timeout=30)
-                    if is_disconnected:
-                        is_disconnected = False
-                        logging.getLogger('transport.aws_sns_sqs').warning('Reconnected - receiving messages')
-                except (aiohttp.client_exceptions.ServerDisconnectedError, RuntimeError) as e:
-                    is_disconnected = True
-                    error_message = str(e) if e and str(e) not in ['', 'None'] else 'Server disconnected'
-                    logging.getLogger('transport.aws_sns_sqs').warning('Unable to receive message from queue [sqs] on AWS ({}) - reconnecting'.format(error_message))
-                    await asyncio.sleep(1)
-                    continue
-                except ResponseParserError as e:
-                    is_disconnected = True
-                    error_message = 'Unable to parse response: the server was not able to produce a timely response to your request'
-                    logging.getLogger('transport.aws_sns_sqs').warning('Unable to receive message from queue [sqs] on AWS ({}) - reconnecting'.format(error_message))
-                    await asyncio.sleep(1)
-                    continue
-                except (botocore.exceptions.ClientError, aiohttp.client_exceptions.ClientConnectorError, asyncio.TimeoutError) as e:
-                    error_message = str(e) if not isinstance(e, asyncio.TimeoutError) else 'Network timeout'
-                    if 'AWS.SimpleQueueService.NonExistentQueue' in error_message:
+                    if cls.close_waiter.done():
+                        break
+
+                    try:
+                        # The long poll is cancelled as soon as the service is stopping, instead of waiting for it to time out
+                        close_waiter = cls.close_waiter
+                        receive_message = client.receive_message(QueueUrl=queue_url, WaitTimeSeconds=wait_time_seconds, MaxNumberOfMessages=capacity, AttributeNames=attribute_names)
+                        receive_task = asyncio.ensure_future(asyncio.wait_for(receive_message, timeout=wait_time_seconds + 10))
+                        await asyncio.wait([receive_task, close_waiter], return_when=asyncio.FIRST_COMPLETED)
+                        if not receive_task.done():
+                            receive_task.cancel()
+                            break
+                        response = receive_task.result()
                         if is_disconnected:
                             is_disconnected = False
                             logging.getLogger('transport.aws_sns_sqs').warning('Reconnected - receiving messages')
-                        try:
-                            context['_aws_sns_sqs_subscribed'] = False
-                            cls.topics = {}
-                            func = await cls.subscribe(cls, obj, context)
-                            await func()
-                        except Exception:
-                            pass
-                        await asyncio.sleep(20)
+                    except (aiohttp.client_exceptions.ServerDisconnectedError, RuntimeError) as e:
+                        is_disconnected = True
+                        error_message = str(e) if e and str(e) not in ['', 'None'] else 'Server disconnected'
+                        logging.getLogger('transport.aws_sns_sqs').warning('Unable to receive message from queue [sqs] on AWS ({}) - reconnecting'.format(error_message))
+                        await asyncio.sleep(1)
                         continue
-                    if isinstance(e, (asyncio.TimeoutError, aiohttp.client_exceptions.ClientConnectorError)):
+                    except ResponseParserError as e:
                         is_disconnected = True
-                    logging.getLogger('transport.aws_sns_sqs').warning('Unable to receive message from queue [sqs] on AWS ({})'.format(error_message))
-                    await asyncio.sleep(1)
-                    continue
-                except Exception as e:
-                    error_message = str(e)
-                    logging.getLogger('transport.aws_sns_sqs').warning('Unexpected error while receiving message from queue [sqs] on AWS ({})'.format(error_message))
-                    await asyncio.sleep(1)
-                    continue
+                        error_message = 'Unable to parse response: the server was not able to produce a timely response to your request'
+                        logging.getLogger('transport.aws_sns_sqs').warning('Unable to receive message from queue [sqs] on AWS ({}) - reconnecting'.format(error_message))
+                        await asyncio.sleep(1)
+                        continue
+                    except (botocore.exceptions.ClientError, aiohttp.client_exceptions.ClientConnectorError, asyncio.TimeoutError) as e:
+                        error_message = str(e) if not isinstance(e, asyncio.TimeoutError) else 'Network timeout'
+                        if 'AWS.SimpleQueueService.NonExistentQueue' in error_message:
+                            if is_disconnected:
+                                is_disconnected = False
+                                logging.getLogger('transport.aws_sns_sqs').warning('Reconnected - receiving messages')
+                            try:
+                                context['_aws_sns_sqs_subscribed'] = False
+                                cls.invalidate_topic_cache(cls, context)
+                                func = await cls.subscribe(cls, obj, context)
+                                await func()
+                            except Exception:
+                                pass
+                            await asyncio.wait([cls.close_waiter], timeout=20)
+                            continue
+                        if isinstance(e, (asyncio.TimeoutError, aiohttp.client_exceptions.ClientConnectorError)):
+                            is_disconnected = True
+                        logging.getLogger('transport.aws_sns_sqs').warning('Unable to receive message from queue [sqs] on AWS ({})'.format(error_message))
+                        await asyncio.sleep(1)
+                        continue
+                    except Exception as e:
+                        error_message = str(e)
+                        logging.getLogger('transport.aws_sns_sqs').warning('Unexpected error while receiving message from queue [sqs] on AWS ({})'.format(error_message))
+                        await asyncio.sleep(1)
+                        continue
 
-                messages = response.get('Messages', [])
-                if messages:
-                    futures = []
+                    messages = response.get('Messages', [])
+                    receive_stats['receives'] += 1
+                    queue_metrics['receives'] += 1
+                    queue_metrics['messages'] += len(messages)
+                    if not messages:
+                        receive_stats['empty_receives'] += 1
+                        queue_metrics['empty_receives'] += 1
+                        empty_receives += 1
+                    else:
+                        empty_receives = 0
 
                     for message in messages:
                         receipt_handle = message.get('ReceiptHandle')
                         try:
-                            message_body = ujson.loads(message.get('Body'))
+                            payload = cls.decode_message_body(message.get('Body'), raw_message_delivery)
                         except ValueError:
                             # Malformed SQS message, not in SNS format and should be discarded
                             await cls.delete_message(cls, receipt_handle, queue_url, context)
                             logging.getLogger('transport.aws_sns_sqs').warning('Discarded malformed message')
                             continue
 
-                        payload = message_body.get('Message')
-                        futures.append(callback(payload, receipt_handle, queue_url))
-                    if futures:
-                        await asyncio.wait([asyncio.ensure_future(asyncio.shield(func())) for func in futures if func])
+                        receive_count = int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1))
+                        start_message_task(payload, receipt_handle, receive_count, message.get('Attributes', {}).get('MessageGroupId') if is_fifo_queue else None)
+                        received += 1
+                finally:
+                    # Slots that were reserved but not filled by the receive are released right away
+                    for _ in range(capacity - received):
+                        semaphore.release()
+
+        def start_poller() -> None:
+            poller_stop = asyncio.Future()  # type: asyncio.Future
+            task = asyncio.ensure_future(receive_messages(poller_stop))
+            poller_tasks[task] = poller_stop
+            task.add_done_callback(lambda t: poller_tasks.pop(t, None))
+
+        def stop_poller() -> None:
+            for task, poller_stop in poller_tasks.items():
+                if not poller_stop.done():
+                    poller_stop.set_result(None)
+                    return
+
+        async def autoscale_pollers() -> None:
+            interval = context.get('options', {}).get('aws_sns_sqs', {}).get('poller_autoscale_interval', 10)
+            await start_waiter
+            while not cls.close_waiter.done():
+                await asyncio.wait([cls.close_waiter], timeout=interval)
+                if cls.close_waiter.done():
+                    break
+
+                try:
+                    response = await asyncio.wait_for(client.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['ApproximateNumberOfMessages']), timeout=30)
+                    backlog = int(response.get('Attributes', {}).get('ApproximateNumberOfMessages', 0))
+                except Exception:
+                    continue
+
+                active_pollers = len([poller_stop for poller_stop in poller_tasks.values() if not poller_stop.done()])
+                empty_receive_rate = (receive_stats['empty_receives'] / receive_stats['receives']) if receive_stats['receives'] else 1.0
+                receive_stats['receives'] = 0
+                receive_stats['empty_receives'] = 0
+
+                if backlog >= MAX_BATCH_ENTRIES * active_pollers and active_pollers < max_pollers and not semaphore.locked():
+                    start_poller()
+                elif backlog < MAX_BATCH_ENTRIES and empty_receive_rate >= 0.5 and active_pollers > min_pollers:
+                    stop_poller()
+
+        async def consume() -> None:
+            nonlocal visibility_timeout
+            if visibility_timeout is None:
+                try:
+                    response = await asyncio.wait_for(client.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['VisibilityTimeout']), timeout=30)
+                    visibility_timeout = int(response.get('Attributes', {}).get('VisibilityTimeout', DEFAULT_VISIBILITY_TIMEOUT))
+                except Exception:
+                    visibility_timeout = DEFAULT_VISIBILITY_TIMEOUT
+
+            asyncio.ensure_future(extend_visibility_timeouts())
+            for _ in range(min_pollers):
+                start_poller()
+            if max_pollers > min_pollers:
+                asyncio.ensure_future(autoscale_pollers())
+
+            await start_waiter
+            while poller_tasks:
+                await asyncio.wait(list(poller_tasks.keys()))
+            if message_tasks:
+                await asyncio.wait(list(message_tasks))
 
             if not stop_waiter.done():
                 stop_waiter.set_result(None)
@@ -560,55 +1644,32 @@ class AWSSNSSQSTransport(Invoker):
         stop_method = getattr(obj, '_stop_service', None)
 
         async def stop_service(*args: Any, **kwargs: Any) -> None:
+            if not start_waiter.done():
+                start_waiter.set_result(None)
+
             if not cls.close_waiter.done():
                 cls.close_waiter.set_result(None)
-                logging.getLogger('transport.aws_sns_sqs').warning('Draining message pool - may take up to 30 seconds')
-
-                master_stop_time = time.time()
-                for _ in range(0, 100):
-                    tasks = []
-                    t = time.time()
-                    if stop_waiter.done():
-                        break
-                    try:
-                        for topic, topic_arn in cls.topics.items():
-                            tasks.append(asyncio.ensure_future(cls.publish_message(cls, topic_arn, DRAIN_MESSAGE_PAYLOAD, context)))
-                        if tasks:
-                            task_results = await asyncio.wait(tasks, timeout=35)
-                            exception = None
-                            for v in [value for value in task_results][0]:
-                                try:
-                                    if (v.exception() or v.cancelled()) and not exception:
-                                        exception = True
-                                        sleep_timer = (t + 30.0) - time.time()
-                                        if sleep_timer > 0.0:
-                                            logging.getLogger('transport.aws_sns_sqs').warning('Draining failed - please wait')
-                                            await asyncio.sleep(sleep_timer)
-                                except Exception:
-                                    pass
-                            if exception and not stop_waiter.done():
-                                stop_waiter.set_result(None)
-                    except Exception as e:
-                        pass
-
-                    if master_stop_time + 35.0 > time.time() and not stop_waiter.done():
-                        stop_waiter.set_result(None)
+                logging.getLogger('transport.aws_sns_sqs').warning('Stopping consumers - waiting for in-flight messages to be handled')
+                if cls.wildcard_subscription_task and not cls.wildcard_subscription_task.done():
+                    cls.wildcard_subscription_task.cancel()
+                cls.wildcard_subscription_task = None
 
-                    await asyncio.sleep(0.2)
-
-                if not start_waiter.done():
-                    start_waiter.set_result(None)
                 await stop_waiter
                 if stop_method:
                     await stop_method(*args, **kwargs)
-                tasks = []
-                for _, client in cls.clients.items():
-                    task = client.close()
-                    if getattr(task, '_coro', None):
-                        task = task._coro
-                    tasks.append(asyncio.ensure_future(task))
-                await asyncio.wait(tasks, timeout=3)
-                cls.clients = None
+                await cls.flush_delete_messages(cls, context)
+
+                # Clients are kept for the next run of the services if they are restarted due to code changes
+                import tomodachi.launcher
+                if cls.clients and not tomodachi.launcher.ServiceLauncher.restart_services:
+                    tasks = []
+                    for _, client in cls.clients.items():
+                        task = client.close()
+                        if getattr(task, '_coro', None):
+                            task = task._coro
+                        tasks.append(asyncio.ensure_future(task))
+                    await asyncio.wait(tasks, timeout=3)
+                    cls.clients = None
             else:
                 await stop_waiter
                 if stop_method:
@@ -626,50 +1687,109 @@ class AWSSNSSQSTransport(Invoker):
 
         setattr(obj, '_started_service', started_service)
 
-        loop.create_task(receive_messages())
+        loop.create_task(consume())
 
     async def subscribe(cls: Any, obj: Any, context: Dict) -> Optional[Callable]:
         if context.get('_aws_sns_sqs_subscribed'):
             return None
         context['_aws_sns_sqs_subscribed'] = True
 
-        if cls.clients:
-            tasks = []
-            for _, client in cls.clients.items():
-                task = client.close()
-                if getattr(task, '_coro', None):
-                    task = task._coro
-                tasks.append(asyncio.ensure_future(task))
-            await asyncio.wait(tasks, timeout=3)
-            cls.clients = None
-
         async def _subscribe() -> None:
             cls.close_waiter = asyncio.Future()
+            context['_aws_sns_sqs_wildcard_subscriptions'] = []
 
-            async def setup_queue(topic: str, func: Callable, queue_name: Optional[str] = None, competing_consumer: Optional[bool] = None) -> str:
+            topology_manifest = cls.load_topology_manifest(context)
+            semaphore = asyncio.Semaphore(context.get('options', {}).get('aws_sns_sqs', {}).get('setup_concurrency', 10))
+
+            async def setup_queue(topic: Optional[str], func: Callable, queue_name: Optional[str] = None, competing_consumer: Optional[bool] = None, visibility_timeout: Optional[int] = None,
+                                  max_receive_count: Optional[int] = None, dead_letter_queue_name: Optional[str] = None, raw_message_delivery: bool = False,
+                                  filter_policy: Optional[str] = None) -> str:
                 _uuid = obj.uuid
 
                 if queue_name and competing_consumer is False:
                     raise AWSSNSSQSException('Queue with predefined queue name must be competing', log_level=context.get('log_level'))
 
                 if queue_name is None:
-                    queue_name = cls.get_queue_name(cls.encode_topic(topic), func.__name__, _uuid, competing_consumer, context)
+                    queue_name = cls.get_queue_name(cls.encode_topic(str(topic)), func.__name__, _uuid, competing_consumer, context)
                 else:
                     queue_name = cls.prefix_queue_name(queue_name, context)
 
-                queue_url, queue_arn = await cls.create_queue(cls, queue_name, context)  # type: str, str
-
-                if re.search(r'([*#])', topic):
-                    await cls.subscribe_wildcard_topic(cls, topic, queue_arn, queue_url, context)
-                else:
-                    topic_arn = await cls.create_topic(cls, topic, context)
-                    await cls.subscribe_topics(cls, (topic_arn,), queue_arn, queue_url, context)
+                # FIFO topics can only deliver messages to FIFO queues
+                if cls.is_fifo(topic) and not cls.is_fifo(queue_name):
+                    queue_name = '{}{}'.format(queue_name, FIFO_SUFFIX)
+
+                is_wildcard_topic = bool(topic and re.search(r'([*#])', topic))
+                digest = cls.get_topology_digest(cls.get_topic_name(topic, context) if topic else None, queue_name, visibility_timeout, max_receive_count, dead_letter_queue_name, raw_message_delivery, filter_policy,
+                                                 context.get('options', {}).get('aws_sns_sqs', {}).get('queue_policy'), context.get('options', {}).get('aws_sns_sqs', {}).get('wildcard_queue_policy'))
+
+                subscription_attributes = {}  # type: Dict[str, str]
+                if raw_message_delivery:
+                    subscription_attributes['RawMessageDelivery'] = 'true'
+                if filter_policy:
+                    subscription_attributes['FilterPolicy'] = filter_policy
+                subscription_digest = cls.get_topology_digest(cls.get_topic_name(topic, context) if topic else None, subscription_attributes)
+
+                async with semaphore:
+                    # Queues set up by an earlier run with the same configuration are only verified to still exist,
+                    # along with their subscriptions and the attributes of the subscriptions
+                    manifest_entry = topology_manifest.get(queue_name)
+                    if not is_wildcard_topic and manifest_entry and manifest_entry.get('digest') == digest and manifest_entry.get('subscription_digest') == subscription_digest and \
+                            (manifest_entry.get('subscription_arns') or not topic):
+                        if await cls.queue_exists(cls, manifest_entry.get('queue_url'), manifest_entry.get('queue_arn'), context) and \
+                                await cls.subscriptions_exist(cls, manifest_entry.get('subscription_arns') or [], manifest_entry.get('queue_arn'), subscription_attributes, context):
+                            return str(manifest_entry.get('queue_url'))
+
+                    queue_url, queue_arn = await cls.create_queue(cls, queue_name, context)  # type: str, str
+
+                    queue_attributes = {}
+                    if visibility_timeout is not None:
+                        queue_attributes['VisibilityTimeout'] = str(int(visibility_timeout))
+                    if max_receive_count or dead_letter_queue_name:
+                        _, dead_letter_queue_arn = await cls.create_queue(cls, cls.get_dead_letter_queue_name(queue_name, dead_letter_queue_name, context), context)
+                        queue_attributes['RedrivePolicy'] = ujson.dumps({'deadLetterTargetArn': dead_letter_queue_arn, 'maxReceiveCount': str(int(max_receive_count or DEFAULT_MAX_RECEIVE_COUNT))})
+
+                    if not topic:
+                        # Queues of @sqs handlers receive messages sent directly to the queue and have no subscriptions
+                        await cls.set_queue_attributes(cls, queue_url, queue_attributes, context)
+                        subscription_arn_list = []
+                    elif is_wildcard_topic:
+                        subscription_arn_list = await cls.subscribe_wildcard_topic(cls, topic, queue_arn, queue_url, context, queue_attributes=queue_attributes, subscription_attributes=subscription_attributes)
+                    else:
+                        topic_arn = await cls.create_topic(cls, topic, context)
+                        subscription_arn_list = await cls.subscribe_topics(cls, (topic_arn,), queue_arn, queue_url, context, queue_attributes=queue_attributes, subscription_attributes=subscription_attributes)
+
+                topology_manifest[queue_name] = {
+                    'queue_url': queue_url,
+                    'queue_arn': queue_arn,
+                    'subscription_arns': subscription_arn_list or [],
+                    'digest': digest,
+                    'subscription_digest': subscription_digest
+                }
 
                 return queue_url
 
-            for topic, competing, queue_name, func, handler in context.get('_aws_sns_sqs_subscribers', []):
-                queue_url = await setup_queue(topic, func, competing_consumer=competing, queue_name=queue_name)
-                await cls.consume_queue(cls, obj, context, handler, queue_url=queue_url)
+            subscribers = context.get('_aws_sns_sqs_subscribers', [])
+            default_raw_message_delivery = bool(context.get('options', {}).get('aws_sns_sqs', {}).get('raw_message_delivery', False))
+            queue_urls = await asyncio.gather(*[setup_queue(subscriber.topic, subscriber.func, competing_consumer=subscriber.competing, queue_name=subscriber.queue_name,
+                                                            visibility_timeout=subscriber.visibility_timeout, max_receive_count=subscriber.max_receive_count,
+                                                            dead_letter_queue_name=subscriber.dead_letter_queue_name,
+                                                            raw_message_delivery=default_raw_message_delivery if subscriber.raw_message_delivery is None else subscriber.raw_message_delivery,
+                                                            filter_policy=cls.get_filter_policy(subscriber.filter_policy))
+                                                for subscriber in subscribers])
+            cls.store_topology_manifest(topology_manifest, context)
+
+            # Subscriptions are set up again when a queue has been deleted, which replaces the running refresh task
+            if cls.wildcard_subscription_task and not cls.wildcard_subscription_task.done():
+                cls.wildcard_subscription_task.cancel()
+            cls.wildcard_subscription_task = None
+            if context.get('_aws_sns_sqs_wildcard_subscriptions'):
+                cls.wildcard_subscription_task = asyncio.ensure_future(cls.refresh_wildcard_subscriptions(cls, context))
+
+            for queue_url, subscriber in zip(queue_urls, subscribers):
+                await cls.consume_queue(cls, obj, context, subscriber.handler, queue_url=queue_url, pollers=subscriber.pollers, max_pollers=subscriber.max_pollers,
+                                        max_in_flight=subscriber.max_in_flight, visibility_timeout=subscriber.visibility_timeout,
+                                        raw_message_delivery=default_raw_message_delivery if subscriber.raw_message_delivery is None else subscriber.raw_message_delivery,
+                                        group_concurrency=subscriber.group_concurrency, wait_time_seconds=subscriber.wait_time_seconds, idle_backoff=subscriber.idle_backoff)
 
         return _subscribe
 
@@ -677,3 +1797,6 @@ class AWSSNSSQSTransport(Invoker):
 aws_sns_sqs = AWSSNSSQSTransport.decorator(AWSSNSSQSTransport.subscribe_handler)
 aws_sns_sqs_publish = AWSSNSSQSTransport.publish
 publish = AWSSNSSQSTransport.publish
+sqs = AWSSNSSQSTransport.decorator(AWSSNSSQSTransport.sqs_handler)
+sqs_send = AWSSNSSQSTransport.send
+sqs_send_batch = AWSSNSSQSTransport.send_batch
@@ -0,0 +1,558 @@
+import asyncio
+import hashlib
+import heapq
+import time
+import uuid
+import ujson
+import botocore
+from collections import OrderedDict, deque
+from typing import Any, Dict, List, Optional, Tuple
+
+ACCOUNT_ID = '000000000000'
+REGION_NAME = 'memory'
+FIFO_SUFFIX = '.fifo'
+MAX_BATCH_ENTRIES = 10
+MAX_WAIT_TIME_SECONDS = 20
+LIST_TOPICS_PAGE_SIZE = 100
+DEDUPLICATION_INTERVAL = 300
+DEFAULT_VISIBILITY_TIMEOUT = 30
+
+
+def client_error(code: str, message: str, operation_name: str) -> Exception:
+    error = botocore.exceptions.ClientError({'Error': {'Code': code, 'Message': message}}, operation_name)  # type: Exception
+    return error
+
+
+class MemoryMessage(object):
+    __slots__ = ('message_id', 'body', 'message_attributes', 'message_group_id', 'sequence', 'sent_at', 'visible_at', 'receive_count', 'receipt_handle', 'deleted')
+
+    def __init__(self, message_id: str, body: str, message_attributes: Optional[Dict], message_group_id: Optional[str], sequence: int, visible_at: float) -> None:
+        self.message_id = message_id
+        self.body = body
+        self.message_attributes = message_attributes
+        self.message_group_id = message_group_id
+        self.sequence = sequence
+        self.sent_at = time.time()
+        self.visible_at = visible_at
+        self.receive_count = 0
+        self.receipt_handle = None  # type: Optional[str]
+        self.deleted = False
+
+
+class MemoryQueue(object):
+    # Visible messages of standard queues are kept in a deque, while received and delayed messages are kept in a heap
+    # ordered by the time they become visible again. Messages of FIFO queues are kept in order per message group, and
+    # a group is skipped for as long as its first message is in flight.
+    def __init__(self, name: str, attributes: Optional[Dict] = None) -> None:
+        self.name = name
+        self.url = 'memory://sqs/{}/{}'.format(ACCOUNT_ID, name)
+        self.arn = 'arn:aws:sqs:{}:{}:{}'.format(REGION_NAME, ACCOUNT_ID, name)
+        self.fifo = name.endswith(FIFO_SUFFIX)
+        self.attributes = {
+            'QueueArn': self.arn,
+            'VisibilityTimeout': str(DEFAULT_VISIBILITY_TIMEOUT),
+            'DelaySeconds': '0',
+            'ReceiveMessageWaitTimeSeconds': '0',
+            'CreatedTimestamp': str(int(time.time()))
+        }  # type: Dict[str, str]
+        self.attributes.update({k: str(v) for k, v in (attributes or {}).items()})
+
+        self.visible = deque()  # type: deque
+        self.invisible = []  # type: List[Tuple[float, int, MemoryMessage]]
+        self.groups = OrderedDict()  # type: OrderedDict
+        self.receipts = {}  # type: Dict[str, MemoryMessage]
+        self.deduplication_ids = {}  # type: Dict[str, Tuple[float, str]]
+        self.waiters = set()  # type: set
+        self.sequence = 0
+        self.size = 0
+        self.compacted_size = 0
+
+    @property
+    def visibility_timeout(self) -> int:
+        return int(self.attributes.get('VisibilityTimeout', DEFAULT_VISIBILITY_TIMEOUT))
+
+    @property
+    def redrive_policy(self) -> Optional[Dict]:
+        redrive_policy = self.attributes.get('RedrivePolicy')
+        if not redrive_policy:
+            return None
+        return dict(ujson.loads(redrive_policy))
+
+    def wake_waiters(self) -> None:
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.waiters = set()
+
+    def add_message(self, body: str, message_attributes: Optional[Dict] = None, delay_seconds: Optional[int] = None, message_group_id: Optional[str] = None,
+                    message_deduplication_id: Optional[str] = None) -> str:
+        current_time = time.time()
+        if self.fifo:
+            if not message_group_id:
+                raise ValueError('The request must contain the parameter MessageGroupId.')
+            message_deduplication_id = message_deduplication_id or hashlib.sha256(body.encode('utf-8')).hexdigest()
+            deduplicated = self.deduplication_ids.get(message_deduplication_id)
+            if deduplicated and deduplicated[0] > current_time:
+                return deduplicated[1]
+
+        message_id = str(uuid.uuid4())
+        self.sequence += 1
+        delay = int(self.attributes.get('DelaySeconds', 0)) if delay_seconds is None else delay_seconds
+        message = MemoryMessage(message_id, body, message_attributes, message_group_id if self.fifo else None, self.sequence, current_time + delay)
+        self.size += 1
+
+        if self.fifo:
+            self.deduplication_ids[str(message_deduplication_id)] = (current_time + DEDUPLICATION_INTERVAL, message_id)
+            self.groups.setdefault(message_group_id, deque()).append(message)
+        elif delay > 0:
+            heapq.heappush(self.invisible, (message.visible_at, message.sequence, message))
+        else:
+            self.visible.append(message)
+
+        self.wake_waiters()
+        return message_id
+
+    def release_messages(self, current_time: float) -> Optional[float]:
+        # Messages whose visibility timeout has expired are made visible again. Returns the time when the next
+        # invisible message becomes visible.
+        while self.invisible and self.invisible[0][0] <= current_time:
+            visible_at, _, message = heapq.heappop(self.invisible)
+            if message.deleted or message.visible_at != visible_at:
+                continue
+            if message.receipt_handle:
+                self.receipts.pop(message.receipt_handle, None)
+                message.receipt_handle = None
+            if not self.fifo:
+                self.visible.append(message)
+
+        return self.invisible[0][0] if self.invisible else None
+
+    def take_messages(self, max_number_of_messages: int, current_time: float) -> List[MemoryMessage]:
+        messages = []  # type: List[MemoryMessage]
+        if not self.fifo:
+            while self.visible and len(messages) < max_number_of_messages:
+                message = self.visible.popleft()
+                if not message.deleted:
+                    messages.append(message)
+            return messages
+
+        for message_group_id, group in list(self.groups.items()):
+            if len(messages) >= max_number_of_messages:
+                break
+            if group[0].visible_at > current_time:
+                continue
+            for message in group:
+                if len(messages) >= max_number_of_messages or message.visible_at > current_time:
+                    break
+                messages.append(message)
+            self.groups.move_to_end(message_group_id)
+        return messages
+
+    def receive_messages(self, max_number_of_messages: int, dead_letter_queues: Dict[str, 'MemoryQueue'], visibility_timeout: Optional[int] = None) -> List[MemoryMessage]:
+        current_time = time.time()
+        self.release_messages(current_time)
+
+        redrive_policy = self.redrive_policy
+        max_receive_count = int(redrive_policy.get('maxReceiveCount', 0)) if redrive_policy else 0
+        dead_letter_queue = dead_letter_queues.get(str(redrive_policy.get('deadLetterTargetArn'))) if redrive_policy else None
+
+        received_messages = []  # type: List[MemoryMessage]
+        while len(received_messages) < max_number_of_messages:
+            messages = self.take_messages(max_number_of_messages - len(received_messages), current_time)
+            if not messages:
+                break
+
+            for message in messages:
+                if max_receive_count and dead_letter_queue and message.receive_count >= max_receive_count:
+                    # Messages which have been received too many times are moved to the dead-letter queue
+                    self.remove_message(message)
+                    dead_letter_queue.add_message(message.body, message.message_attributes, delay_seconds=0, message_group_id=message.message_group_id,
+                                                  message_deduplication_id=message.message_id)
+                    continue
+
+                message.receive_count += 1
+                message.receipt_handle = '{}:{}'.format(message.message_id, uuid.uuid4())
+                self.receipts[message.receipt_handle] = message
+                message.visible_at = float('inf')
+                received_messages.append(message)
+
+        # The visibility timeout is applied once the batch is complete, so that a message is received at most once per batch
+        for message in received_messages:
+            self.set_visibility(message, self.visibility_timeout if visibility_timeout is None else visibility_timeout, current_time)
+
+        return received_messages
+
+    def set_visibility(self, message: MemoryMessage, visibility_timeout: int, current_time: float) -> None:
+        message.visible_at = current_time + visibility_timeout
+        if visibility_timeout > 0:
+            heapq.heappush(self.invisible, (message.visible_at, message.sequence, message))
+            return
+
+        if message.receipt_handle:
+            self.receipts.pop(message.receipt_handle, None)
+            message.receipt_handle = None
+        if not self.fifo:
+            self.visible.appendleft(message)
+        self.wake_waiters()
+
+    def remove_message(self, message: MemoryMessage) -> None:
+        message.deleted = True
+        self.size -= 1
+
+        # Heap entries of deleted messages are otherwise only dropped once their visibility timeout expires
+        if len(self.invisible) > 2 * self.compacted_size + 1024:
+            self.invisible = [entry for entry in self.invisible if not entry[2].deleted and entry[2].visible_at == entry[0]]
+            heapq.heapify(self.invisible)
+            self.compacted_size = len(self.invisible)
+        if message.receipt_handle:
+            self.receipts.pop(message.receipt_handle, None)
+            message.receipt_handle = None
+        if self.fifo:
+            group = self.groups.get(message.message_group_id)
+            if group is not None:
+                group.remove(message)
+                if not group:
+                    self.groups.pop(message.message_group_id, None)
+                elif group[0].visible_at <= time.time():
+                    self.wake_waiters()
+
+    def get_attributes(self, attribute_names: Optional[List[str]] = None) -> Dict[str, str]:
+        current_time = time.time()
+        self.release_messages(current_time)
+        not_visible = len([message for message in self.receipts.values() if not message.deleted])
+        attributes = dict(self.attributes)
+        attributes.update({
+            'ApproximateNumberOfMessages': str(max(self.size - not_visible, 0)),
+            'ApproximateNumberOfMessagesNotVisible': str(not_visible)
+        })
+        if not attribute_names or 'All' in attribute_names:
+            return attributes
+        return {name: value for name, value in attributes.items() if name in attribute_names}
+
+
+class AWSSNSSQSMemoryBackend(object):
+    # In-process emulation of the subset of SNS and SQS used by the aws_sns_sqs transport, selected with
+    # options.aws_sns_sqs.backend = 'memory'. Errors are raised as botocore ClientError exceptions with the same
+    # error codes as AWS, so that the transport handles them as it would in production.
+    default_backend = None  # type: Optional[AWSSNSSQSMemoryBackend]
+
+    def __init__(self) -> None:
+        self.topics = {}  # type: Dict[str, Dict[str, Any]]
+        self.subscriptions = {}  # type: Dict[str, Dict[str, Any]]
+        self.queues = {}  # type: Dict[str, MemoryQueue]
+        self.queue_arns = {}  # type: Dict[str, MemoryQueue]
+        self.objects = {}  # type: Dict[Tuple[str, str], bytes]
+
+    @classmethod
+    def get_default_backend(cls) -> 'AWSSNSSQSMemoryBackend':
+        if not cls.default_backend:
+            cls.default_backend = cls()
+        return cls.default_backend
+
+    def create_client(self, name: str) -> Any:
+        if name == 'sns':
+            return MemorySNSClient(self)
+        if name == 'sqs':
+            return MemorySQSClient(self)
+        if name == 's3':
+            return MemoryS3Client(self)
+        raise ValueError('Unknown service "{}"'.format(name))
+
+    def get_queue(self, queue_url: str, operation_name: str) -> MemoryQueue:
+        queue = self.queues.get(queue_url)
+        if not queue:
+            raise client_error('AWS.SimpleQueueService.NonExistentQueue', 'The specified queue does not exist for this wsdl version.', operation_name)
+        return queue
+
+    @classmethod
+    def match_filter_policy(cls, filter_policy: Optional[str], message_attributes: Optional[Dict]) -> bool:
+        if not filter_policy:
+            return True
+
+        for name, conditions in ujson.loads(filter_policy).items():
+            attribute = (message_attributes or {}).get(name)
+            values = []  # type: List[Any]
+            if attribute:
+                if attribute.get('DataType') == 'String.Array':
+                    values = list(ujson.loads(attribute.get('StringValue')))
+                elif attribute.get('DataType') == 'Number':
+                    values = [float(attribute.get('StringValue'))]
+                else:
+                    values = [attribute.get('StringValue')]
+
+            if not any(cls.match_filter_condition(condition, attribute is not None, values) for condition in (conditions if isinstance(conditions, list) else [conditions])):
+                return False
+
+        return True
+
+    @classmethod
+    def match_filter_condition(cls, condition: Any, exists: bool, values: List[Any]) -> bool:
+        if not isinstance(condition, dict):
+            if isinstance(condition, (int, float)) and not isinstance(condition, bool):
+                return any(isinstance(value, float) and value == condition for value in values)
+            return any(value == condition for value in values)
+
+        if 'exists' in condition:
+            return bool(condition.get('exists')) == exists
+        if 'prefix' in condition:
+            return any(isinstance(value, str) and value.startswith(str(condition.get('prefix'))) for value in values)
+        if 'anything-but' in condition:
+            excluded = condition.get('anything-but')
+            excluded = excluded if isinstance(excluded, list) else [excluded]
+            return bool(values) and not any(value in excluded for value in values)
+        if 'numeric' in condition:
+            operators = {'=': lambda a, b: a == b, '<': lambda a, b: a < b, '<=': lambda a, b: a <= b, '>': lambda a, b: a > b, '>=': lambda a, b: a >= b}
+            numeric = list(condition.get('numeric') or [])
+            comparisons = list(zip(numeric[::2], numeric[1::2]))
+            return any(isinstance(value, float) and all(operators[operator](value, float(operand)) for operator, operand in comparisons) for value in values)
+
+        return False
+
+
+class MemoryClient(object):
+    def __init__(self, backend: AWSSNSSQSMemoryBackend) -> None:
+        self.backend = backend
+
+    async def close(self) -> None:
+        pass
+
+
+class MemorySNSClient(MemoryClient):
+    async def create_topic(self, Name: str, Attributes: Optional[Dict] = None) -> Dict:
+        topic_arn = 'arn:aws:sns:{}:{}:{}'.format(REGION_NAME, ACCOUNT_ID, Name)
+        if topic_arn not in self.backend.topics:
+            self.backend.topics[topic_arn] = {'Attributes': dict(Attributes or {}), 'Subscriptions': []}
+        return {'TopicArn': topic_arn}
+
+    async def list_topics(self, NextToken: Optional[str] = None) -> Dict:
+        topic_arns = sorted(self.backend.topics.keys())
+        start = int(NextToken or 0)
+        response = {'Topics': [{'TopicArn': topic_arn} for topic_arn in topic_arns[start:start + LIST_TOPICS_PAGE_SIZE]]}  # type: Dict[str, Any]
+        if start + LIST_TOPICS_PAGE_SIZE < len(topic_arns):
+            response['NextToken'] = str(start + LIST_TOPICS_PAGE_SIZE)
+        return response
+
+    async def subscribe(self, TopicArn: str, Protocol: str, Endpoint: str, Attributes: Optional[Dict] = None) -> Dict:
+        topic = self.backend.topics.get(TopicArn)
+        if topic is None:
+            raise client_error('NotFound', 'Topic does not exist', 'Subscribe')
+
+        for subscription_arn in topic['Subscriptions']:
+            subscription = self.backend.subscriptions[subscription_arn]
+            if subscription['Endpoint'] == Endpoint:
+                if Attributes and any(subscription['Attributes'].get(name) != value for name, value in Attributes.items()):
+                    raise client_error('InvalidParameter', 'Invalid parameter: Attributes Reason: Subscription already exists with different attributes', 'Subscribe')
+                return {'SubscriptionArn': subscription_arn}
+
+        subscription_arn = '{}:{}'.format(TopicArn, uuid.uuid4())
+        self.backend.subscriptions[subscription_arn] = {'TopicArn': TopicArn, 'Protocol': Protocol, 'Endpoint': Endpoint, 'Attributes': dict(Attributes or {})}
+        topic['Subscriptions'].append(subscription_arn)
+        return {'SubscriptionArn': subscription_arn}
+
+    async def get_subscription_attributes(self, SubscriptionArn: str) -> Dict:
+        subscription = self.backend.subscriptions.get(SubscriptionArn)
+        if subscription is None:
+            raise client_error('NotFound', 'Subscription does not exist', 'GetSubscriptionAttributes')
+        attributes = {'SubscriptionArn': SubscriptionArn, 'TopicArn': subscription['TopicArn'], 'Protocol': subscription['Protocol'], 'Endpoint': subscription['Endpoint'],
+                      'RawMessageDelivery': 'false', 'PendingConfirmation': 'false'}
+        attributes.update(subscription['Attributes'])
+        return {'Attributes': attributes}
+
+    async def set_subscription_attributes(self, SubscriptionArn: str, AttributeName: str, AttributeValue: str) -> Dict:
+        subscription = self.backend.subscriptions.get(SubscriptionArn)
+        if subscription is None:
+            raise client_error('NotFound', 'Subscription does not exist', 'SetSubscriptionAttributes')
+        subscription['Attributes'][AttributeName] = AttributeValue
+        return {}
+
+    async def publish(self, TopicArn: str, Message: str, MessageAttributes: Optional[Dict] = None, MessageGroupId: Optional[str] = None, MessageDeduplicationId: Optional[str] = None) -> Dict:
+        topic = self.backend.topics.get(TopicArn)
+        if topic is None:
+            raise client_error('NotFound', 'Topic does not exist', 'Publish')
+
+        message_id = str(uuid.uuid4())
+        envelope = None
+        for subscription_arn in topic['Subscriptions']:
+            subscription = self.backend.subscriptions[subscription_arn]
+            queue = self.backend.queue_arns.get(subscription['Endpoint'])
+            if not queue or not AWSSNSSQSMemoryBackend.match_filter_policy(subscription['Attributes'].get('FilterPolicy'), MessageAttributes):
+                continue
+
+            if str(subscription['Attributes'].get('RawMessageDelivery', 'false')).lower() == 'true':
+                queue.add_message(Message, MessageAttributes, message_group_id=MessageGroupId, message_deduplication_id=MessageDeduplicationId)
+                continue
+
+            if envelope is None:
+                envelope = ujson.dumps({
+                    'Type': 'Notification',
+                    'MessageId': message_id,
+                    'TopicArn': TopicArn,
+                    'Message': Message,
+                    'Timestamp': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()),
+                    'SignatureVersion': '1',
+                    'MessageAttributes': {name: {'Type': value.get('DataType'), 'Value': value.get('StringValue')} for name, value in (MessageAttributes or {}).items()}
+                })
+            queue.add_message(envelope, None, message_group_id=MessageGroupId, message_deduplication_id=MessageDeduplicationId)
+
+        return {'MessageId': message_id}
+
+
+class MemorySQSClient(MemoryClient):
+    async def create_queue(self, QueueName: str, Attributes: Optional[Dict] = None) -> Dict:
+        queue_url = 'memory://sqs/{}/{}'.format(ACCOUNT_ID, QueueName)
+        if queue_url not in self.backend.queues:
+            queue = MemoryQueue(QueueName, Attributes)
+            self.backend.queues[queue_url] = queue
+            self.backend.queue_arns[queue.arn] = queue
+        return {'QueueUrl': queue_url}
+
+    async def get_queue_url(self, QueueName: str) -> Dict:
+        queue = self.backend.get_queue('memory://sqs/{}/{}'.format(ACCOUNT_ID, QueueName), 'GetQueueUrl')
+        return {'QueueUrl': queue.url}
+
+    async def delete_queue(self, QueueUrl: str) -> Dict:
+        queue = self.backend.get_queue(QueueUrl, 'DeleteQueue')
+        self.backend.queues.pop(QueueUrl, None)
+        self.backend.queue_arns.pop(queue.arn, None)
+        return {}
+
+    async def get_queue_attributes(self, QueueUrl: str, AttributeNames: Optional[List[str]] = None) -> Dict:
+        queue = self.backend.get_queue(QueueUrl, 'GetQueueAttributes')
+        return {'Attributes': queue.get_attributes(AttributeNames)}
+
+    async def set_queue_attributes(self, QueueUrl: str, Attributes: Dict) -> Dict:
+        queue = self.backend.get_queue(QueueUrl, 'SetQueueAttributes')
+        queue.attributes.update({k: str(v) for k, v in Attributes.items()})
+        return {}
+
+    async def send_message(self, QueueUrl: str, MessageBody: str, MessageAttributes: Optional[Dict] = None, DelaySeconds: Optional[int] = None, MessageGroupId: Optional[str] = None,
+                           MessageDeduplicationId: Optional[str] = None) -> Dict:
+        queue = self.backend.get_queue(QueueUrl, 'SendMessage')
+        try:
+            message_id = queue.add_message(MessageBody, MessageAttributes, DelaySeconds, MessageGroupId, MessageDeduplicationId)
+        except ValueError as e:
+            raise client_error('MissingParameter', str(e), 'SendMessage') from e
+        return {'MessageId': message_id, 'MD5OfMessageBody': hashlib.md5(MessageBody.encode('utf-8')).hexdigest()}
+
+    async def send_message_batch(self, QueueUrl: str, Entries: List[Dict]) -> Dict:
+        queue = self.backend.get_queue(QueueUrl, 'SendMessageBatch')
+        if len(Entries) > MAX_BATCH_ENTRIES:
+            raise client_error('AWS.SimpleQueueService.TooManyEntriesInBatchRequest', 'Maximum number of entries per request are 10.', 'SendMessageBatch')
+
+        response = {'Successful': [], 'Failed': []}  # type: Dict[str, List]
+        for entry in Entries:
+            try:
+                message_id = queue.add_message(entry['MessageBody'], entry.get('MessageAttributes'), entry.get('DelaySeconds'), entry.get('MessageGroupId'),
+                                               entry.get('MessageDeduplicationId'))
+            except ValueError as e:
+                response['Failed'].append({'Id': entry.get('Id'), 'SenderFault': True, 'Code': 'MissingParameter', 'Message': str(e)})
+                continue
+            response['Successful'].append({'Id': entry.get('Id'), 'MessageId': message_id})
+        return response
+
+    async def receive_message(self, QueueUrl: str, WaitTimeSeconds: Optional[int] = None, MaxNumberOfMessages: int = 1, AttributeNames: Optional[List[str]] = None,
+                              VisibilityTimeout: Optional[int] = None) -> Dict:
+        queue = self.backend.get_queue(QueueUrl, 'ReceiveMessage')
+        wait_time_seconds = min(int(queue.attributes.get('ReceiveMessageWaitTimeSeconds', 0)) if WaitTimeSeconds is None else WaitTimeSeconds, MAX_WAIT_TIME_SECONDS)
+        max_number_of_messages = min(max(MaxNumberOfMessages, 1), MAX_BATCH_ENTRIES)
+        end_time = time.time() + wait_time_seconds
+
+        while True:
+            messages = queue.receive_messages(max_number_of_messages, self.backend.queue_arns, VisibilityTimeout)
+            current_time = time.time()
+            if messages or current_time >= end_time:
+                break
+
+            # Wait for new messages, or until an invisible message becomes visible again
+            waiter = asyncio.Future()  # type: asyncio.Future
+            queue.waiters.add(waiter)
+            timeout = end_time - current_time
+            if queue.invisible:
+                timeout = min(timeout, max(queue.invisible[0][0] - current_time, 0.001))
+            try:
+                await asyncio.wait([waiter], timeout=timeout)
+            finally:
+                queue.waiters.discard(waiter)
+
+        response_messages = []
+        for message in messages:
+            attributes = {
+                'ApproximateReceiveCount': str(message.receive_count),
+                'SentTimestamp': str(int(message.sent_at * 1000))
+            }
+            if message.message_group_id:
+                attributes['MessageGroupId'] = message.message_group_id
+            if AttributeNames and 'All' not in AttributeNames:
+                attributes = {name: value for name, value in attributes.items() if name in AttributeNames}
+            response_messages.append({
+                'MessageId': message.message_id,
+                'ReceiptHandle': message.receipt_handle,
+                'MD5OfBody': hashlib.md5(message.body.encode('utf-8')).hexdigest(),
+                'Body': message.body,
+                'Attributes': attributes
+            })
+
+        return {'Messages': response_messages} if response_messages else {}
+
+    async def delete_message(self, QueueUrl: str, ReceiptHandle: str) -> Dict:
+        queue = self.backend.get_queue(QueueUrl, 'DeleteMessage')
+        message = queue.receipts.get(ReceiptHandle)
+        if not message:
+            raise client_error('ReceiptHandleIsInvalid', 'The input receipt handle is invalid.', 'DeleteMessage')
+        queue.remove_message(message)
+        return {}
+
+    async def delete_message_batch(self, QueueUrl: str, Entries: List[Dict]) -> Dict:
+        queue = self.backend.get_queue(QueueUrl, 'DeleteMessageBatch')
+        response = {'Successful': [], 'Failed': []}  # type: Dict[str, List]
+        for entry in Entries:
+            message = queue.receipts.get(entry['ReceiptHandle'])
+            if not message:
+                response['Failed'].append({'Id': entry.get('Id'), 'SenderFault': True, 'Code': 'ReceiptHandleIsInvalid', 'Message': 'The input receipt handle is invalid.'})
+                continue
+            queue.remove_message(message)
+            response['Successful'].append({'Id': entry.get('Id')})
+        return response
+
+    async def change_message_visibility(self, QueueUrl: str, ReceiptHandle: str, VisibilityTimeout: int) -> Dict:
+        queue = self.backend.get_queue(QueueUrl, 'ChangeMessageVisibility')
+        message = queue.receipts.get(ReceiptHandle)
+        if not message:
+            raise client_error('ReceiptHandleIsInvalid', 'The input receipt handle is invalid.', 'ChangeMessageVisibility')
+        queue.set_visibility(message, VisibilityTimeout, time.time())
+        return {}
+
+    async def change_message_visibility_batch(self, QueueUrl: str, Entries: List[Dict]) -> Dict:
+        queue = self.backend.get_queue(QueueUrl, 'ChangeMessageVisibilityBatch')
+        response = {'Successful': [], 'Failed': []}  # type: Dict[str, List]
+        for entry in Entries:
+            message = queue.receipts.get(entry['ReceiptHandle'])
+            if not message:
+                response['Failed'].append({'Id': entry.get('Id'), 'SenderFault': True, 'Code': 'ReceiptHandleIsInvalid', 'Message': 'The input receipt handle is invalid.'})
+                continue
+            queue.set_visibility(message, int(entry.get('VisibilityTimeout', 0)), time.time())
+            response['Successful'].append({'Id': entry.get('Id')})
+        return response
+
+
+class MemoryS3Object(object):
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+
+    async def read(self) -> bytes:
+        return self.data
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryS3Client(MemoryClient):
+    async def put_object(self, Bucket: str, Key: str, Body: bytes) -> Dict:
+        self.backend.objects[(Bucket, Key)] = bytes(Body)
+        return {}
+
+    async def get_object(self, Bucket: str, Key: str) -> Dict:
+        data = self.backend.objects.get((Bucket, Key))
+        if data is None:
+            raise client_error('NoSuchKey', 'The specified key does not exist.', 'GetObject')
+        return {'Body': MemoryS3Object(data), 'ContentLength': len(data)}